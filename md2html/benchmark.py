@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Benchmark runner for md2html
+Run with: python -m md2html.benchmark
+"""
+
+import argparse
+import re
+import sys
+import time
+from pathlib import Path
+from typing import Callable, List, Tuple
+
+from .markdown_preprocessing import (MarkdownDirective, parse_directive_options, parse_markdown_directives,
+                                     parse_frontmatter)
+from .source import SourceBuffer
+
+
+def best_time(func: Callable, repeat: int) -> float:
+    """Best wall-clock time of `repeat` calls, in seconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def print_table(rows: List[Tuple[str, ...]], header: Tuple[str, ...]):
+    widths = [max(len(str(row[i])) for row in rows + [header]) for i in range(len(header))]
+    for row in [header] + rows:
+        print('  '.join(str(cell).ljust(width) for cell, width in zip(row, widths)))
+
+
+################################################################
+########################## Directives ##########################
+################################################################
+
+def legacy_parse_markdown_directives(content: str) -> List[MarkdownDirective]:
+    """The line-by-line directive parser used before the single-pass scanner, kept for comparison"""
+    pattern = r'@(include|src)\s*\(\s*([^,)]+)(?:\s*,\s*(.+))?\s*\)'
+    directives = []
+    for line_number, line in enumerate(content.split('\n'), 1):
+        match = re.search(pattern, line.strip())
+        if match:
+            directives.append(MarkdownDirective(
+                directive_type=match.group(1),
+                file_path=match.group(2).strip().strip('"\''),
+                options=parse_directive_options(match.group(3)),
+                line_number=line_number
+            ))
+    return directives
+
+
+def make_notes_document(size: int) -> str:
+    """Typical notes: prose, directives and fenced code blocks"""
+    section = """## Section
+
+Some prose with `inline code`, a [link](https://example.com) and $x^2$ math.
+@include(partials/snippet.md, lang=cpp, lines=1-20)
+
+```cpp
+// @src(not_a_dependency.cpp)
+int main() { return 0; }
+```
+
+@src(examples/main.cpp, run=true)
+
+"""
+    return section * (size // len(section) + 1)
+
+
+def make_prose_document(size: int) -> str:
+    """Mostly prose, with an occasional directive"""
+    paragraph = ("Lorem ipsum dolor sit amet, `consectetur` adipiscing elit, sed do eiusmod "
+                 "tempor incididunt ut labore et dolore magna aliqua.\n") * 20 + "\n"
+    section = paragraph * 10 + "@include(partials/footer.md)\n\n"
+    return section * (size // len(section) + 1)
+
+
+def make_long_line_document(size: int, line_length: int) -> str:
+    """Very long lines full of unterminated directives, the worst case for a
+    backtracking `(.+)` option group"""
+    line = ("@include(a.md, key=value " * (line_length // 25 + 1))[:line_length]
+    return (line + "\n") * (size // (line_length + 1) + 1)
+
+
+def bench_directives(size_mb: float, repeat: int):
+    """Directive scanning on multi-megabyte files"""
+    size = int(size_mb * 1024 * 1024)
+    documents = [
+        ("prose", make_prose_document(size)),
+        ("notes", make_notes_document(size)),
+        ("long lines (2 KB)", make_long_line_document(size // 8, 2_000)),
+        ("long lines (16 KB)", make_long_line_document(size // 64, 16_000)),
+    ]
+
+    rows = []
+    for name, document in documents:
+        legacy = best_time(lambda: legacy_parse_markdown_directives(document), repeat)
+        scanner = best_time(lambda: parse_markdown_directives(document), repeat)
+        rows.append((name, f"{len(document) / 1024 / 1024:.2f} MB", f"{legacy * 1000:.1f} ms",
+                     f"{scanner * 1000:.1f} ms", f"{legacy / scanner:.1f}x"))
+    print_table(rows, ("document", "size", "line-by-line", "scanner", "speedup"))
+
+
+################################################################
+######################### Frontmatter ##########################
+################################################################
+
+def make_frontmatter_documents(size: int) -> List[str]:
+    """Pages with a realistic front matter block and a body of a few KB"""
+    header = """---
+title: "Notes on {i}"
+date: 2024-01-{day:02d}
+tags: [math, programming, notes, page-{i}]
+authors:
+  - name: Someone
+    email: someone@example.com
+summary: >
+  A longer folded summary of the page that spans
+  a couple of lines in the YAML source.
+---
+"""
+    body = "Some prose for the page body, with `code` and $math$.\n" * 60
+    documents = []
+    total = 0
+    while total < size:
+        document = header.format(i=len(documents), day=len(documents) % 28 + 1) + body
+        documents.append(document)
+        total += len(document)
+    return documents
+
+
+def bench_frontmatter(size_mb: float, repeat: int):
+    """Front matter parsing: python-frontmatter vs. offset + C loader vs. lazy"""
+    import frontmatter
+    documents = make_frontmatter_documents(int(size_mb * 1024 * 1024))
+
+    def python_frontmatter():
+        for document in documents:
+            frontmatter.loads(document).metadata.get('template')
+
+    def eager():
+        for document in documents:
+            parse_frontmatter(SourceBuffer.from_text(document)).get('template')
+
+    def lazy():
+        for document in documents:
+            parse_frontmatter(SourceBuffer.from_text(document), lazy=True).get('template')
+
+    baseline = best_time(python_frontmatter, repeat)
+    rows = [("python-frontmatter", f"{baseline * 1000:.1f} ms", "1.0x")]
+    for name, func in (("offset + C loader", eager), ("lazy, template only", lazy)):
+        elapsed = best_time(func, repeat)
+        rows.append((name, f"{elapsed * 1000:.1f} ms", f"{baseline / elapsed:.1f}x"))
+    print(f"{len(documents)} documents")
+    print_table(rows, ("parser", "time", "speedup"))
+
+
+################################################################
+############################ Memory ############################
+################################################################
+
+def make_site(root: Path, count: int):
+    """A site of count pages spread over nested directories, with front matter,
+    directives and a few copied assets"""
+    page = """---
+title: "Page {i}"
+tags: [notes, section-{section}]
+---
+# Page {i}
+
+@include(../shared/header.md)
+@src(examples/main.cpp, lang=cpp, run=true)
+
+Some prose for the body of the page.
+"""
+    for i in range(count):
+        section = root / f"section{i % 50}" / f"chapter{i % 7}"
+        section.mkdir(parents=True, exist_ok=True)
+        if i % 10 == 0:
+            (section / f"figure{i}.png").write_bytes(b"png")
+        (section / f"page{i}.md").write_text(page.format(i=i, section=i % 50))
+
+
+def bench_memory(size_mb: float, repeat: int):
+    """Memory held by the build graph after scanning a large site"""
+    import shutil
+    import tempfile
+    import tracemalloc
+    from .buildgraph import BuildTargets, handle_target
+    from .config import Config
+
+    count = int(size_mb * 5000)
+    root = Path(tempfile.mkdtemp(prefix="md2html-bench-"))
+    try:
+        make_site(root / "src", count)
+        config = Config(invoked_from=root, bundle_root=root, base_input_path=root / "src",
+                        output_dir=root / "html", recursive=True)
+        tracemalloc.start()
+        targets = BuildTargets(config=config)
+        handle_target(root / "src", config, targets)
+        targets.wait_for_metadata()
+        # File contents are kept for the render stage, but they are bounded by the
+        # source store's limit rather than by the size of the graph
+        targets.sources.buffers.clear()
+        graph, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        nodes = len(targets.nodes)
+        del targets
+    finally:
+        shutil.rmtree(root)
+
+    print_table([(f"{nodes}", f"{graph / 1024 / 1024:.1f} MB", f"{graph / nodes:.0f} B", f"{peak / 1024 / 1024:.1f} MB")],
+                ("nodes", "graph", "per node", "peak during scan"))
+
+
+################################################################
+########################### Markdown ###########################
+################################################################
+
+def bench_markdown(size_mb: float, repeat: int):
+    """Markdown conversion: a new Markdown instance per page vs. one reset between pages"""
+    import markdown
+    from .config import Config
+    from .render import PageRenderer
+    page = make_notes_document(2 * 1024)
+    pages = [page] * max(1, int(size_mb * 1024 * 1024) // len(page))
+    # The extensions pages are rendered with, including highlighting and math. Their
+    # in-memory caches are shared by both runs, so only the setup cost differs.
+    renderer = PageRenderer(Config(invoked_from=Path.cwd(), bundle_root=Path.cwd()))
+    extensions = renderer.markdown_extensions()
+
+    def per_page():
+        return [markdown.markdown(text, extensions=renderer.markdown_extensions()) for text in pages]
+
+    def pooled():
+        instance = markdown.Markdown(extensions=renderer.markdown_extensions())
+        return [instance.reset().convert(text) for text in pages]
+
+    if per_page() != pooled():
+        print("Warning: pooled instance output differs from per-page output")
+    baseline = best_time(per_page, repeat)
+    elapsed = best_time(pooled, repeat)
+    names = [extension if isinstance(extension, str) else type(extension).__name__ for extension in extensions]
+    print(f"{len(pages)} pages of {len(page) / 1024:.1f} KB, extensions: {', '.join(names)}")
+    print_table([("new instance per page", f"{baseline * 1000:.1f} ms", f"{baseline / len(pages) * 1e6:.0f} us", "1.0x"),
+                 ("reset() between pages", f"{elapsed * 1000:.1f} ms", f"{elapsed / len(pages) * 1e6:.0f} us",
+                  f"{baseline / elapsed:.1f}x")],
+                ("renderer", "time", "per page", "speedup"))
+
+
+# Registry of available benchmarks
+BENCHMARKS = {
+    'directives': bench_directives,
+    'frontmatter': bench_frontmatter,
+    'memory': bench_memory,
+    'markdown': bench_markdown,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark runner for md2html")
+    parser.add_argument(
+        '--bench',
+        choices=list(BENCHMARKS.keys()) + ['all'],
+        default='all',
+        help='Which benchmark to run (default: all)'
+    )
+    parser.add_argument('--size-mb', type=float, default=4.0, help='Approximate input size in MB (default: 4)')
+    parser.add_argument('--repeat', type=int, default=3, help='Repetitions per measurement, best is reported (default: 3)')
+    args = parser.parse_args()
+
+    names = list(BENCHMARKS.keys()) if args.bench == 'all' else [args.bench]
+    for name in names:
+        print(f"=== {name}: {BENCHMARKS[name].__doc__} ===")
+        BENCHMARKS[name](args.size_mb, args.repeat)
+        print()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,385 @@
+"""
+Build stage: renders the markdown targets of a build graph and copies the other
+files, skipping targets whose build manifest entry shows that nothing they were
+built from has changed.
+
+The remaining targets become jobs for the scheduler, which runs them on --jobs
+workers. Pages are written through writer.py, only if their HTML changed. With
+--execute, each source that a page runs with @src(file, run=true),
+and the session of each file with @src_begin(run=true) blocks, becomes a job of
+its own that the page waits for, run by the asyncio executor in execute.py.
+
+Copies are made inside the kernel with copy_file_range or sendfile where the
+platform has them, keep the mtime of their input, and are skipped when the output
+already has the input's size, mtime and content hash, e.g. after the manifest was
+lost. With --link-assets, they are hardlinked, or else reflinked on filesystems
+that support it, and only copied if neither works.
+"""
+
+from dataclasses import dataclass, field
+from collections import defaultdict
+from functools import partial
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Set, Tuple
+from pathlib import Path
+import json
+import os
+import sys
+import time
+
+from .buildgraph import BuildTarget, BuildTargets, BuildTargetType
+from .config import Config
+from .execute import Executor
+from .highlight import highlight_fingerprint
+from .manifest import BuildManifest, source_state, written_state
+from .render import RENDER_VERSION, PageRenderer
+from .scheduler import Job, Scheduler, add_requirement
+from .source import SourceBuffer, SourceStore, content_hash, file_hash
+from .writer import sync_files, temp_path_for, write_if_changed
+
+COPY_CHUNK_SIZE = 1024 * 1024
+# ioctl request cloning a file on Linux filesystems with reflinks (btrfs, XFS)
+FICLONE = 0x40049409
+# Render worker processes are replaced after this many pages. Within any process, the
+# renderer also rebuilds its Markdown instance after RENDERER_MAX_PAGES pages, or if
+# memory grows too much (see render.py), which is what bounds leaks with --jobs 1.
+RENDER_WORKER_MAX_PAGES = 1000
+
+
+@dataclass
+class BuildSummary:
+    rendered: int = 0
+    copied: int = 0
+    unchanged: int = 0
+    skipped: int = 0 # existing files left alone because of --no-overwrite
+    errors: List[Tuple[str, str]] = field(default_factory=list) # (input file, error) of each failed target
+    deferred: List[BuildTarget] = field(default_factory=list) # targets not started because the build was stopped
+    viewed_seconds: Optional[float] = None # time until the pages open in a browser were rebuilt, when serving
+    written: int = 0 # output files written
+    kept: int = 0 # output files left as they were: unchanged targets, and outputs built again to the same contents
+
+    @property
+    def failed(self) -> int:
+        return len(self.errors)
+
+    def __str__(self) -> str:
+        parts = [f"{self.rendered} rendered", f"{self.copied} copied", f"{self.unchanged} unchanged"]
+        if self.skipped:
+            parts.append(f"{self.skipped} skipped")
+        if self.failed:
+            parts.append(f"{self.failed} failed")
+        if self.deferred:
+            parts.append(f"{len(self.deferred)} deferred")
+        return f"Build: {', '.join(parts)} (files: {self.written} written, {self.kept} unchanged)"
+
+
+def settings_fingerprint(config: Config) -> str:
+    """Fingerprint of everything besides a page's own files that affects its HTML:
+    the renderer version, the render options and every file in the template search
+    path. Template files are few and small, so hashing them all on each build is
+    cheaper than tracking which of them each page's template includes."""
+    templates = []
+    for templates_dir in config.get_templates_search_paths():
+        for directory, subdirs, files in os.walk(templates_dir):
+            subdirs.sort()
+            for name in sorted(files):
+                path = Path(directory) / name
+                templates.append((str(path), content_hash(path.read_bytes())))
+    settings = {
+        'render_version': RENDER_VERSION,
+        'execute': config.execute,
+        'highlight': highlight_fingerprint(),
+        'math': config.math,
+        'templates': templates,
+    }
+    return content_hash(json.dumps(settings).encode())
+
+
+def kernel_copy(src_fd: int, dst_fd: int, size: int) -> int:
+    """Copy up to size bytes from the current offset of src_fd to that of dst_fd inside
+    the kernel, with copy_file_range, or else sendfile. Returns the number of bytes
+    copied, which is short of size if neither works for these files."""
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < size:
+                count = os.copy_file_range(src_fd, dst_fd, size - copied)
+                if count == 0:
+                    return copied
+                copied += count
+            return copied
+        except OSError:
+            pass # e.g. across filesystems before Linux 5.3
+    if hasattr(os, 'sendfile'):
+        try:
+            while copied < size:
+                # With an explicit offset, sendfile leaves src_fd's offset where copy_file_range left it
+                count = os.sendfile(dst_fd, src_fd, copied, size - copied)
+                if count == 0:
+                    break
+                copied += count
+        except OSError:
+            pass # e.g. macOS, which only sends to sockets
+    return copied
+
+
+def copy_file(input_path: Path, output_path: Path, st: os.stat_result):
+    """Copy a file's contents in the kernel where possible, falling back to a chunked copy,
+    and give the copy the mtime of the input. The copy replaces output_path by a rename,
+    so an output that was a hardlink of the input isn't written through."""
+    temp_path = temp_path_for(output_path)
+    try:
+        with open(input_path, 'rb') as src, open(temp_path, 'wb') as dst:
+            copied = kernel_copy(src.fileno(), dst.fileno(), st.st_size)
+            src.seek(copied)
+            dst.seek(copied)
+            while chunk := src.read(COPY_CHUNK_SIZE):
+                dst.write(chunk)
+        os.utime(temp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(temp_path, output_path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+def link_file(input_path: Path, output_path: Path) -> bool:
+    """Make output_path a hardlink of input_path, or else a reflink (a copy-on-write clone,
+    where the filesystem supports one). Returns whether either worked."""
+    temp_path = temp_path_for(output_path)
+    try:
+        os.link(input_path, temp_path)
+        os.replace(temp_path, output_path)
+        return True
+    except OSError:
+        temp_path.unlink(missing_ok=True)
+    try:
+        import fcntl
+        with open(input_path, 'rb') as src, open(temp_path, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        os.replace(temp_path, output_path)
+        return True
+    except (OSError, ImportError):
+        temp_path.unlink(missing_ok=True)
+        return False
+
+
+def copy_target(input_path: Path, output_path: Path, link: bool = False) -> Tuple[List, List, bool]:
+    """Bring a copied file up to date. Returns the input and output states for the manifest,
+    and whether the output was written. A copy with the size, mtime and contents of the
+    input is left alone, and with link, so is a hardlink of the input.
+
+    Files are only hashed to tell whether such a copy is up to date: links and fresh
+    copies are recorded without a content hash, so they cost no reads of their own."""
+    st = os.stat(input_path)
+    try:
+        out = os.stat(output_path)
+    except FileNotFoundError:
+        out = None
+    if out is not None:
+        linked = (out.st_dev, out.st_ino) == (st.st_dev, st.st_ino)
+        if link and linked:
+            return [st.st_mtime_ns, st.st_size, None], [out.st_mtime_ns, out.st_size, None], False
+        if not link and not linked and (out.st_size, out.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+            digest = file_hash(input_path)
+            if file_hash(output_path) == digest:
+                return [st.st_mtime_ns, st.st_size, digest], [out.st_mtime_ns, out.st_size, digest], False
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    if not (link and link_file(input_path, output_path)):
+        copy_file(input_path, output_path, st)
+    return [st.st_mtime_ns, st.st_size, None], written_state(output_path, None), True
+
+
+# The renderer of this process: the main process's when building on a single
+# worker, otherwise one per render worker process, created by init_renderer
+renderer: Optional[PageRenderer] = None
+
+
+def init_renderer(config: Config, sources: Optional[SourceStore] = None):
+    """Set up the renderer of this process. A renderer left by an earlier build with the
+    same config is kept, with its Markdown instance and templates, for watch mode and
+    the daemon."""
+    global renderer
+    sources = sources if sources is not None else SourceStore()
+    if renderer is not None and renderer.config is config:
+        renderer.sources = sources
+    else:
+        renderer = PageRenderer(config, sources)
+
+
+def render_html(input_path: Path, frontmatter: Optional[Mapping[str, Any]], outputs: Dict[str, Any],
+                source: Optional[SourceBuffer] = None) -> Tuple[List, Dict[str, List], bytes]:
+    """Render a page without writing it. Runs on a render worker, and returns the input
+    and dependency states for the manifest, and the HTML. source is the page as the
+    scan read it, sent along to render workers so that they don't read it again."""
+    if source is not None:
+        renderer.sources.add(source)
+    page = renderer.render(input_path, frontmatter, outputs)
+    dependencies = {os.path.abspath(source.path): source_state(source) for source in page.dependencies}
+    return source_state(page.source), dependencies, page.html.encode('utf-8')
+
+
+def render_page(input_path: Path, output_path: Path, frontmatter: Optional[Mapping[str, Any]], outputs: Dict[str, Any],
+                source: Optional[SourceBuffer] = None) -> Tuple[List, Dict[str, List], List, bool]:
+    """Render a page and write it out if it changed. Runs on a render worker, and returns
+    the input, dependency and output states for the manifest, and whether it was written."""
+    input_state, dependencies, data = render_html(input_path, frontmatter, outputs, source)
+    return (input_state, dependencies, *write_if_changed(output_path, data))
+
+
+def build_scheduler(config: Config, keep_pools: bool = False) -> Scheduler:
+    """The scheduler of a build, whose process pool renders pages with init_renderer's renderer"""
+    return Scheduler(config.jobs, process_initializer=init_renderer, process_initargs=(config,),
+                     process_max_tasks=RENDER_WORKER_MAX_PAGES, keep_pools=keep_pools)
+
+
+def build(targets: BuildTargets, config: Config, only: Optional[Iterable[BuildTarget]] = None,
+          store: Any = None, stop: Optional[Callable[[], bool]] = None,
+          scheduler: Optional[Scheduler] = None) -> BuildSummary:
+    """Bring the outputs of every target up to date, or only of the given targets,
+    e.g. from affected_targets(). Targets that fail are reported in the summary's
+    errors, and don't stop the others from building. Once stop returns true, no
+    more targets are started, and the rest are returned in the summary's deferred.
+
+    With the dev server's serve.OutputStore, rendered pages come back from the workers and are
+    published to the store before they are written, and the hash of every other
+    output is recorded in it for ETags. Pages open in a browser build first, and
+    pages requested while the build runs move to the front of the queue.
+
+    scheduler is one kept between builds, e.g. by a daemon session, so that its
+    render workers stay warm; by default, each build makes its own."""
+    started = time.perf_counter()
+    manifest = BuildManifest.load(config.output_root())
+    settings = settings_fingerprint(config)
+    # Switching --link-assets on or off replaces the copies
+    copy_settings = 'link' if config.link_assets else ''
+    summary = BuildSummary()
+    written_paths: List[Path] = [] # outputs to flush to disk at the end, with --fsync
+    outputs: Dict[str, Any] = {} # ExecutionRequest.key -> output of the run, SessionRequest.key -> block outputs
+    runs: Dict[str, List[str]] = defaultdict(list) # page input_file -> keys of the runs it embeds
+
+    def page_args(node: BuildTarget) -> Tuple:
+        # Taken when the job is submitted, after the runs it embeds have finished
+        page_outputs = {key: outputs[key] for key in runs[node.input_file]}
+        # A single worker renders from targets.sources itself; render workers get the buffer the scan read
+        source = targets.sources.release(node.input_path) if config.jobs > 1 else None
+        if store is not None:
+            return node.input_path, node.frontmatter, page_outputs, source
+        return node.input_path, node.output_path, node.frontmatter, page_outputs, source
+
+    def record_page(node: BuildTarget, result: Tuple):
+        if store is not None:
+            input_state, dependencies, data = result
+            digest = content_hash(data)
+            store.publish(node.output_path, digest, data)
+            key = store.key(node.output_path)
+            if key in viewed:
+                viewed.discard(key)
+                if not viewed:
+                    summary.viewed_seconds = time.perf_counter() - started
+            result = (input_state, dependencies, *write_if_changed(node.output_path, data))
+        input_state, dependencies, output_state, written = result
+        manifest.record(node.output_path, node.input_path, settings, input_state, dependencies, output_state)
+        record_output(node, written)
+        summary.rendered += 1
+        if config.verbose:
+            print(f"Built {node.output_path}", file=sys.stderr)
+
+    def record_output(node: BuildTarget, written: bool):
+        if written:
+            summary.written += 1
+            if config.fsync:
+                written_paths.append(node.output_path)
+        else:
+            summary.kept += 1
+
+    def record_copy(node: BuildTarget, result: Tuple[List, List, bool]):
+        input_state, output_state, written = result
+        manifest.record(node.output_path, node.input_path, copy_settings, input_state, {}, output_state)
+        record_output(node, written)
+        # Copies recorded without a content hash get an ETag from their mtime and size
+        etag = output_state[2] or f"{output_state[0]:x}-{output_state[1]:x}"
+        if not written:
+            summary.unchanged += 1
+            if store is not None:
+                store.note(node.output_path, etag)
+            return
+        if store is not None:
+            store.publish(node.output_path, etag)
+        summary.copied += 1
+        if config.verbose:
+            print(f"Built {node.output_path}", file=sys.stderr)
+
+    pages: Dict[str, Job] = {}
+    jobs: List[Job] = []
+    for node in (targets.nodes.values() if only is None else only):
+        if node.node_type not in (BuildTargetType.MARKDOWN, BuildTargetType.COPY):
+            continue
+        output_path = node.output_path
+        # Copies don't go through a template, so the render settings don't apply to them
+        node_settings = settings if node.node_type == BuildTargetType.MARKDOWN else copy_settings
+        if manifest.is_current(output_path, node.input_path, node_settings):
+            summary.unchanged += 1
+            summary.kept += 1
+            if store is not None:
+                store.note(output_path, manifest.output_digest(output_path))
+            continue
+        if not config.force_overwrite and not manifest.contains(output_path) and output_path.exists():
+            if config.verbose:
+                print(f"Skipping {output_path}: file exists and --no-overwrite is set", file=sys.stderr)
+            summary.skipped += 1
+            continue
+        if node.node_type == BuildTargetType.MARKDOWN:
+            job = Job(node, render_page if store is None else render_html, partial(page_args, node),
+                      partial(record_page, node))
+            pages[node.input_file] = job
+        else:
+            job = Job(node, copy_target, partial(tuple, (node.input_path, output_path, config.link_assets)),
+                      partial(record_copy, node))
+        jobs.append(job)
+
+    viewed: Set[str] = set() # store keys of the open pages that haven't been rebuilt yet
+    promote = None
+    if store is not None:
+        page_jobs = {store.key(job.target.output_path): job for job in jobs}
+        viewed = {key for key in store.viewed() | set(store.take_requested()) if key in page_jobs}
+        jobs.sort(key=lambda job: store.key(job.target.output_path) not in viewed)
+        promote = lambda: [page_jobs[key] for key in store.take_requested() if key in page_jobs]
+
+    # Each run embedded by a page that is being rebuilt happens once, before the pages that embed it
+    executions: List[Job] = []
+    executor = Executor(config.cache_dir, config.reexecute)
+    if config.execute:
+        for request in targets.executions:
+            execution = None
+            for page in targets.pages_embedding(request):
+                job = pages.get(page.input_file)
+                if job is None:
+                    continue
+                if execution is None:
+                    target = BuildTarget.from_paths(BuildTargetType.EXECUTE, Path(os.path.relpath(request.source)))
+                    execution = Job(target, executor.output, partial(tuple, (request,)),
+                                    partial(outputs.__setitem__, request.key))
+                    executions.append(execution)
+                add_requirement(job, execution)
+                runs[page.input_file].append(request.key)
+
+    if config.jobs <= 1:
+        init_renderer(config, targets.sources)
+    scheduler = scheduler if scheduler is not None else build_scheduler(config)
+    scheduler.async_pool = executor
+    try:
+        failed = scheduler.run(executions + jobs, promote, stop)
+    finally:
+        executor.shutdown()
+    summary.deferred = [job.target for job in scheduler.deferred
+                        if job.target.node_type in (BuildTargetType.MARKDOWN, BuildTargetType.COPY)]
+    # Failures come back in the order jobs finished; report them in graph order, so they read the same for any --jobs
+    for job in sorted(failed, key=lambda job: (job.target.order, job.target.input_file)):
+        if job.target.output_dir is not None:
+            manifest.forget(job.target.output_path)
+        summary.errors.append((job.target.input_file, job.error))
+
+    if written_paths:
+        sync_files(written_paths)
+    manifest.save()
+    return summary
+
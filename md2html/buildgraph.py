@@ -1,14 +1,17 @@
 from dataclasses import dataclass, field
 from collections import defaultdict, deque
-from typing import List, Dict, Set, Tuple, Optional, Any
+from typing import List, Dict, Set, Tuple, Optional, Any, Iterable, Mapping, NamedTuple, Union, Callable, Deque
 from pathlib import Path
 from enum import Enum
 import argparse
 import sys
 import json
 import os
-from .config import Config
-from .markdown_preprocessing import get_markdown_dependencies, parse_markdown_metadata
+from .config import Config, DEFAULT_TEMPLATE
+from .execute import ExecutionRequest, SessionRequest
+from .markdown_preprocessing import LazyFrontmatter, MarkdownMetadata, get_markdown_dependencies, parse_markdown_metadata
+from .metadata_cache import MetadataCache
+from .source import SourceBuffer, SourceStore
 
 class BuildTargetType(Enum):
     MARKDOWN = 'markdown'
@@ -18,68 +21,389 @@ class BuildTargetType(Enum):
 # not handled currently:
 #     HTML = 'html'
 
-@dataclass
+class DependencyEdge(NamedTuple):
+    """An @include or @src reference: the file as written and its "key=value" options.
+    Edges are immutable so BuildTargets can share one instance between all the
+    pages that reference the same file with the same options."""
+    name: str
+    options: Tuple[str, ...] = ()
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {"name": self.name, "options": list(self.options)}
+
+def join_path(directory: str, name: str) -> str:
+    """str(Path(directory) / name), without building the Path"""
+    return name if directory == '.' else os.path.join(directory, name)
+
+@dataclass(slots=True)
 class BuildTarget:
+    """A node of the build graph, laid out to stay small on sites with 100k+ pages:
+    paths are stored as an interned directory string shared by all the files in
+    that directory plus the file name, and input_path/output_path build Paths on demand."""
     node_type: BuildTargetType
-    input_path: Path
-    output_path: Optional[Path] = None
-    dependencies: List[Dict[str, Any]] = field(default_factory=list)
-    frontmatter: Dict[str, Any] = field(default_factory=dict)
+    input_dir: str
+    input_name: str
+    output_dir: Optional[str] = None
+    output_name: Optional[str] = None
+    dependencies: Tuple[DependencyEdge, ...] = ()
+    frontmatter: Optional[Mapping[str, Any]] = None # dict or LazyFrontmatter, None if there is none
+    order: int = -1 # discovery order, set by BuildTargets.add_node
+
+    @classmethod
+    def from_paths(cls, node_type: BuildTargetType, input_path: Path, output_path: Optional[Path] = None) -> 'BuildTarget':
+        output_dir = sys.intern(str(output_path.parent)) if output_path else None
+        return cls(node_type, sys.intern(str(input_path.parent)), input_path.name,
+                   output_dir, output_path.name if output_path else None)
+
+    @property
+    def input_file(self) -> str:
+        return join_path(self.input_dir, self.input_name)
+
+    @property
+    def output_file(self) -> Optional[str]:
+        return join_path(self.output_dir, self.output_name) if self.output_name is not None else None
+
+    @property
+    def input_path(self) -> Path:
+        return Path(self.input_dir, self.input_name)
+
+    @property
+    def output_path(self) -> Optional[Path]:
+        return Path(self.output_dir, self.output_name) if self.output_name is not None else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The node as it appears in the JSON build graph"""
+        return {
+            "input": self.input_file,
+            "output": self.output_file,
+            "type": self.node_type.value,
+            "dependencies": [edge.as_dict() for edge in self.dependencies],
+            "frontmatter": dict(self.frontmatter) if self.frontmatter else {}
+        }
+
+    def to_json_line(self) -> str:
+        """The node as a line of the NDJSON build graph"""
+        return json.dumps(self.to_dict()) + '\n'
 @dataclass
 class WatchTargets:
-    watched_files: Set[Path] = field(default_factory=set)
+    watched_files: Set[str] = field(default_factory=set) # resolved paths
+    watched_dirs: Set[str] = field(default_factory=set) # resolved paths of the directories the scan walked
+    # Dependency keys of the watched files whose resolved path differs from their key,
+    # e.g. files under a symlinked directory, by resolved path
+    keys: Dict[str, Set[str]] = field(default_factory=dict)
     
     def add_watched_file(self, file_path: Path):
         """Add a file that should be monitored for changes"""
-        self.watched_files.add(file_path.resolve())
+        self.add_resolved_file(os.path.realpath(file_path), dependency_key(file_path))
+
+    def add_resolved_file(self, file_path: str, key: str):
+        """Add a file whose path is already resolved, e.g. by the directory walk, with its dependency key"""
+        self.watched_files.add(file_path)
+        if key != file_path:
+            self.keys.setdefault(file_path, set()).add(key)
+
+    def dependency_keys(self, paths: Set[str]) -> Set[str]:
+        """The dependency keys of resolved paths, such as those of file events"""
+        keys = set(paths)
+        for path in paths:
+            keys.update(self.keys.get(path, ()))
+        return keys
+
+    def add_walked_dir(self, dir_path: str):
+        """Add a resolved directory the scan listed, so that files created in it are seen
+        even while it holds no targets"""
+        self.watched_dirs.add(dir_path)
     
     def should_watch_file(self, file_path: Path) -> bool:
         """Check if a specific file should trigger a rebuild"""
-        return file_path.resolve() in self.watched_files
+        return os.path.realpath(file_path) in self.watched_files
     
     def get_watch_dirs(self) -> Set[Path]:
         """Get the set of directories that watchdog should monitor"""
-        watch_dirs = set()
+        watch_dirs = {Path(dir_path) for dir_path in self.watched_dirs}
         for file_path in self.watched_files:
-            watch_dirs.add(file_path.parent)
+            watch_dirs.add(Path(os.path.dirname(file_path)))
         return watch_dirs
 
+# Number of markdown files handed to a metadata worker at a time when --jobs > 1
+METADATA_BATCH_SIZE = 64
+
+def load_markdown_metadata(path: Path, sources: Optional[SourceStore] = None,
+                           lazy_frontmatter: bool = False) -> Tuple[MarkdownMetadata, Tuple[int, int], str]:
+    """Parse a markdown file, returning its metadata along with the fingerprint and
+    content hash the metadata cache needs. The file is read once, through sources
+    if given so the render stage can reuse the buffer."""
+    source = sources.read(path) if sources else SourceBuffer.read(path)
+    return parse_markdown_metadata(path, source, lazy_frontmatter), source.fingerprint, source.digest
+
+def load_markdown_metadata_batch(paths: List[Path]) -> List[Tuple[Optional[Tuple[MarkdownMetadata, Tuple[int, int], str]],
+                                                                 Optional[SourceBuffer], Optional[str]]]:
+    """Worker entry point for parallel scans: returns (loaded metadata, source buffer, error)
+    per path, in order. The buffers go back to the main process with the metadata, so the
+    render stage doesn't read the files again."""
+    results = []
+    for path in paths:
+        sources = SourceStore()
+        try:
+            loaded = load_markdown_metadata(path, sources)
+            results.append((loaded, sources.release(path), None))
+        except Exception as e:
+            results.append((None, None, str(e)))
+    return results
+
+def dependency_key(path: Union[str, Path]) -> str:
+    """Absolute, lexically normalised path used as a key in the reverse dependency index.
+    Unlike resolve() this costs no syscalls, so it is cheap enough to apply to every
+    node during the scan and to every changed path passed to affected_targets()."""
+    return os.path.normpath(os.path.abspath(path))
+
 @dataclass
 class BuildTargets:
-    nodes: Dict[Path, BuildTarget] = field(default_factory=dict)
+    nodes: Dict[str, BuildTarget] = field(default_factory=dict) # keyed by input_file
     watch_targets: WatchTargets = field(default_factory=WatchTargets)
+    config: Optional[Config] = None # used to resolve frontmatter templates for the dependency index
+    jobs: int = 1
+    metadata_cache: Optional[MetadataCache] = None
+    sources: SourceStore = field(default_factory=SourceStore) # files read during this build
+
+    # Parallel scan state: markdown nodes waiting for a batch, submitted batches in discovery order,
+    # and the input_file of every node whose metadata hasn't been applied yet
+    pending_metadata: List[BuildTarget] = field(default_factory=list)
+    metadata_batches: Deque[Tuple[List[BuildTarget], Any]] = field(default_factory=deque)
+    metadata_pool: Optional[Any] = None # concurrent.futures.ProcessPoolExecutor, imported on first use
+    awaiting_metadata: Set[str] = field(default_factory=set)
+
+    # Called with each node in discovery order as soon as its metadata has been applied,
+    # e.g. to stream the graph while the scan is still running
+    on_node_ready: Optional[Callable[[BuildTarget], None]] = None
+    unreported_nodes: Deque[BuildTarget] = field(default_factory=deque)
+
+    # Reverse dependency index: dependency file (@include, @src or template) -> files that directly depend on it.
+    # Dependents are either nodes or @included markdown files that are not nodes
+    # themselves (e.g. _partial.md), which is how transitive @include chains are followed.
+    node_keys: Dict[str, str] = field(default_factory=dict)  # dependency_key -> key in nodes
+    dependents: Dict[str, Set[str]] = field(default_factory=lambda: defaultdict(set))
+    unindexed_includes: List[str] = field(default_factory=list)
+    indexed_includes: Set[str] = field(default_factory=set)
+    template_paths: Dict[str, List[str]] = field(default_factory=dict) # template name -> template_keys()
+    # Runs of @src(file, run=true) targets, and sessions of files with @src_begin(run=true) blocks
+    # -> files whose directives request them, for --execute builds
+    executions: Dict[Union[ExecutionRequest, SessionRequest], Set[str]] = field(default_factory=lambda: defaultdict(set))
+    # Interning table for dependency edges, so pages that reference the same file share one edge
+    edges: Dict[DependencyEdge, DependencyEdge] = field(default_factory=dict)
 
     def node_exists(self, path: Path) -> bool:
-        return path in self.nodes
+        return str(path) in self.nodes
+    def get_node(self, path: Path) -> Optional[BuildTarget]:
+        return self.nodes.get(str(path))
     def add_node(self, node: BuildTarget):
-        if self.node_exists(node.input_path):
-            print(f"Error: Node for {node.input_path} already exists in build targets", file=sys.stderr)
+        key = node.input_file
+        if key in self.nodes:
+            print(f"Error: Node for {key} already exists in build targets", file=sys.stderr)
             sys.exit(1)
         
         # Parse metadata for markdown files
-        if node.node_type == BuildTargetType.MARKDOWN and node.input_path.suffix.lower() == '.md':
-            try:
-                metadata = parse_markdown_metadata(node.input_path)
-                node.dependencies = metadata.dependencies
-                node.frontmatter = metadata.yaml_frontmatter
-            except Exception as e:
-                print(f"Warning: Could not parse metadata from {node.input_path}: {e}", file=sys.stderr)
+        if node.node_type == BuildTargetType.MARKDOWN and node.input_name.lower().endswith('.md'):
+            if self.jobs > 1:
+                cached = self.metadata_cache.lookup(node.input_path, self.sources) if self.metadata_cache else None
+                if cached is not None:
+                    self.apply_metadata(node, cached)
+                else:
+                    self.pending_metadata.append(node)
+                    self.awaiting_metadata.add(key)
+                    if len(self.pending_metadata) >= METADATA_BATCH_SIZE:
+                        self.submit_pending_metadata()
+            else:
+                metadata = self.load_metadata(node.input_path)
+                if metadata is not None:
+                    self.apply_metadata(node, metadata)
         
-        self.nodes[node.input_path] = node
-    def get_json_str(self) -> str:
+        node.order = len(self.nodes)
+        # Interned, so the copy index_dependencies makes for the reverse index is the same string
+        self.node_keys[sys.intern(dependency_key(key))] = key
+        self.nodes[key] = node
+        
+        if self.on_node_ready:
+            self.unreported_nodes.append(node)
+            if self.metadata_batches:
+                self.apply_metadata_batches(wait=False)
+            self.report_ready_nodes()
+    def load_metadata(self, path: Path) -> Optional[MarkdownMetadata]:
+        """Parse a markdown file through the metadata cache. Prints a warning and
+        returns None if the file can't be parsed."""
+        if self.metadata_cache:
+            cached = self.metadata_cache.lookup(path, self.sources)
+            if cached is not None:
+                return cached
+        try:
+            # Serial scans defer YAML parsing until the front matter is used. Pool workers
+            # parse eagerly instead, so that the work stays off the main process.
+            loaded = load_markdown_metadata(path, self.sources, lazy_frontmatter=True)
+        except Exception as e:
+            print(f"Warning: Could not parse metadata from {path}: {e}", file=sys.stderr)
+            return None
+        self.store_loaded_metadata(path, loaded)
+        return loaded[0]
+    def store_loaded_metadata(self, path: Path, loaded: Tuple[MarkdownMetadata, Tuple[int, int], str]):
+        if self.metadata_cache:
+            metadata, fingerprint, digest = loaded
+            self.metadata_cache.store(path, fingerprint, digest, metadata)
+    def apply_metadata(self, node: BuildTarget, metadata: MarkdownMetadata):
+        node.dependencies = tuple(self.intern_edge(dependency["name"], dependency["options"])
+                                  for dependency in metadata.dependencies)
+        frontmatter = metadata.yaml_frontmatter
+        # Unparsed lazy front matter is kept as is: testing it for emptiness would parse it
+        if isinstance(frontmatter, LazyFrontmatter) or frontmatter:
+            node.frontmatter = frontmatter
+        self.index_dependencies(node.input_path, metadata)
+    def intern_edge(self, name: str, options: Iterable[str]) -> DependencyEdge:
+        edge = DependencyEdge(name, tuple(options))
+        return self.edges.setdefault(edge, edge)
+    def index_dependencies(self, path: Path, metadata: MarkdownMetadata):
+        """Record reverse edges from each @include/@src target and the frontmatter
+        template to the file that references it"""
+        source = sys.intern(dependency_key(path))
+        source_dir = os.path.dirname(source)
+        for directive in metadata.directives:
+            if directive.directive_type == 'src_begin':
+                if directive.options.get('run') is True:
+                    self.executions[SessionRequest(source)].add(source)
+                continue
+            dependency = dependency_key(os.path.join(source_dir, directive.file_path))
+            if dependency not in self.dependents:
+                # First reference to this file: resolving it for the watch list costs syscalls
+                self.watch_targets.add_watched_file(dependency)
+            self.dependents[dependency].add(source)
+            if directive.directive_type == 'src' and directive.options.get('run') is True:
+                self.executions[ExecutionRequest.from_options(dependency, directive.options)].add(source)
+            if directive.directive_type == 'include' and dependency.lower().endswith('.md'):
+                self.unindexed_includes.append(dependency)
+        template = metadata.template
+        if template is None:
+            template = DEFAULT_TEMPLATE
+        if self.config and isinstance(template, str):
+            for template_path in self.template_keys(template):
+                self.dependents[template_path].add(source)
+    def template_keys(self, template: str) -> List[str]:
+        """Dependency keys of a template name at every search location. All of them are
+        dependencies: creating ./templates/x.html can shadow the bundled one, so it
+        changes the output as well."""
+        keys = self.template_paths.get(template)
+        if keys is None:
+            keys = [dependency_key(templates_dir / template) for templates_dir in self.config.get_templates_search_paths()]
+            for key in keys:
+                self.watch_targets.add_watched_file(key)
+            self.template_paths[template] = keys
+        return keys
+    def index_included_files(self):
+        """Follow @include chains through markdown files that aren't build targets
+        themselves, so edits to nested partials reach the pages that use them."""
+        while self.unindexed_includes:
+            include = self.unindexed_includes.pop()
+            if include in self.node_keys or include in self.indexed_includes:
+                continue
+            self.indexed_includes.add(include)
+            if not os.path.isfile(include):
+                continue
+            metadata = self.load_metadata(Path(include))
+            if metadata is not None:
+                self.index_dependencies(include, metadata)
+    def refresh(self, changed_paths: Iterable[str]):
+        """Parse changed markdown nodes and partials again, for a watch mode rebuild.
+        Reverse edges the files no longer have are kept: they only cost a spare rebuild."""
+        self.sources = SourceStore()
+        for key in map(dependency_key, changed_paths):
+            if key in self.node_keys:
+                node = self.nodes[self.node_keys[key]]
+                if node.node_type != BuildTargetType.MARKDOWN:
+                    continue
+                metadata = self.load_metadata(node.input_path)
+                if metadata is not None:
+                    self.apply_metadata(node, metadata)
+            elif key in self.indexed_includes and os.path.isfile(key):
+                metadata = self.load_metadata(Path(key))
+                if metadata is not None:
+                    self.index_dependencies(key, metadata)
+        self.index_included_files()
+    def affected_targets(self, changed_paths: Iterable[Path]) -> List[BuildTarget]:
+        """Return the build targets that must be rebuilt if changed_paths changed, in
+        graph order. Walks the reverse index from the changed files only, so the cost
+        is proportional to the affected part of the graph rather than the site size."""
+        queue = deque({dependency_key(path) for path in changed_paths})
+        seen = set(queue)
+        affected = []
+        while queue:
+            key = queue.popleft()
+            if key in self.node_keys:
+                affected.append(self.nodes[self.node_keys[key]])
+            for dependent in self.dependents.get(key, ()):
+                if dependent not in seen:
+                    seen.add(dependent)
+                    queue.append(dependent)
+        affected.sort(key=lambda node: node.order)
+        return affected
+    def pages_embedding(self, execution: Union[ExecutionRequest, SessionRequest]) -> List[BuildTarget]:
+        """The pages that embed the output of an execution, directly or through
+        @included partials, in graph order"""
+        return self.affected_targets(self.executions.get(execution, ()))
+    def submit_pending_metadata(self):
+        """Hand the queued markdown nodes to the worker pool as one batch"""
+        if not self.pending_metadata:
+            return
+        if self.metadata_pool is None:
+            from concurrent.futures import ProcessPoolExecutor
+            self.metadata_pool = ProcessPoolExecutor(max_workers=self.jobs)
+        batch = self.pending_metadata
+        self.pending_metadata = []
+        future = self.metadata_pool.submit(load_markdown_metadata_batch, [node.input_path for node in batch])
+        self.metadata_batches.append((batch, future))
+    def apply_metadata_batches(self, wait: bool):
+        """Apply the metadata parsed by the worker pool. Batches are applied in discovery
+        order, so the graph (and any warnings) match a serial scan exactly; without wait,
+        this stops at the first batch that hasn't finished."""
+        while self.metadata_batches:
+            batch, future = self.metadata_batches[0]
+            if not wait and not future.done():
+                return
+            self.metadata_batches.popleft()
+            for node, (loaded, source, error) in zip(batch, future.result()):
+                self.awaiting_metadata.discard(node.input_file)
+                if error is not None:
+                    print(f"Warning: Could not parse metadata from {node.input_path}: {error}", file=sys.stderr)
+                else:
+                    self.store_loaded_metadata(node.input_path, loaded)
+                    self.apply_metadata(node, loaded[0])
+                    self.sources.add(source)
+    def report_ready_nodes(self):
+        """Pass nodes to on_node_ready in discovery order, up to the first one still waiting for metadata"""
+        while self.unreported_nodes and self.unreported_nodes[0].input_file not in self.awaiting_metadata:
+            self.on_node_ready(self.unreported_nodes.popleft())
+    def wait_for_metadata(self):
+        """Collect metadata parsed by the worker pool and finish the dependency index."""
+        self.submit_pending_metadata()
+        try:
+            self.apply_metadata_batches(wait=True)
+        finally:
+            self.metadata_batches.clear()
+            if self.metadata_pool is not None:
+                self.metadata_pool.shutdown()
+                self.metadata_pool = None
+        if self.on_node_ready:
+            self.report_ready_nodes()
+        self.index_included_files()
+    def get_json_str(self, nodes: Optional[Iterable[BuildTarget]] = None) -> str:
+        """Serialise the build graph, or only the given nodes (e.g. from affected_targets)"""
+        if nodes is None:
+            nodes = self.nodes.values()
         json_data = {
-            "nodes": [
-                {
-                    "input": str(node.input_path),
-                    "output": str(node.output_path) if node.output_path else None,
-                    "type": node.node_type.value,
-                    "dependencies": node.dependencies if node.dependencies else [],
-                    "frontmatter": node.frontmatter if node.frontmatter else {}
-                }
-                for node in self.nodes.values()
-            ]
+            "nodes": [node.to_dict() for node in nodes]
         }
         return json.dumps(json_data, indent=2)
+    def get_ndjson_str(self, nodes: Optional[Iterable[BuildTarget]] = None) -> str:
+        """Serialise the build graph, or only the given nodes, as one JSON node per line"""
+        if nodes is None:
+            nodes = self.nodes.values()
+        return ''.join(node.to_json_line() for node in nodes)
 
 
 """ 
@@ -94,6 +418,11 @@ def should_ignore_path(config: Config, file_path: Path) -> bool:
     if file_path.name.startswith('_') or file_path.name.startswith('.'):
         return True
     return False
+def list_directory(path: Path) -> List[os.DirEntry]:
+    """The entries of a directory, in the order the filesystem lists them (like Path.iterdir)"""
+    with os.scandir(path) as entries:
+        return list(entries)
+
 def handle_target(path: Path, config: Config, target_list: BuildTargets):
     if not path.exists():
         print(f"Error: Input file {path} does not exist.", file=sys.stderr)
@@ -108,21 +437,84 @@ def handle_target(path: Path, config: Config, target_list: BuildTargets):
             output_path = config.output_dir
 
         if path.suffix.lower() == '.md':
-            target_list.add_node(BuildTarget(BuildTargetType.MARKDOWN,path,output_path))
+            target_list.add_node(BuildTarget.from_paths(BuildTargetType.MARKDOWN,path,output_path))
             target_list.watch_targets.add_watched_file(path)
         else:
             if output_path.resolve() != path.resolve():
-                target_list.add_node(BuildTarget(BuildTargetType.COPY,path,output_path))
+                target_list.add_node(BuildTarget.from_paths(BuildTargetType.COPY,path,output_path))
                 target_list.watch_targets.add_watched_file(path)
     elif path.is_dir():
         if not config.recursive:
             print(f"Error: {path} is a directory, but recursive mode is not enabled. (Maybe try ./* instead of .)", file=sys.stderr)
             sys.exit(1)
-        if config.output_dir \
-            and path.resolve() == config.output_dir.resolve() \
-            and (config.base_input_path.resolve() in config.output_dir.resolve().parents):
-            return
-        
-        for item in path.iterdir():
-            if not should_ignore_path(config, item):
-                handle_target(item, config, target_list)
\ No newline at end of file
+        walk_directory(path, config, target_list)
+
+def walk_directory(path: Path, config: Config, target_list: BuildTargets):
+    """Add every file under the directory path to target_list, depth first in directory order.
+
+    Iterative, and built on os.scandir so the file type comes from the directory listing:
+    the walk costs one scandir per directory and no syscalls per file, except a realpath
+    for symlinks. The base and output directories are resolved once, and output paths
+    are built from the relative path components instead of resolving every file."""
+    base_root = config.base_input_path.resolve()
+    resolved = path.resolve()
+    if base_root != resolved and base_root not in resolved.parents:
+        print(f"Error: {path} is not under base input path {config.base_input_path}", file=sys.stderr)
+        sys.exit(1)
+
+    # The output directory is skipped when it is inside the input tree (`md2html -r . -o html`)
+    skipped_dir = None
+    copies_in_place = config.output_dir is None
+    if config.output_dir is not None:
+        output_root = config.output_dir.resolve()
+        if base_root in output_root.parents:
+            skipped_dir = str(output_root)
+        copies_in_place = output_root == base_root
+    if str(resolved) == skipped_dir:
+        return
+    output_dir = path if config.output_dir is None else config.output_dir / resolved.relative_to(base_root)
+
+    # One frame per directory being listed: (remaining entries, path, resolved path, dependency key,
+    # output path), with paths as interned strings that the nodes in the directory share.
+    # The resolved paths on the stack also stop symlinks that point back at an ancestor.
+    stack = [(iter(list_directory(path)), sys.intern(str(path)), str(resolved), dependency_key(path), sys.intern(str(output_dir)))]
+    ancestors = {str(resolved)}
+    target_list.watch_targets.add_walked_dir(str(resolved))
+    while stack:
+        entries, dir_path, dir_resolved, dir_key, dir_output = stack[-1]
+        entry = next(entries, None)
+        if entry is None:
+            stack.pop()
+            ancestors.discard(dir_resolved)
+            continue
+        name = entry.name
+        if should_ignore_path(config, Path(name)):
+            continue
+        try:
+            is_dir = entry.is_dir()
+            is_file = not is_dir and entry.is_file()
+            item_resolved = os.path.realpath(entry.path) if entry.is_symlink() else os.path.join(dir_resolved, name)
+        except OSError:
+            continue # removed since the directory was listed
+
+        if is_file:
+            if name.lower().endswith('.md'):
+                output_name = name[:-len('.md')] + '.html'
+                target_list.add_node(BuildTarget(BuildTargetType.MARKDOWN, dir_path, name, dir_output, output_name))
+                target_list.watch_targets.add_resolved_file(item_resolved, os.path.join(dir_key, name))
+            elif not copies_in_place:
+                target_list.add_node(BuildTarget(BuildTargetType.COPY, dir_path, name, dir_output, name))
+                target_list.watch_targets.add_resolved_file(item_resolved, os.path.join(dir_key, name))
+        elif is_dir:
+            if item_resolved == skipped_dir or item_resolved in ancestors:
+                continue
+            item = join_path(dir_path, name)
+            try:
+                listing = list_directory(item)
+            except OSError as e:
+                print(f"Warning: Could not list {item}: {e}", file=sys.stderr)
+                continue
+            ancestors.add(item_resolved)
+            target_list.watch_targets.add_walked_dir(item_resolved)
+            stack.append((iter(listing), sys.intern(item), item_resolved, os.path.join(dir_key, name),
+                          sys.intern(join_path(dir_output, name))))
@@ -0,0 +1,50 @@
+"""
+Client of the build daemon: `md2html --client ...` runs a command on a daemon
+started with `md2html --daemon` (see daemon.py), and prints what it prints.
+
+The client only needs the socket path from the arguments, so it imports nothing
+but the standard library and config.py: the build graph and render modules are
+only loaded by the daemon.
+"""
+
+from typing import List
+import json
+import os
+import socket
+import sys
+
+from .config import Config
+
+
+def send(connection: socket.socket, message: dict):
+    connection.sendall(json.dumps(message).encode() + b'\n')
+
+
+def run_client(config: Config, argv: List[str]) -> int:
+    """Run the command line on the daemon, printing what it prints. Returns its exit status."""
+    path = config.socket_path
+    if path is None:
+        print("Error: --client needs --socket when the cache is disabled", file=sys.stderr)
+        return 1
+    request = {'argv': [arg for arg in argv if arg != '--client'], 'cwd': os.getcwd()}
+    if config.affected is not None and ('-' in argv or '--affected=-' in argv):
+        # parse_args has already read the paths from stdin
+        request['stdin'] = ''.join(f"{changed}\n" for changed in config.affected)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        try:
+            connection.connect(str(path))
+        except OSError as e:
+            print(f"Error: No md2html daemon on {path} ({e}), start one with `md2html --daemon`", file=sys.stderr)
+            return 1
+        send(connection, request)
+        for line in connection.makefile('rb'):
+            message = json.loads(line)
+            if 'stdout' in message:
+                sys.stdout.write(message['stdout'])
+            elif 'stderr' in message:
+                sys.stderr.write(message['stderr'])
+            elif 'exit' in message:
+                sys.stdout.flush()
+                return message['exit']
+    print("Error: The daemon closed the connection", file=sys.stderr)
+    return 1
@@ -26,11 +26,26 @@ Options:
     -w, --watch                      Watch files for changes and rebuild
     -s, --serve                      Start development server (implies --watch)
     -p, --port PORT                  Server port (default: 8000)
-    -e, --execute                    Execute embedded code blocks
+    -e, --execute                    Run @src(file, run=true) sources and @src_begin(run=true) blocks, and embed their output
+    --reexecute                      With --execute, run every source again instead of using cached results
     -n, --no-overwrite              Don't overwrite existing files
     -v, --verbose                    Verbose output
     --d, --dry-run                    Dry run mode (output build DAG as JSON)
     --templates PATH                 Templates directory (default: ./templates, then bundle/templates)
+    -j, --jobs N                     Parse and build on N worker processes (0: one per CPU)
+    --cache-dir PATH                 Cache directory (default: ./.md2html-cache)
+    --no-cache                       Don't read or write the metadata, highlight, math and execution caches
+    --fsync                          Flush the files a build writes to disk at the end of the build
+    --link-assets                    Hardlink (or reflink) copied files into the output instead of copying them
+    --math BACKEND                   Convert LaTeX math to MathML (mathml, default) or KaTeX HTML (katex)
+    --affected PATH                  Only output the build targets affected by changes to PATH
+                                     (repeatable; '-' reads newline-separated paths from stdin)
+    --startup-profile                Print import and phase timings to stderr
+    --format FORMAT                  Build graph output format: json (default), or ndjson to
+                                     stream one node per line as soon as it is scanned
+    --daemon                         Keep build state in memory and serve commands from --client
+    --client                         Run the command on the daemon instead of in this process
+    --socket PATH                    Daemon socket (default: daemon.sock in the cache directory)
 
 Examples:
     md2html note.md                  # Creates note.html (overwrites)
@@ -39,8 +54,17 @@ Examples:
     md2html -r src -o html         # Creates html/file1.html, ...
     md2html -r src1 src2 -o html/         # Creates html/src1/file1.html, html/src2/file2.html
     md2html -r . -o _site --serve    # Build site and serve
+    git diff --name-only HEAD~ | md2html -r src -o html --affected -
+                                     # List targets affected by the last commit
+    md2html -r src --dry-run --format=ndjson | jq -c .output
+                                     # Stream the build graph
+    md2html --daemon &               # Start a daemon in the current directory, then
+    md2html --client -r src -o html  # build through it
 """)
 
+# Template for pages whose front matter doesn't name one
+DEFAULT_TEMPLATE = 'default.html'
+
 # Command line configuration for md2html
 @dataclass
 class Config:
@@ -60,10 +84,22 @@ class Config:
     serve: bool = False
     port: int = 8000
     execute: bool = False
+    reexecute: bool = False # run sources even if the execution cache has their result
     force_overwrite: bool = True
     verbose: bool = False
     dry_run: bool = False
     templates_dir: Optional[Path] = None  
+    jobs: int = 1 # number of worker processes used to parse markdown metadata and to build
+    cache_dir: Optional[Path] = None # None disables the persistent metadata, highlight, math and execution caches
+    affected: Optional[List[Path]] = None # changed paths to query with --affected, None when not querying
+    startup_profile: bool = False
+    output_format: str = 'json' # format of the --dry-run/--affected build graph: 'json' or 'ndjson'
+    math: str = 'mathml' # backend converting LaTeX math, see mathrender.BACKENDS
+    fsync: bool = False # flush written outputs to disk at the end of each build
+    link_assets: bool = False # hardlink or reflink files that are copied, where the filesystem allows
+    daemon: bool = False
+    client: bool = False
+    socket_path: Optional[Path] = None # Unix socket of the daemon, None if there is no cache directory to hold it
     def calculate_output_path(self, input_path: Path) -> Path:
         if not (self.base_input_path.resolve() in input_path.resolve().parents):
             print(f"Error: {input_path} is not under base input path {self.base_input_path}", file=sys.stderr)
@@ -79,6 +115,14 @@ class Config:
         
         return output_file
 
+    def output_root(self) -> Path:
+        """The directory outputs are written under, which also holds the build manifest"""
+        if self.output_dir is None:
+            return self.base_input_path
+        if self.single_file_mode and self.output_dir.suffix:
+            return self.output_dir.parent
+        return self.output_dir
+
     def find_template(self, template_name: str) -> Optional[Path]:
         """Find a template file, searching in order:
         1. User-specified templates directory
@@ -138,10 +182,23 @@ def parse_args(argv: List[str]) -> Tuple[Config, List[str]]:
     parser.add_argument('-s', '--serve', action='store_true', help="Start development server (implies --watch)")
     parser.add_argument('-p', '--port', type=int, default=8000, help="Server port (default: 8000)")
     parser.add_argument('-e', '--execute', action='store_true', help="Execute embedded code blocks")
+    parser.add_argument('--reexecute', action='store_true', help="With --execute, ignore cached run results")
     parser.add_argument('-n', '--no-overwrite', action='store_true', help="Don't overwrite existing files")
     parser.add_argument('-v', '--verbose', action='store_true', help="Verbose output")
     parser.add_argument('-d', '--dry-run', action='store_true', help="Dry run mode (output build DAG as JSON)")
     parser.add_argument('--templates', type=Path, help="Templates directory (default: ./templates, then bundle/templates)")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Parse and build on N worker processes (0: one per CPU)")
+    parser.add_argument('--cache-dir', type=Path, help="Cache directory (default: ./.md2html-cache)")
+    parser.add_argument('--no-cache', action='store_true', help="Don't read or write the metadata, highlight, math and execution caches")
+    parser.add_argument('--math', choices=['mathml', 'katex'], default='mathml', help="LaTeX math backend (default: mathml)")
+    parser.add_argument('--fsync', action='store_true', help="Flush written files to disk at the end of the build")
+    parser.add_argument('--link-assets', action='store_true', help="Hardlink or reflink copied files instead of copying them")
+    parser.add_argument('--affected', action='append', metavar='PATH', help="Only output the build targets affected by changes to PATH ('-' reads stdin)")
+    parser.add_argument('--startup-profile', action='store_true', help="Print import and phase timings to stderr")
+    parser.add_argument('--format', choices=['json', 'ndjson'], default='json', help="Build graph output format (default: json)")
+    parser.add_argument('--daemon', action='store_true', help="Keep build state in memory and serve commands from --client")
+    parser.add_argument('--client', action='store_true', help="Run the command on the daemon")
+    parser.add_argument('--socket', type=Path, help="Daemon socket (default: daemon.sock in the cache directory)")
     parser.add_argument('inputs', nargs='*', help="Input files or directories")  # Positional args
 
     args = parser.parse_args(argv)
@@ -159,9 +216,34 @@ def parse_args(argv: List[str]) -> Tuple[Config, List[str]]:
         config.watch = True
     config.port = args.port
     config.execute = args.execute
+    config.reexecute = args.reexecute
     config.force_overwrite = not args.no_overwrite
     config.verbose = args.verbose
     config.dry_run = args.dry_run
     config.templates_dir = args.templates
+    config.startup_profile = args.startup_profile
+    config.output_format = args.format
+    config.math = args.math
+    config.link_assets = args.link_assets
+    config.fsync = args.fsync
+    if args.jobs < 0:
+        print(f"Error: --jobs must be a non-negative integer, got {args.jobs}", file=sys.stderr)
+        sys.exit(1)
+    config.jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    if args.affected is not None:
+        config.affected = []
+        for changed in args.affected:
+            if changed == '-':
+                config.affected.extend(Path(line.strip()) for line in sys.stdin if line.strip())
+            else:
+                config.affected.append(Path(changed))
+    if not args.no_cache:
+        config.cache_dir = args.cache_dir if args.cache_dir else invoked_from / ".md2html-cache"
+    config.daemon = args.daemon
+    config.client = args.client
+    if args.socket:
+        config.socket_path = args.socket
+    elif config.cache_dir:
+        config.socket_path = config.cache_dir / "daemon.sock"
 
     return config, args.inputs  # args.inputs is the list of positional args
@@ -0,0 +1,71 @@
+"""
+Content-addressed text caches for rendered fragments, such as highlighted code
+blocks and converted math.
+
+Entries live in a subdirectory of the cache directory, one file per entry named
+by its key, which is a hash of everything the fragment depends on. Entries are
+never invalidated, only replaced by entries with new keys, and are written
+through a temporary file so that render workers can share a directory. A bounded
+in-memory map sits in front of the files.
+"""
+
+from typing import Dict, Optional
+from pathlib import Path
+import os
+import threading
+
+# Entries kept in memory by a ContentCache, on top of the files
+MEMORY_CACHE_ENTRIES = 4096
+
+
+class ContentCache:
+    """One kind of fragment. With no directory, only the in-memory map is used."""
+
+    def __init__(self, directory: Optional[Path]):
+        self.directory = directory
+        self.memory: Dict[str, str] = {}
+
+    def get(self, key: str) -> Optional[str]:
+        text = self.memory.get(key)
+        if text is None and self.directory is not None:
+            try:
+                text = self.entry_path(key).read_text(encoding='utf-8')
+            except (OSError, UnicodeDecodeError):
+                return None
+            self.remember(key, text)
+        return text
+
+    def put(self, key: str, text: str):
+        """Store an entry. Failing to write it only costs a miss next time."""
+        self.remember(key, text)
+        self.put_bytes(key, text.encode('utf-8'))
+
+    def get_bytes(self, key: str) -> Optional[bytes]:
+        """Read a binary entry, such as a file produced by a run. These bypass the in-memory map."""
+        if self.directory is None:
+            return None
+        try:
+            return self.entry_path(key).read_bytes()
+        except OSError:
+            return None
+
+    def put_bytes(self, key: str, data: bytes):
+        if self.directory is None:
+            return
+        path = self.entry_path(key)
+        # Unique per thread as well as per process, as executions store entries from pool threads
+        temp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path.write_bytes(data)
+            os.replace(temp_path, path)
+        except OSError:
+            pass
+
+    def remember(self, key: str, text: str):
+        if len(self.memory) >= MEMORY_CACHE_ENTRIES:
+            self.memory.clear()
+        self.memory[key] = text
+
+    def entry_path(self, key: str) -> Path:
+        return self.directory / key[:2] / key
@@ -0,0 +1,217 @@
+"""
+Build daemon: `md2html --daemon` keeps build state in memory between commands,
+and `md2html --client ...` runs a command on it.
+
+The client (client.py) sends its arguments over the daemon's Unix socket, by default
+`daemon.sock` in the cache directory, as one JSON line. The daemon runs the
+command in its own process, and streams back what it prints as JSON lines,
+{"stdout": text} or {"stderr": text}, followed by {"exit": status}.
+
+For each distinct command line, ignoring the options that only change what is
+printed, the daemon keeps a session: the Config, the scanned BuildTargets, the
+metadata cache, a watcher of the tree, and the build scheduler, whose render
+workers stay up between commands with --jobs > 1. Repeating a command only applies the
+file events that arrived since the last one, as watch mode does, and renders on
+the renderer the previous build left warm. The build itself still checks every
+target against the build manifest, so an edit is never missed by a build, even
+if its event hasn't arrived yet.
+
+Commands run one at a time, from the directory the daemon was started in.
+"""
+
+from dataclasses import replace
+from contextlib import redirect_stderr, redirect_stdout
+from typing import Dict, List
+from pathlib import Path
+import io
+import json
+import os
+import signal
+import socket
+import sys
+
+from .buildgraph import BuildTargets
+from .client import send
+from .config import Config, parse_args
+
+# Seconds a client has to send its request once connected; commands run one at a
+# time, so a client that connects and sends nothing would otherwise block the daemon
+REQUEST_TIMEOUT = 2
+
+# Options that only change what a command prints: they are taken from each
+# command, and commands that differ only in them share a session
+REQUEST_FIELDS = {'affected': None, 'dry_run': False, 'output_format': 'json', 'verbose': False,
+                  'startup_profile': False, 'client': False, 'socket_path': None}
+
+
+class StreamWriter(io.TextIOBase):
+    """A text stream that forwards what is written to the client, as {name: text} messages"""
+
+    def __init__(self, connection: socket.socket, name: str):
+        self.connection = connection
+        self.name = name
+        self.connected = True
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        if text and self.connected:
+            try:
+                send(self.connection, {self.name: text})
+            except OSError:
+                self.connected = False # the client went away; the command still finishes
+        return len(text)
+
+
+class Session:
+    """The warm state of one command line"""
+
+    def __init__(self, config: Config, args: List[Path]):
+        from .build import build_scheduler
+        from .metadata_cache import MetadataCache
+        self.config = config
+        self.args = args
+        self.metadata_cache = MetadataCache.open(config.cache_dir)
+        self.targets = self.scan()
+        self.scheduler = build_scheduler(config, keep_pools=True)
+        self.watcher = None
+        try:
+            from .watch import TreeWatcher
+            self.watcher = TreeWatcher(self.targets)
+        except ImportError:
+            print("Warning: watchdog is not installed, the daemon scans the tree on every command", file=sys.stderr)
+
+    def scan(self) -> BuildTargets:
+        from .md2html import scan
+        return scan(self.config, self.args, self.metadata_cache)
+
+    def refresh(self):
+        """Apply the file events since the last command to the build graph"""
+        if self.watcher is None:
+            self.targets = self.scan()
+            return
+        from .watch import update_targets
+        changed, unknown = self.watcher.collector.take()
+        self.targets, _ = update_targets(self.targets, self.config, changed, unknown, self.scan)
+        self.watcher.update(self.targets)
+
+    def close(self):
+        self.scheduler.shutdown()
+        if self.watcher is not None:
+            self.watcher.stop()
+        if self.metadata_cache:
+            self.metadata_cache.close()
+
+
+class Daemon:
+    def __init__(self, root: Path):
+        self.root = root
+        self.sessions: Dict[str, Session] = {}
+        self.terminated = False
+
+    def terminate(self, signum, frame):
+        """SIGTERM handler: stops the daemon through the cleanup in run_daemon, like Ctrl-C"""
+        self.terminated = True
+        sys.exit(0)
+
+    def run_command(self, argv: List[str], cwd: str) -> int:
+        """Run a command line, with stdio already redirected. Returns the exit status."""
+        from .md2html import input_paths, output
+        if os.path.realpath(cwd) != os.path.realpath(self.root):
+            print(f"Error: The daemon runs commands from {self.root}, not {cwd}", file=sys.stderr)
+            return 1
+        config, args = parse_args(argv)
+        if config.daemon or config.watch:
+            print("Error: --daemon, --watch and --serve can't run on the daemon", file=sys.stderr)
+            return 1
+        key = repr((args, replace(config, **REQUEST_FIELDS)))
+        session = self.sessions.get(key)
+        if session is None:
+            session = Session(config, input_paths(config, args))
+            self.sessions[key] = session
+        else:
+            for name in REQUEST_FIELDS:
+                setattr(session.config, name, getattr(config, name))
+            session.refresh()
+        # Commit metadata parsed by this command now, the daemon may be killed before closing the cache
+        if session.metadata_cache:
+            session.metadata_cache.commit()
+        return output(session.config, session.targets, scheduler=session.scheduler)
+
+    def handle(self, connection: socket.socket):
+        connection.settimeout(REQUEST_TIMEOUT)
+        request = json.loads(connection.makefile('rb').readline())
+        connection.settimeout(None)
+        stdin = sys.stdin
+        stopped = None
+        with redirect_stdout(StreamWriter(connection, 'stdout')), redirect_stderr(StreamWriter(connection, 'stderr')):
+            sys.stdin = io.StringIO(request.get('stdin') or '')
+            try:
+                status = self.run_command(request['argv'], request['cwd'])
+            except SystemExit as e:
+                # Raised by parse_args and output to end the command, or by terminate() to end the daemon
+                if self.terminated:
+                    print("Error: The daemon was stopped during the command", file=sys.stderr)
+                    status, stopped = 1, e
+                else:
+                    status = e.code if isinstance(e.code, int) else 1
+            except Exception as e:
+                print(f"Error: {type(e).__name__}: {e}", file=sys.stderr)
+                status = 1
+            finally:
+                sys.stdin = stdin
+        try:
+            send(connection, {'exit': status})
+        finally:
+            if stopped is not None:
+                raise stopped
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+        self.sessions.clear()
+
+
+def daemon_running(path: Path) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(str(path))
+            return True
+        except OSError:
+            return False
+
+
+def run_daemon(config: Config) -> int:
+    """Serve commands on config.socket_path until interrupted. Returns the exit status."""
+    path = config.socket_path
+    if path is None:
+        print("Error: --daemon needs --socket when the cache is disabled", file=sys.stderr)
+        return 1
+    if path.exists():
+        if daemon_running(path):
+            print(f"Error: A daemon is already listening on {path}", file=sys.stderr)
+            return 1
+        path.unlink()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(str(path))
+    listener.listen()
+    daemon = Daemon(config.invoked_from)
+    signal.signal(signal.SIGTERM, daemon.terminate)
+    print(f"md2html daemon listening on {path} (Ctrl-C to stop)", file=sys.stderr, flush=True)
+    try:
+        while True:
+            connection, _ = listener.accept()
+            with connection:
+                try:
+                    daemon.handle(connection)
+                except (OSError, ValueError, KeyError) as e:
+                    print(f"Warning: Dropped a client request: {e}", file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+        listener.close()
+        path.unlink(missing_ok=True)
+    return 0
@@ -0,0 +1,556 @@
+"""
+Running @src(file, run=true) sources for --execute builds.
+
+A source is run with the interpreter for its file extension, or compiled and
+then run, in its own directory, and its standard output is embedded in the pages
+below the listing. Directive options change how it runs:
+- args: space separated command line arguments,
+- artifacts: space separated files the run produces, relative to the source,
+- timeout: seconds the run may take.
+
+Runs are asyncio subprocesses, so the sources of a build run concurrently, within
+a global limit and separate limits for the compile and run steps. Each step has a
+timeout and a cap on the output it keeps.
+
+Runs are cached under `execute/` in the cache directory (see content_cache.py),
+keyed by a hash of the source contents, these options, the command line and a
+fingerprint of the interpreter binary. Only successful runs are cached, so a run
+that failed, e.g. on something outside the source, runs again on the next build.
+A cached result holds the stdout and stderr, and the contents of the artifacts,
+which are restored if they are missing. --reexecute runs every source again, and
+refreshes the cache.
+
+Inline @src_begin(run=true) ... @src_end blocks of a file run as one session: in
+order, in a shared namespace, in a single warm Python worker that takes the blocks
+over a pipe. Each block's result is cached under a key chained from the keys of
+the blocks before it, so a file whose first edited block is block k serves blocks
+before k from the cache and runs only k and the blocks after it. The worker gets
+the state the earlier blocks left from a snapshot of their namespace, cached with
+the result of block k - 1; names that can't be pickled, such as functions defined
+in the session, leave no snapshot, and the earlier blocks are then run again, with
+their outputs discarded. Side effects outside the namespace, like written files,
+are never restored.
+"""
+
+from dataclasses import asdict, dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, NamedTuple, Optional, Sequence, Tuple, Union
+from pathlib import Path
+import json
+import os
+import sys
+
+from .content_cache import ContentCache
+from .markdown_preprocessing import MarkdownDirective, scan_directives
+from .source import content_hash, file_hash
+
+# Command that runs a source file, by extension. The file name is appended to it.
+RUNNERS: Dict[str, List[str]] = {
+    '.py': [sys.executable],
+    '.sh': ['sh'],
+    '.js': ['node'],
+    '.rb': ['ruby'],
+    '.rkt': ['racket'],
+}
+# Command that compiles a source file into {binary}, by extension. The binary is then run.
+COMPILERS: Dict[str, List[str]] = {
+    '.c': ['cc', '-O2', '-o', '{binary}', '{source}'],
+    '.cpp': ['c++', '-std=c++17', '-O2', '-o', '{binary}', '{source}'],
+    '.rs': ['rustc', '-O', '-o', '{binary}', '{source}'],
+}
+
+EXECUTE_DIRNAME = 'execute'
+# Subprocesses running at once: in total, and per step. Compiles are CPU bound, so
+# they are limited to the CPU count, while runs of notes snippets mostly wait.
+EXECUTE_CONCURRENCY = 16
+COMPILE_CONCURRENCY = os.cpu_count() or 1
+RUN_CONCURRENCY = 16
+COMPILE_TIMEOUT = 120 # seconds
+RUN_TIMEOUT = 60 # seconds, unless the directive has a timeout option
+# Bytes of stdout and of stderr kept per step; the rest is read and dropped
+OUTPUT_LIMIT = 1024 * 1024
+# How much of the error output of a failed run to quote in the error
+ERROR_OUTPUT_LIMIT = 500
+# Largest pickled namespace a session block leaves in the cache for the blocks after it
+SNAPSHOT_LIMIT = 1024 * 1024
+# Languages of the blocks a session can run
+SESSION_LANGUAGES = ('python', 'py')
+
+
+class ExecutionError(Exception):
+    """Raised when a source can't be run, or exits with a non-zero status"""
+
+
+class ExecutionRequest(NamedTuple):
+    """One way of running a source: pages that run the same source with the same
+    options share a single run."""
+    source: str # normalised absolute path
+    args: Tuple[str, ...] = ()
+    artifacts: Tuple[str, ...] = ()
+    timeout: Optional[int] = None # seconds for the run step, RUN_TIMEOUT if None
+
+    @classmethod
+    def from_options(cls, source: str, options: Mapping[str, Any]) -> 'ExecutionRequest':
+        timeout = options.get('timeout')
+        return cls(os.path.normpath(os.path.abspath(source)),
+                   tuple(str(options.get('args', '')).split()),
+                   tuple(str(options.get('artifacts', '')).split()),
+                   timeout if isinstance(timeout, int) and timeout > 0 else None)
+
+    @property
+    def key(self) -> str:
+        """String form, used to pass outputs to render workers"""
+        return json.dumps(self)
+
+
+class SessionRequest(NamedTuple):
+    """The run of the @src_begin(run=true) blocks of a file, shared by the pages
+    that include it. Its output is the list of the blocks' outputs."""
+    source: str # normalised absolute path of the file holding the blocks
+
+    @property
+    def key(self) -> str:
+        return json.dumps(['session', self.source])
+
+
+def session_blocks(directives: Sequence[MarkdownDirective]) -> List[MarkdownDirective]:
+    """The blocks of a file that run in its session, in order"""
+    return [directive for directive in directives
+            if directive.directive_type == 'src_begin' and directive.options.get('run') is True]
+
+
+@dataclass
+class ExecutionResult:
+    stdout: str
+    stderr: str
+    returncode: int
+    artifacts: Dict[str, str] = field(default_factory=dict) # artifact -> content hash
+    step: str = 'run' # the step that produced the result: 'compile' if compiling failed
+    cached: bool = False
+
+    def output(self) -> str:
+        """The standard output of a successful run"""
+        if self.returncode != 0:
+            errors = self.stderr.strip()[-ERROR_OUTPUT_LIMIT:]
+            failed = "compilation exited" if self.step == 'compile' else "exited"
+            raise ExecutionError(f"{failed} with status {self.returncode}" + (f": {errors}" if errors else ""))
+        return self.stdout
+
+
+class Commands(NamedTuple):
+    compile: Optional[List[str]] # with a {binary} placeholder, None for interpreted languages
+    run: List[str] # with a {binary} placeholder for compiled languages
+
+    @property
+    def toolchain(self) -> str:
+        """The program whose version the result depends on"""
+        return (self.compile or self.run)[0]
+
+
+def commands_for(request: ExecutionRequest) -> Commands:
+    path = Path(request.source)
+    suffix = path.suffix.lower()
+    if suffix in COMPILERS:
+        compile_command = [part.replace('{source}', path.name) for part in COMPILERS[suffix]]
+        return Commands(compile_command, ['{binary}', *request.args])
+    if suffix in RUNNERS:
+        return Commands(None, RUNNERS[suffix] + [path.name, *request.args])
+    raise ExecutionError(f"don't know how to run {path.suffix or 'extensionless'} files")
+
+
+async def read_capped(stream, limit: int) -> str:
+    """Read a stream to the end, keeping only its first limit bytes"""
+    kept = bytearray()
+    dropped = 0
+    while chunk := await stream.read(64 * 1024):
+        room = limit - len(kept)
+        kept += chunk[:room]
+        dropped += max(0, len(chunk) - room)
+    text = kept.decode('utf-8', errors='replace')
+    if dropped:
+        text += f"\n[{dropped} more bytes of output dropped]\n"
+    return text
+
+
+async def run_process(command: List[str], cwd: Path, timeout: float) -> Tuple[str, str, int]:
+    """Run a command, returning its capped stdout and stderr and its exit status"""
+    import asyncio
+    try:
+        process = await asyncio.create_subprocess_exec(*command, cwd=cwd, stdin=asyncio.subprocess.DEVNULL,
+                                                       stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    except FileNotFoundError:
+        raise ExecutionError(f"{command[0]} not found")
+    try:
+        stdout, stderr = await asyncio.wait_for(asyncio.gather(
+            read_capped(process.stdout, OUTPUT_LIMIT), read_capped(process.stderr, OUTPUT_LIMIT)), timeout)
+        returncode = await asyncio.wait_for(process.wait(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise ExecutionError(f"timed out after {timeout} s")
+    except asyncio.CancelledError:
+        process.kill()
+        await process.wait()
+        raise
+    return stdout, stderr, returncode
+
+
+@dataclass
+class BlockResult:
+    """What running one session block produced"""
+    stdout: str
+    stderr: str
+    error: Optional[str] = None # the traceback, if the block raised
+    state: Optional[str] = None # base64 pickled snapshot of the namespace after the block, if it pickles
+
+
+# Runs session blocks sent as JSON lines on stdin, replying with a BlockResult per line.
+# The replies go to a copy of the original stdout; file descriptor 1 is pointed at
+# stderr so that subprocesses of the blocks can't write into them.
+SESSION_WORKER = """
+import base64, contextlib, importlib, io, json, os, pickle, sys, traceback, types
+output_limit, snapshot_limit = int(sys.argv[1]), int(sys.argv[2])
+replies = os.fdopen(os.dup(1), 'w')
+os.dup2(2, 1)
+namespace = {'__name__': '__main__', '__builtins__': __builtins__}
+
+def snapshot():
+    modules, values = {}, {}
+    for name, value in namespace.items():
+        if name.startswith('__'):
+            continue
+        if isinstance(value, types.ModuleType):
+            modules[name] = value.__name__
+        else:
+            values[name] = value
+    try:
+        data = pickle.dumps((modules, values))
+    except Exception:
+        return None
+    return base64.b64encode(data).decode() if len(data) <= snapshot_limit else None
+
+def restore(state):
+    modules, values = pickle.loads(base64.b64decode(state))
+    for name, module in modules.items():
+        namespace[name] = importlib.import_module(module)
+    namespace.update(values)
+
+def capped(text):
+    return text if len(text) <= output_limit else text[:output_limit] + f"\\n[{len(text) - output_limit} more characters of output dropped]\\n"
+
+for line in sys.stdin:
+    message = json.loads(line)
+    stdout, stderr = io.StringIO(), io.StringIO()
+    error = None
+    try:
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+            if 'restore' in message:
+                restore(message['restore'])
+            else:
+                exec(compile(message['code'], message['filename'], 'exec'), namespace)
+    except BaseException as e:
+        error = ''.join(traceback.format_exception(type(e), e, e.__traceback__.tb_next))
+    state = snapshot() if error is None and 'code' in message else None
+    replies.write(json.dumps({'stdout': capped(stdout.getvalue()), 'stderr': capped(stderr.getvalue()),
+                              'error': error, 'state': state}) + '\\n')
+    replies.flush()
+"""
+
+
+class Session:
+    """A running session worker"""
+
+    def __init__(self, process: Any):
+        self.process = process
+
+    @classmethod
+    async def start(cls, cwd: Path) -> 'Session':
+        import asyncio
+        process = await asyncio.create_subprocess_exec(
+            RUNNERS['.py'][0], '-c', SESSION_WORKER, str(OUTPUT_LIMIT), str(SNAPSHOT_LIMIT), cwd=cwd,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+            # A reply holds a block's escaped output and a snapshot on one line
+            limit=8 * OUTPUT_LIMIT + 2 * SNAPSHOT_LIMIT)
+        return cls(process)
+
+    async def send(self, message: Dict[str, Any], timeout: float) -> BlockResult:
+        import asyncio
+        self.process.stdin.write(json.dumps(message).encode() + b'\n')
+        try:
+            await asyncio.wait_for(self.process.stdin.drain(), timeout)
+            reply = await asyncio.wait_for(self.process.stdout.readline(), timeout)
+        except asyncio.TimeoutError:
+            raise ExecutionError(f"timed out after {timeout} s")
+        except (ConnectionError, ValueError) as e:
+            raise ExecutionError(f"lost the session worker: {e}")
+        if not reply:
+            raise ExecutionError("the session worker exited")
+        return BlockResult(**json.loads(reply))
+
+    async def close(self):
+        import asyncio
+        self.process.stdin.close()
+        try:
+            await asyncio.wait_for(self.process.wait(), 1)
+        except asyncio.TimeoutError:
+            self.process.kill()
+            await self.process.wait()
+        except asyncio.CancelledError:
+            await self.kill()
+            raise
+
+    async def kill(self):
+        if self.process.returncode is None:
+            self.process.kill()
+        await self.process.wait()
+
+
+async def cancel_tasks():
+    """Cancel the other tasks on the running loop and wait for them to finish, so that
+    the subprocesses they run are killed and reaped, then close its async generators"""
+    import asyncio
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await asyncio.get_running_loop().shutdown_asyncgens()
+
+
+def block_timeout(block: MarkdownDirective) -> int:
+    timeout = block.options.get('timeout')
+    return timeout if isinstance(timeout, int) and timeout > 0 else RUN_TIMEOUT
+
+
+def block_message(source: str, block: MarkdownDirective) -> Dict[str, Any]:
+    # Leading newlines make tracebacks point at the block's lines in the file
+    return {'code': '\n' * block.line_number + block.code, 'filename': source}
+
+
+class Executor:
+    """Runs requests concurrently on an asyncio event loop in a background thread,
+    through the execution cache. Works as a pool for the build scheduler: submit()
+    takes a coroutine function, and returns a concurrent.futures.Future that is done
+    as soon as that run is, so pages waiting for it can render right away."""
+
+    def __init__(self, cache_dir: Optional[Path] = None, reexecute: bool = False):
+        self.cache = ContentCache(cache_dir / EXECUTE_DIRNAME if cache_dir is not None else None)
+        self.reexecute = reexecute
+        self.toolchains: Dict[str, str] = {} # program -> fingerprint
+        self.hits = 0
+        self.misses = 0
+        self.loop: Any = None # asyncio event loop, started on first submit
+        self.thread: Any = None
+        self.limits: Dict[str, Any] = {} # asyncio.Semaphore for 'total', 'compile' and 'run', created on the loop
+
+    def submit(self, func: Callable[..., Awaitable[Any]], *args) -> Any:
+        import asyncio
+        if self.loop is None:
+            import threading
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, name="md2html-execute", daemon=True)
+            self.thread.start()
+        return asyncio.run_coroutine_threadsafe(func(*args), self.loop)
+
+    def shutdown(self):
+        """Stop the loop. Runs still going, e.g. when the build is interrupted, are
+        cancelled first, which kills their subprocesses."""
+        if self.loop is not None:
+            import asyncio
+            asyncio.run_coroutine_threadsafe(cancel_tasks(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+
+    async def output(self, request: Union[ExecutionRequest, SessionRequest]) -> Union[str, List[str]]:
+        """The output of a request, for an EXECUTE job"""
+        if isinstance(request, SessionRequest):
+            return await self.run_session(request)
+        return (await self.run(request)).output()
+
+    async def run(self, request: ExecutionRequest) -> ExecutionResult:
+        commands = commands_for(request)
+        key = self.key(request, commands)
+        if not self.reexecute:
+            result = self.load(key, request)
+            if result is not None:
+                self.hits += 1
+                return result
+        self.misses += 1
+        result = await self.execute(request, commands)
+        if result.returncode == 0:
+            self.cache.put(key, json.dumps(asdict(result)))
+        return result
+
+    def key(self, request: ExecutionRequest, commands: Commands) -> str:
+        try:
+            source_hash = file_hash(Path(request.source))
+        except OSError as e:
+            raise ExecutionError(f"could not read {request.source}: {e}")
+        return content_hash(json.dumps([source_hash, request, commands, self.toolchain(commands.toolchain)]).encode())
+
+    def toolchain(self, program: str) -> str:
+        """Fingerprint of the compiler or interpreter binary: its resolved path, size and
+        mtime. This changes whenever the toolchain is upgraded, without running it to ask
+        its version."""
+        fingerprint = self.toolchains.get(program)
+        if fingerprint is None:
+            import shutil
+            found = shutil.which(program)
+            if found is None:
+                raise ExecutionError(f"{program} not found")
+            resolved = os.path.realpath(found)
+            st = os.stat(resolved)
+            fingerprint = f"{resolved}:{st.st_size}:{st.st_mtime_ns}"
+            self.toolchains[program] = fingerprint
+        return fingerprint
+
+    def limit(self, step: str) -> Tuple[Any, Any]:
+        """The semaphores a compile or run step holds: its own, and the global one"""
+        import asyncio
+        if not self.limits:
+            self.limits = {'total': asyncio.Semaphore(EXECUTE_CONCURRENCY),
+                           'compile': asyncio.Semaphore(COMPILE_CONCURRENCY),
+                           'run': asyncio.Semaphore(RUN_CONCURRENCY)}
+        return self.limits[step], self.limits['total']
+
+    async def step(self, step: str, command: List[str], cwd: Path, timeout: float) -> Tuple[str, str, int]:
+        """Run one compile or run step within the global and per-step concurrency limits"""
+        step_limit, total_limit = self.limit(step)
+        async with step_limit, total_limit:
+            return await run_process(command, cwd, timeout)
+
+    async def execute(self, request: ExecutionRequest, commands: Commands) -> ExecutionResult:
+        import tempfile
+        directory = Path(request.source).parent
+        with tempfile.TemporaryDirectory(prefix="md2html-execute-") as build_dir:
+            binary = os.path.join(build_dir, Path(request.source).stem)
+            if commands.compile is not None:
+                compile_command = [part.replace('{binary}', binary) for part in commands.compile]
+                stdout, stderr, returncode = await self.step('compile', compile_command, directory, COMPILE_TIMEOUT)
+                if returncode != 0:
+                    return ExecutionResult(stdout, stderr, returncode, step='compile')
+            run_command = [part.replace('{binary}', binary) for part in commands.run]
+            stdout, stderr, returncode = await self.step('run', run_command, directory, request.timeout or RUN_TIMEOUT)
+        result = ExecutionResult(stdout, stderr, returncode)
+        if result.returncode == 0:
+            for artifact in request.artifacts:
+                try:
+                    data = (directory / artifact).read_bytes()
+                except OSError:
+                    raise ExecutionError(f"artifact {artifact} was not produced")
+                digest = content_hash(data)
+                self.cache.put_bytes(digest, data)
+                result.artifacts[artifact] = digest
+        return result
+
+    def load(self, key: str, request: ExecutionRequest) -> Optional[ExecutionResult]:
+        """A cached result, with its artifacts restored. None if there is no usable entry."""
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        try:
+            result = ExecutionResult(**json.loads(entry))
+        except (ValueError, TypeError):
+            return None
+        directory = Path(request.source).parent
+        for artifact, digest in result.artifacts.items():
+            path = directory / artifact
+            try:
+                if path.exists() and file_hash(path) == digest:
+                    continue
+                data = self.cache.get_bytes(digest)
+                if data is None:
+                    return None
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(data)
+            except OSError:
+                return None
+        result.cached = True
+        return result
+
+    async def run_session(self, request: SessionRequest) -> List[str]:
+        """The outputs of the session blocks of a file, running only the blocks from
+        the first one without a cached result on"""
+        try:
+            text = Path(request.source).read_text(encoding='utf-8')
+        except (OSError, UnicodeDecodeError) as e:
+            raise ExecutionError(f"could not read {request.source}: {e}")
+        blocks = session_blocks(scan_directives(text))
+        for block in blocks:
+            lang = str(block.options.get('lang', 'python'))
+            if lang not in SESSION_LANGUAGES:
+                raise ExecutionError(f"block at line {block.line_number}: only python blocks can run, not {lang}")
+        keys = self.block_keys(request, blocks)
+        results: List[BlockResult] = []
+        if not self.reexecute:
+            for key in keys:
+                result = self.load_block(key)
+                if result is None:
+                    break
+                results.append(result)
+        first = len(results)
+        self.hits += first
+        if first < len(blocks):
+            start, ran = await self.run_blocks(request, blocks, keys, first, results[first - 1] if first else None)
+            results = results[:start] + ran
+        outputs = []
+        for block, result in zip(blocks, results):
+            if result.error is not None:
+                raise ExecutionError(f"block at line {block.line_number} failed: {result.error.strip()[-ERROR_OUTPUT_LIMIT:]}")
+            outputs.append(result.stdout)
+        return outputs
+
+    def block_keys(self, request: SessionRequest, blocks: List[MarkdownDirective]) -> List[str]:
+        """Cache keys of the blocks, each a hash of the key before it and the block's code"""
+        key = content_hash(json.dumps(['session', request.source, self.toolchain(RUNNERS['.py'][0])]).encode())
+        keys = []
+        for block in blocks:
+            key = content_hash(json.dumps([key, block.code]).encode())
+            keys.append(key)
+        return keys
+
+    def load_block(self, key: str) -> Optional[BlockResult]:
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        try:
+            return BlockResult(**json.loads(entry))
+        except (ValueError, TypeError):
+            return None
+
+    async def run_blocks(self, request: SessionRequest, blocks: List[MarkdownDirective], keys: List[str],
+                         first: int, previous: Optional[BlockResult]) -> Tuple[int, List[BlockResult]]:
+        """Run blocks[first:] in a new worker, after restoring or recreating the state the
+        blocks before them left. Stops at the first block that raises, which is
+        the last result returned. Returns the index of the first result, which is
+        that of the failed block if one of the blocks before first fails when it
+        is run again."""
+        import asyncio
+        run_limit, total_limit = self.limit('run')
+        async with run_limit, total_limit:
+            session = await Session.start(Path(request.source).parent)
+            try:
+                restored = False
+                if previous is not None and previous.state is not None:
+                    restored = (await session.send({'restore': previous.state}, RUN_TIMEOUT)).error is None
+                if not restored:
+                    for index, block in enumerate(blocks[:first]):
+                        result = await session.send(block_message(request.source, block), block_timeout(block))
+                        if result.error is not None:
+                            # It succeeded before, so something outside the file changed
+                            return index, [result]
+                results = []
+                for key, block in zip(keys[first:], blocks[first:]):
+                    result = await session.send(block_message(request.source, block), block_timeout(block))
+                    self.misses += 1
+                    results.append(result)
+                    if result.error is not None:
+                        # Not cached, so that the block runs again next time
+                        break
+                    self.cache.put(key, json.dumps(asdict(result)))
+            except asyncio.CancelledError:
+                await session.kill()
+                raise
+            finally:
+                await session.close()
+        return first, results
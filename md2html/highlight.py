@@ -0,0 +1,73 @@
+"""
+Syntax highlighting of fenced code blocks, with a content-addressed disk cache.
+
+Notes repeat the same snippets across pages and rebuilds, and highlighting is
+the most expensive part of rendering them. Highlighted HTML is cached under
+`highlight/` in the cache directory, keyed by a hash of the code, the language,
+the formatter options and the Pygments version (see content_cache.py). Editing
+the prose of a page therefore costs no highlighting at all.
+
+Within a process, a Highlighter reuses one lexer per language and one formatter.
+It is hooked into Markdown by HighlightExtension in markdown_extensions.py.
+"""
+
+from typing import Any, Dict, Optional
+from pathlib import Path
+import json
+
+from .content_cache import ContentCache
+from .source import content_hash
+
+HIGHLIGHT_DIRNAME = 'highlight'
+# Options of the Pygments HtmlFormatter. The class matches the styles in default.css.
+FORMATTER_OPTIONS: Dict[str, Any] = {'cssclass': 'codehilite', 'wrapcode': True}
+
+
+def highlight_fingerprint() -> str:
+    """Fingerprint of everything besides the code and language that affects highlighted HTML"""
+    import pygments
+    return content_hash(json.dumps([pygments.__version__, FORMATTER_OPTIONS], sort_keys=True).encode())
+
+
+class Highlighter:
+    """Highlights code through a ContentCache. Not thread safe; each render worker has its own."""
+
+    def __init__(self, cache_dir: Optional[Path] = None):
+        self.cache = ContentCache(cache_dir / HIGHLIGHT_DIRNAME if cache_dir is not None else None)
+        self.fingerprint = highlight_fingerprint()
+        self.lexers: Dict[str, Any] = {} # language -> pygments lexer, or None if Pygments doesn't know it
+        self.formatter = None
+        self.hits = 0
+        self.misses = 0
+
+    def highlight(self, code: str, lang: str) -> Optional[str]:
+        """HTML of code highlighted as lang, or None if Pygments has no lexer for lang"""
+        key = content_hash(f"{self.fingerprint}\0{lang}\0{code}".encode())
+        html = self.cache.get(key)
+        if html is not None:
+            self.hits += 1
+            return html
+        lexer = self.lexer(lang)
+        if lexer is None:
+            return None
+        html = self.format(code, lexer)
+        self.misses += 1
+        self.cache.put(key, html)
+        return html
+
+    def lexer(self, lang: str) -> Any:
+        if lang not in self.lexers:
+            from pygments.lexers import get_lexer_by_name
+            from pygments.util import ClassNotFound
+            try:
+                self.lexers[lang] = get_lexer_by_name(lang)
+            except ClassNotFound:
+                self.lexers[lang] = None
+        return self.lexers[lang]
+
+    def format(self, code: str, lexer: Any) -> str:
+        from pygments import highlight
+        if self.formatter is None:
+            from pygments.formatters import HtmlFormatter
+            self.formatter = HtmlFormatter(**FORMATTER_OPTIONS)
+        return highlight(code, lexer, self.formatter)
@@ -0,0 +1,138 @@
+"""
+Build manifest: what each output was built from, so unchanged targets are skipped.
+
+The manifest is a JSON file, `.md2html-manifest.json`, in the output root. For each
+output it records the state of the input file, the state of every file read while
+rendering it (@include and @src targets), a fingerprint of the templates and
+render settings, and the state of the output itself. A file's state is
+[mtime_ns, size, content hash]. A file whose (mtime_ns, size) is unchanged is
+taken to be unchanged, which costs one stat, so a no-op rebuild only stats the
+files involved. If the fingerprint changed, the content is hashed and compared,
+so a `touch` or `git checkout` doesn't cause a rebuild. Copies and links are
+recorded without a content hash, so that building them reads nothing; they are
+compared by fingerprint only.
+"""
+
+from typing import Any, Dict, List, Optional
+from pathlib import Path
+import json
+import os
+import sys
+
+from .source import SourceBuffer, file_hash
+
+MANIFEST_FILENAME = '.md2html-manifest.json'
+# Bump whenever the format of the entries changes
+MANIFEST_VERSION = 1
+
+
+def source_state(source: SourceBuffer) -> List[Any]:
+    """The recorded state of a file, from the buffer it was read into"""
+    return [*source.fingerprint, source.digest]
+
+
+def written_state(path: Path, digest: Optional[str]) -> List[Any]:
+    """The recorded state of a file just written with contents hashing to digest, if known"""
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size, digest]
+
+
+class BuildManifest:
+    """The manifest of one output root, loaded at the start of a build and saved at the end"""
+
+    def __init__(self, root: Path, entries: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.root = root
+        self.path = root / MANIFEST_FILENAME
+        self.root_prefix = os.path.join(os.path.abspath(root), '')
+        self.entries: Dict[str, Dict[str, Any]] = entries if entries is not None else {}
+        self.changed = False
+
+    @staticmethod
+    def load(root: Path) -> 'BuildManifest':
+        """Load the manifest in root. A missing, unreadable or outdated manifest is
+        treated as empty, which makes every target build."""
+        try:
+            data = json.loads((root / MANIFEST_FILENAME).read_text())
+            if data.get('version') == MANIFEST_VERSION and isinstance(data.get('outputs'), dict):
+                return BuildManifest(root, data['outputs'])
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as e:
+            print(f"Warning: Ignoring unreadable build manifest {root / MANIFEST_FILENAME}: {e}", file=sys.stderr)
+        return BuildManifest(root)
+
+    def key(self, output_path: Path) -> str:
+        path = os.path.abspath(output_path)
+        if path.startswith(self.root_prefix):
+            return path[len(self.root_prefix):]
+        return os.path.relpath(path, self.root)
+
+    def contains(self, output_path: Path) -> bool:
+        return self.key(output_path) in self.entries
+
+    def is_current(self, output_path: Path, input_path: Path, settings: str) -> bool:
+        """Whether output_path was built from input_path with the same settings, and neither
+        the input, the dependencies it was built with nor the output have changed since"""
+        entry = self.entries.get(self.key(output_path))
+        if entry is None or entry['settings'] != settings or entry['input'] != os.path.abspath(input_path):
+            return False
+        if not self.file_unchanged(input_path, entry['input_state']):
+            return False
+        for dependency, state in entry['dependencies'].items():
+            if not self.file_unchanged(Path(dependency), state):
+                return False
+        return self.file_unchanged(output_path, entry['output_state'])
+
+    def output_digest(self, output_path: Path) -> str:
+        """The content hash recorded for an output, which must be in the manifest"""
+        return self.entries[self.key(output_path)]['output_state'][2]
+
+    def file_unchanged(self, path: Path, state: List[Any]) -> bool:
+        """Whether path still matches a recorded state. If only the fingerprint changed,
+        the recorded fingerprint is refreshed so the next build only needs a stat. A state
+        without a content hash is compared by fingerprint only."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if st.st_mtime_ns == state[0] and st.st_size == state[1]:
+            return True
+        if st.st_size != state[1] or state[2] is None:
+            return False
+        try:
+            if file_hash(path) != state[2]:
+                return False
+        except OSError:
+            return False
+        state[0] = st.st_mtime_ns
+        self.changed = True
+        return True
+
+    def record(self, output_path: Path, input_path: Path, settings: str, input_state: List[Any],
+               dependencies: Dict[str, List[Any]], output_state: List[Any]):
+        """Record a target that was just built. dependencies maps the absolute path
+        of each file read while building it to its state."""
+        self.entries[self.key(output_path)] = {
+            'input': os.path.abspath(input_path),
+            'input_state': input_state,
+            'dependencies': dependencies,
+            'settings': settings,
+            'output_state': output_state,
+        }
+        self.changed = True
+
+    def forget(self, output_path: Path):
+        if self.entries.pop(self.key(output_path), None) is not None:
+            self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        temp_path = self.path.with_name(self.path.name + '.tmp')
+        try:
+            self.root.mkdir(parents=True, exist_ok=True)
+            temp_path.write_text(json.dumps({'version': MANIFEST_VERSION, 'outputs': self.entries}))
+            os.replace(temp_path, self.path)
+            self.changed = False
+        except OSError as e:
+            print(f"Warning: Could not save build manifest {self.path}: {e}", file=sys.stderr)
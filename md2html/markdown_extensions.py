@@ -0,0 +1,92 @@
+"""
+Markdown extensions used by the render stage. Importing this module imports
+markdown, so it is only imported once a page is rendered.
+"""
+
+from markdown.extensions import Extension
+from markdown.extensions.attr_list import get_attrs_and_remainder
+from markdown.extensions.fenced_code import FencedBlockPreprocessor
+from markdown.preprocessors import Preprocessor
+
+from .highlight import Highlighter
+from .mathrender import MathRenderer, find_math
+
+
+class HighlightedFencePreprocessor(FencedBlockPreprocessor):
+    """fenced_code's preprocessor, with blocks that name a language highlighted by a Highlighter"""
+
+    def __init__(self, md, highlighter: Highlighter):
+        super().__init__(md, {'lang_prefix': 'language-'})
+        self.highlighter = highlighter
+
+    def run(self, lines):
+        text = "\n".join(lines)
+        index = 0
+        while m := self.FENCED_BLOCK_RE.search(text, index):
+            lang = m.group('lang')
+            if m.group('attrs'):
+                attrs, remainder = get_attrs_and_remainder(m.group('attrs'))
+                if remainder:
+                    # Unbalanced braces: not a fenced block
+                    index = m.end('attrs')
+                    continue
+                _, classes, _ = self.handle_attrs(attrs)
+                lang = classes[0] if classes else None
+            code = m.group('code')
+            html = self.highlighter.highlight(code, lang) if lang else None
+            if html is None:
+                lang_attr = f' class="language-{self._escape(lang)}"' if lang else ''
+                html = f'<pre><code{lang_attr}>{self._escape(code)}</code></pre>'
+            placeholder = self.md.htmlStash.store(html)
+            text = f'{text[:m.start()]}\n{placeholder}\n{text[m.end():]}'
+            index = m.start() + 1 + len(placeholder)
+        return text.split("\n")
+
+
+class HighlightExtension(Extension):
+    """Replaces the fenced_code extension's block processing with cached highlighting"""
+
+    def __init__(self, highlighter: Highlighter):
+        super().__init__()
+        self.highlighter = highlighter
+
+    def extendMarkdown(self, md):
+        md.registerExtension(self)
+        md.preprocessors.register(HighlightedFencePreprocessor(md, self.highlighter), 'fenced_code_block', 25)
+
+
+class MathPreprocessor(Preprocessor):
+    """Replaces $...$ and $$...$$ math with its HTML, converting all the math of a
+    document in one MathRenderer call. Runs after fenced code blocks are stashed,
+    so the math inside them is left alone."""
+
+    def __init__(self, md, math: MathRenderer):
+        super().__init__(md)
+        self.math = math
+
+    def run(self, lines):
+        text = "\n".join(lines)
+        found = find_math(text)
+        if not found:
+            return lines
+        converted = self.math.convert_all([(expression, display) for _, expression, display in found])
+        parts = []
+        position = 0
+        for (match, _, _), html in zip(found, converted):
+            parts.append(text[position:match.start()])
+            parts.append(self.md.htmlStash.store(html))
+            position = match.end()
+        parts.append(text[position:])
+        return ''.join(parts).split("\n")
+
+
+class MathExtension(Extension):
+    """Converts LaTeX math through a MathRenderer"""
+
+    def __init__(self, math: MathRenderer):
+        super().__init__()
+        self.math = math
+
+    def extendMarkdown(self, md):
+        md.registerExtension(self)
+        md.preprocessors.register(MathPreprocessor(md, self.math), 'math', 22)
@@ -2,77 +2,241 @@
 Markdown preprocessing functionality for custom syntax.
 
 Handles:
-- YAML front matter parsing for template configuration
+- YAML front matter parsing for template configuration (on a shared SourceBuffer)
 - @include(file.md, opts) directive parsing
 - @src(file.cpp, opts) directive parsing
+- @src_begin(opts) ... @src_end inline source block parsing
 - Dependency extraction for build graph construction
 """
 
 from dataclasses import dataclass, field
-from typing import List, Dict, Set, Optional, Tuple, Any
+from collections.abc import Mapping
+from typing import List, Dict, Set, Optional, Tuple, Any, Iterator
 from pathlib import Path
 import re
-import yaml
-import frontmatter
+
+from .source import SourceBuffer
 
 
 @dataclass
 class MarkdownDirective:
-    """Represents a parsed @include or @src directive"""
-    directive_type: str  # "include" or "src"
-    file_path: str
+    """Represents a parsed @include or @src directive, or an inline @src_begin block"""
+    directive_type: str  # "include", "src" or "src_begin"
+    file_path: str  # empty for src_begin blocks
     options: Dict[str, Any] = field(default_factory=dict)
     line_number: int = 0
+    # Offsets of the directive text, from the '@' to just past the ')', in the scanned string.
+    # A src_begin block runs to the end of its @src_end line.
+    start: int = 0
+    end: int = 0
+    code: Optional[str] = None  # the lines between @src_begin and @src_end
+
+
+def load_yaml_frontmatter(frontmatter_text: str) -> Optional[Dict[str, Any]]:
+    """Parse the text of a YAML front matter block. Returns None if it is malformed."""
+    # Imported here so that runs which never see front matter don't pay for yaml
+    import yaml
+    # libyaml's loader is several times faster than the pure-Python one
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    try:
+        metadata = yaml.load(frontmatter_text, Loader=loader)
+    except yaml.YAMLError:
+        return None
+    return metadata if isinstance(metadata, dict) else {}
+
+
+class LazyFrontmatter(Mapping):
+    """
+    Read-only front matter mapping that parses its YAML on first access.
+    
+    Looking up a key whose name doesn't occur anywhere in the YAML text (e.g.
+    `template` on most pages) is answered without parsing at all. Malformed YAML
+    behaves like an empty mapping, as in the eager parser. Pickles unparsed
+    unless it has already been parsed.
+    """
+    __slots__ = ('text', '_data')
+
+    def __init__(self, text: str):
+        self.text = text
+        self._data: Optional[Dict[str, Any]] = None
+
+    @property
+    def data(self) -> Dict[str, Any]:
+        if self._data is None:
+            self._data = load_yaml_frontmatter(self.text) or {}
+            self.text = ''
+        return self._data
+
+    @property
+    def parsed(self) -> bool:
+        return self._data is not None
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        if self._data is None and isinstance(key, str) and key not in self.text:
+            return default
+        return self.data.get(key, default)
+
+    def __getitem__(self, key: Any) -> Any:
+        if self._data is None and isinstance(key, str) and key not in self.text:
+            raise KeyError(key)
+        return self.data[key]
+
+    def __contains__(self, key: Any) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self.data)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __repr__(self) -> str:
+        return f"LazyFrontmatter({self.data!r})" if self.parsed else "LazyFrontmatter(<unparsed>)"
+
+    def __getstate__(self):
+        return (self.text, self._data)
+
+    def __setstate__(self, state):
+        self.text, self._data = state
+
+
+_MISSING = object()
 
 
 @dataclass
 class MarkdownMetadata:
     """Contains parsed metadata from a markdown file"""
-    yaml_frontmatter: Dict[str, Any] = field(default_factory=dict)
-    template: Optional[str] = None
+    yaml_frontmatter: Mapping = field(default_factory=dict)  # dict, or LazyFrontmatter in lazy mode
     directives: List[MarkdownDirective] = field(default_factory=list)
     dependencies: List[Dict[str, Any]] = field(default_factory=list)
 
+    @property
+    def template(self) -> Optional[str]:
+        """Template specified in the front matter. Cheap even for unparsed lazy front matter."""
+        return self.yaml_frontmatter.get('template')
 
-def parse_yaml_frontmatter(content: str) -> Tuple[Dict[str, Any], str]:
+
+def parse_other_frontmatter(content: str) -> Tuple[Dict[str, Any], str]:
     """
-    Parse YAML front matter from markdown content.
+    Parse front matter in the other formats python-frontmatter understands (JSON, TOML).
     
     Returns:
         Tuple of (frontmatter_dict, content_without_frontmatter)
     """
-    try:
-        post = frontmatter.loads(content)
-        return post.metadata, post.content
-    except yaml.YAMLError:
-        # If YAML parsing fails, return empty metadata and original content
-        return {}, content
+    opening = content[:64].lstrip()
+    if opening.startswith('{') or opening.startswith('+++'):
+        import frontmatter
+        try:
+            post = frontmatter.loads(content)
+            return post.metadata, post.content
+        except Exception:
+            return {}, content
+    return {}, content.strip()
 
 
-def parse_directive_line(line: str, line_number: int) -> Optional[MarkdownDirective]:
+def parse_frontmatter(source: SourceBuffer, lazy: bool = False) -> Mapping:
     """
-    Parse a single line for @include or @src directive.
+    Parse the front matter of a source buffer. The YAML block located by the
+    buffer is parsed directly, without python-frontmatter splitting the document.
     
-    Expected formats:
-    - @include(file.md)
-    - @include(file.md, key=value, key2=value2)
-    - @src(file.cpp)
-    - @src(file.cpp, lang=cpp, lines=1-10)
+    Args:
+        source: The file's contents
+        lazy: Return a LazyFrontmatter that defers YAML parsing until a field is read
     
     Returns:
-        MarkdownDirective if line contains a valid directive, None otherwise
+        The front matter mapping, empty if there is none or it is malformed
     """
-    # Regex to match @directive(file, optional_args)
-    pattern = r'@(include|src)\s*\(\s*([^,)]+)(?:\s*,\s*(.+))?\s*\)'
-    match = re.search(pattern, line.strip())
-    
-    if not match:
-        return None
-    
-    directive_type = match.group(1)
-    file_path = match.group(2).strip().strip('"\'')
-    options_str = match.group(3)
+    if source.has_frontmatter:
+        if lazy:
+            return LazyFrontmatter(source.frontmatter_text)
+        return load_yaml_frontmatter(source.frontmatter_text) or {}
+    return parse_other_frontmatter(source.text)[0]
+
+
+def parse_yaml_frontmatter(content: str) -> Tuple[Dict[str, Any], str]:
+    """
+    Parse YAML front matter from markdown content.
     
+    Returns:
+        Tuple of (frontmatter_dict, content_without_frontmatter)
+    """
+    source = SourceBuffer.from_text(content)
+    if not source.has_frontmatter:
+        return parse_other_frontmatter(content)
+    metadata = load_yaml_frontmatter(source.frontmatter_text)
+    if metadata is None:
+        # If YAML parsing fails, return empty metadata and original content
+        return {}, content
+    return metadata, source.body
+
+
+# Patterns for the single-pass directive scanner. Each one starts with a literal or a
+# short character class, so searching a large buffer for the next candidate is fast,
+# and none of them can backtrack across a long line.
+DIRECTIVE_START = re.compile(r'@(include|src_begin|src)[ \t]*\(')
+# The line closing an @src_begin block
+SRC_END = re.compile(r'^[ \t]*@src_end\b.*$', re.MULTILINE)
+FENCE_OPEN = re.compile(r'^[ ]{0,3}(`{3,}|~{3,})', re.MULTILINE)
+# A line that can close a fence opened with the same character and at most as many of them
+FENCE_CLOSE = re.compile(r'^[ ]{0,3}(`{3,}|~{3,})[ \t]*$', re.MULTILINE)
+BACKTICKS = re.compile(r'`+')
+
+# Closing delimiters of inline code spans, by backtick count
+_code_span_closers: Dict[int, re.Pattern] = {}
+
+
+def _code_span_closer(length: int) -> re.Pattern:
+    if length not in _code_span_closers:
+        _code_span_closers[length] = re.compile(r'(?<!`)`{%d}(?!`)' % length)
+    return _code_span_closers[length]
+
+
+class _FenceFinder:
+    """Finds code fence openers at or after a position. Candidates are located with
+    str.find, which is much faster than a MULTILINE regex on large buffers, and the
+    next occurrence of each marker is remembered so repeated calls stay linear."""
+
+    MARKERS = ('```', '~~~')
+
+    def __init__(self, content: str):
+        self.content = content
+        self.next_marker = {marker: -1 for marker in self.MARKERS}
+
+    def search(self, position: int) -> Optional[re.Match]:
+        content = self.content
+        while True:
+            candidates = []
+            for marker in self.MARKERS:
+                index = self.next_marker[marker]
+                if index != -2 and index < position:
+                    index = content.find(marker, position)
+                    self.next_marker[marker] = index if index != -1 else -2
+                if index >= 0:
+                    candidates.append(index)
+            if not candidates:
+                return None
+            index = min(candidates)
+            # Only a run indented by at most 3 spaces at the start of a line opens a fence
+            line_start = index
+            while line_start > 0 and index - line_start < 3 and content[line_start - 1] == ' ':
+                line_start -= 1
+            if line_start == 0 or content[line_start - 1] == '\n':
+                return FENCE_OPEN.match(content, line_start)
+            position = index + 3
+
+
+def _fence_end(content: str, fence: re.Match) -> int:
+    """Offset just past the fence closing `fence`, or the end of the document if it is never closed"""
+    marker = fence.group(1)
+    for close in FENCE_CLOSE.finditer(content, fence.end()):
+        closing = close.group(1)
+        if closing[0] == marker[0] and len(closing) >= len(marker):
+            return close.end()
+    return len(content)
+
+
+def parse_directive_options(options_str: Optional[str]) -> Dict[str, Any]:
+    """Parse the comma separated key=value options of a directive"""
     options = {}
     if options_str:
         # Parse key=value pairs
@@ -91,33 +255,161 @@ def parse_directive_line(line: str, line_number: int) -> Optional[MarkdownDirect
                 elif value.isdigit():
                     value = int(value)
                 options[key] = value
-    
-    return MarkdownDirective(
-        directive_type=directive_type,
-        file_path=file_path,
-        options=options,
-        line_number=line_number
-    )
+    return options
 
 
-def parse_markdown_directives(content: str) -> List[MarkdownDirective]:
+def scan_directives(content: str) -> List[MarkdownDirective]:
     """
-    Parse all @include and @src directives from markdown content.
+    Scan a whole markdown buffer for @include and @src directives in a single pass.
+    
+    Directives inside fenced code blocks (``` or ~~~) and inline code spans are
+    ignored. At most one directive is taken per line, and line numbers are
+    computed from match offsets rather than by splitting the buffer into lines.
+    Options run up to the first ')' on the line.
+    
+    An @src_begin(opts) directive opens an inline source block, which runs to the
+    next @src_end line, or to the end of the buffer. Its lines are kept as the
+    directive's code, and are not scanned for directives.
     
     Returns:
-        List of MarkdownDirective objects found in the content
+        List of MarkdownDirective objects in document order
     """
     directives = []
-    lines = content.split('\n')
+    position = 0
+    line_number = 1
+    counted_to = 0
+    fences = _FenceFinder(content)
+    next_fence = fences.search(0)
+    # Bounds of the line holding the current candidate, and its inline code state:
+    # backticks before code_scanned_to are already paired up, and runs of the
+    # lengths in unclosed_lengths have no closer on the line
+    line_end = -1
+    code_scanned_to = 0
+    unclosed_lengths: Set[int] = set()
     
-    for line_number, line in enumerate(lines, 1):
-        directive = parse_directive_line(line, line_number)
-        if directive:
-            directives.append(directive)
+    while True:
+        match = DIRECTIVE_START.search(content, position)
+        if not match:
+            break
+        start = match.start()
+        
+        # Skip fenced code blocks opened before this candidate
+        if next_fence is not None and next_fence.start() < start:
+            fence_end = _fence_end(content, next_fence)
+            next_fence = fences.search(fence_end)
+            if fence_end > start:
+                position = fence_end
+                continue
+            if next_fence is not None and next_fence.start() < start:
+                # More than one fence before the candidate: resume from the last one
+                position = next_fence.start()
+                continue
+        
+        if start >= line_end:
+            line_start = content.rfind('\n', 0, start) + 1
+            line_end = content.find('\n', start)
+            if line_end == -1:
+                line_end = len(content)
+            code_scanned_to = line_start
+            unclosed_lengths = set()
+        
+        # Skip inline code spans opened before this candidate on the same line
+        inside_code = False
+        while True:
+            ticks = BACKTICKS.search(content, code_scanned_to, start)
+            if ticks is None:
+                break
+            length = len(ticks.group())
+            closer = None
+            if length not in unclosed_lengths:
+                closer = _code_span_closer(length).search(content, ticks.end(), line_end)
+                if closer is None:
+                    unclosed_lengths.add(length)
+            if closer is None:
+                code_scanned_to = ticks.end()
+                continue
+            code_scanned_to = closer.end()
+            if closer.start() > start:
+                inside_code = True
+                break
+        if inside_code:
+            position = code_scanned_to
+            continue
+        
+        # Parse "file, options)". Without a ')' nothing later on this line can match either.
+        close = content.find(')', match.end(), line_end)
+        if close == -1:
+            position = line_end
+            continue
+        if match.group(1) == 'src_begin':
+            line_number += content.count('\n', counted_to, start)
+            counted_to = start
+            end = SRC_END.search(content, line_end)
+            code_start = min(line_end + 1, len(content))
+            code_end = end.start() if end else len(content)
+            directives.append(MarkdownDirective(
+                directive_type='src_begin',
+                file_path='',
+                options=parse_directive_options(content[match.end():close]),
+                line_number=line_number,
+                start=start,
+                end=end.end() if end else len(content),
+                code=content[code_start:code_end].rstrip('\n')
+            ))
+            position = directives[-1].end
+            # Fences inside the block don't count
+            if next_fence is not None and next_fence.start() < position:
+                next_fence = fences.search(position)
+            continue
+        file_path, _, options_str = content[match.end():close].partition(',')
+        file_path = file_path.strip().strip('"\'')
+        if file_path:
+            line_number += content.count('\n', counted_to, start)
+            counted_to = start
+            directives.append(MarkdownDirective(
+                directive_type=match.group(1),
+                file_path=file_path,
+                options=parse_directive_options(options_str),
+                line_number=line_number,
+                start=start,
+                end=close + 1
+            ))
+        position = line_end
     
     return directives
 
 
+def parse_directive_line(line: str, line_number: int) -> Optional[MarkdownDirective]:
+    """
+    Parse a single line for @include or @src directive.
+    
+    Expected formats:
+    - @include(file.md)
+    - @include(file.md, key=value, key2=value2)
+    - @src(file.cpp)
+    - @src(file.cpp, lang=cpp, lines=1-10)
+    
+    Returns:
+        MarkdownDirective if line contains a valid directive, None otherwise
+    """
+    directives = scan_directives(line)
+    if not directives:
+        return None
+    directive = directives[0]
+    directive.line_number = line_number
+    return directive
+
+
+def parse_markdown_directives(content: str) -> List[MarkdownDirective]:
+    """
+    Parse all @include and @src directives from markdown content.
+    
+    Returns:
+        List of MarkdownDirective objects found in the content
+    """
+    return scan_directives(content)
+
+
 def extract_dependencies_from_directives(directives: List[MarkdownDirective], base_path: Path) -> List[Dict[str, Any]]:
     """
     Extract file dependencies from parsed directives.
@@ -132,6 +424,9 @@ def extract_dependencies_from_directives(directives: List[MarkdownDirective], ba
     dependencies = []
     
     for directive in directives:
+        if directive.directive_type == 'src_begin':
+            # Inline blocks don't read any file
+            continue
         # Keep relative paths relative, only resolve absolute paths
         if Path(directive.file_path).is_absolute():
             dep_path = directive.file_path
@@ -151,7 +446,8 @@ def extract_dependencies_from_directives(directives: List[MarkdownDirective], ba
     return dependencies
 
 
-def parse_markdown_metadata(markdown_file: Path) -> MarkdownMetadata:
+def parse_markdown_metadata(markdown_file: Path, source: Optional[SourceBuffer] = None,
+                            lazy_frontmatter: bool = False) -> MarkdownMetadata:
     """
     Parse a markdown file and extract all metadata including:
     - YAML front matter
@@ -161,23 +457,22 @@ def parse_markdown_metadata(markdown_file: Path) -> MarkdownMetadata:
     
     Args:
         markdown_file: Path to the markdown file to parse
+        source: The file's contents if they have already been read, e.g. from a SourceStore
+        lazy_frontmatter: Defer parsing the YAML front matter until a field is read
         
     Returns:
         MarkdownMetadata object containing all parsed information
     """
-    if not markdown_file.exists():
-        raise FileNotFoundError(f"Markdown file not found: {markdown_file}")
-    
-    content = markdown_file.read_text(encoding='utf-8')
+    if source is None:
+        if not markdown_file.exists():
+            raise FileNotFoundError(f"Markdown file not found: {markdown_file}")
+        source = SourceBuffer.read(markdown_file)
     
     # Parse YAML front matter
-    frontmatter_data, content_without_frontmatter = parse_yaml_frontmatter(content)
-    
-    # Extract template from front matter
-    template = frontmatter_data.get('template')
+    frontmatter_data = parse_frontmatter(source, lazy=lazy_frontmatter)
     
     # Parse directives from the content (including front matter)
-    directives = parse_markdown_directives(content)
+    directives = parse_markdown_directives(source.text)
     
     # Extract dependencies
     base_path = markdown_file.parent
@@ -185,7 +480,6 @@ def parse_markdown_metadata(markdown_file: Path) -> MarkdownMetadata:
     
     return MarkdownMetadata(
         yaml_frontmatter=frontmatter_data,
-        template=template,
         directives=directives,
         dependencies=dependencies
     )
@@ -0,0 +1,198 @@
+"""
+LaTeX math rendering with a persistent cache.
+
+`$...$` (inline) and `$$...$$` (display) math in a page is converted to HTML by
+one of the BACKENDS, chosen with --math:
+- mathml: MathML via latex2mathml, in process (default),
+- katex: KaTeX HTML via node and the katex package, one node process per page.
+
+Notes reuse the same expressions many times, so conversions are cached in memory
+and on disk under `math/` in the cache directory (see content_cache.py), keyed by
+the expression, display mode, backend and backend version. All the math of a page
+is collected first and the expressions missing from the cache are converted in
+one backend call, so a page whose math didn't change never calls the backend.
+The backend is only set up for that call. The backend version in the keys is
+read without it, and for katex from the package's package.json where node would
+find it, once per process, so that looking up cached math doesn't start node.
+"""
+
+from typing import Dict, List, Optional, Sequence, Tuple
+from pathlib import Path
+import functools
+import json
+import os
+import re
+import shutil
+import subprocess
+
+from .content_cache import ContentCache
+from .source import content_hash
+
+MATH_DIRNAME = 'math'
+
+# Code spans are matched so that the `$` inside them can be skipped. Like markdown's
+# code spans, they end at a blank line, so a stray backtick can't hide the math of
+# later paragraphs. Inline math follows pandoc's rules: no space inside the dollars,
+# and no digit right after the closing one, so that "$5 and $6" stays text.
+MATH_PATTERN = re.compile(
+    r'(?P<code>(?P<ticks>`+)(?:(?!\n[ \t]*\n).)+?(?P=ticks))'
+    r'|(?<!\\)\$\$(?P<display>.+?)\$\$'
+    r'|(?<![\\$])\$(?P<inline>[^\s$](?:[^$\n]*?[^\s\\$])?)\$(?!\d)',
+    re.DOTALL)
+
+
+class MathError(Exception):
+    """Raised when math can't be converted, or the backend isn't available"""
+
+
+def find_math(text: str) -> List[Tuple[re.Match, str, bool]]:
+    """The math in text, as (match, expression, display) in order, outside code spans"""
+    found = []
+    for match in MATH_PATTERN.finditer(text):
+        if match.group('display') is not None:
+            found.append((match, match.group('display').strip(), True))
+        elif match.group('inline') is not None:
+            found.append((match, match.group('inline'), False))
+    return found
+
+
+class MathMLBackend:
+    name = 'mathml'
+
+    def __init__(self):
+        self.installed_version()
+        try:
+            from latex2mathml.converter import convert
+        except ImportError:
+            raise MathError("the mathml backend needs latex2mathml (pip install latex2mathml)")
+        self.convert_one = convert
+
+    @staticmethod
+    def installed_version() -> str:
+        from importlib.metadata import PackageNotFoundError, version
+        try:
+            return version('latex2mathml')
+        except PackageNotFoundError:
+            raise MathError("the mathml backend needs latex2mathml (pip install latex2mathml)")
+
+    def convert(self, items: Sequence[Tuple[str, bool]]) -> List[str]:
+        results = []
+        for expression, display in items:
+            try:
+                results.append(self.convert_one(expression, display='block' if display else 'inline'))
+            except Exception as e:
+                raise MathError(f"could not convert ${expression}$: {e}")
+        return results
+
+
+# Reads [[expression, display], ...] as JSON on stdin and writes the rendered HTML as a JSON list
+KATEX_SCRIPT = """
+const katex = require('katex');
+let input = '';
+process.stdin.on('data', chunk => input += chunk).on('end', () => {
+    const items = JSON.parse(input);
+    const html = items.map(([tex, display]) => katex.renderToString(tex, {displayMode: display, throwOnError: false}));
+    process.stdout.write(JSON.stringify(html));
+});
+"""
+
+
+def run_node(args: List[str], stdin: str) -> str:
+    try:
+        result = subprocess.run(['node'] + args, input=stdin, capture_output=True, text=True)
+    except FileNotFoundError:
+        raise MathError("the katex backend needs node")
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()
+        raise MathError(f"katex failed: {error[-1] if error else result.returncode}")
+    return result.stdout
+
+
+def node_module_dirs() -> List[str]:
+    """The directories node searches, in order, for a package required by a `node -e` script"""
+    directories = []
+    current = os.getcwd()
+    while True:
+        if os.path.basename(current) != 'node_modules':
+            directories.append(os.path.join(current, 'node_modules'))
+        parent = os.path.dirname(current)
+        if parent == current:
+            break
+        current = parent
+    directories += [path for path in os.environ.get('NODE_PATH', '').split(os.pathsep) if path]
+    home = os.path.expanduser('~')
+    directories += [os.path.join(home, '.node_modules'), os.path.join(home, '.node_libraries')]
+    node = shutil.which('node')
+    if node is not None:
+        directories.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(node))), 'lib', 'node'))
+    return directories
+
+
+@functools.lru_cache(maxsize=None)
+def katex_version() -> str:
+    """The version of the katex package that node loads, from its package.json, or from
+    node itself if it isn't found where node looks"""
+    for directory in node_module_dirs():
+        try:
+            with open(os.path.join(directory, 'katex', 'package.json'), encoding='utf-8') as f:
+                return str(json.load(f)['version'])
+        except (OSError, ValueError, KeyError):
+            continue
+    return run_node(['-p', "require('katex').version"], '').strip()
+
+
+class KatexBackend:
+    name = 'katex'
+
+    @staticmethod
+    def installed_version() -> str:
+        return katex_version()
+
+    def convert(self, items: Sequence[Tuple[str, bool]]) -> List[str]:
+        return json.loads(run_node(['-e', KATEX_SCRIPT], json.dumps(list(items))))
+
+
+BACKENDS = {
+    'mathml': MathMLBackend,
+    'katex': KatexBackend,
+}
+
+
+class MathRenderer:
+    """Converts the math of pages through a ContentCache. The backend is set up when
+    the first expression missing from the cache is converted, so pages without math,
+    or whose math is all cached, never load it."""
+
+    def __init__(self, backend: str = 'mathml', cache_dir: Optional[Path] = None):
+        self.backend_name = backend
+        self.backend = None
+        self.version: Optional[str] = None # of the backend, read on the first lookup
+        self.cache = ContentCache(cache_dir / MATH_DIRNAME if cache_dir is not None else None)
+        self.calls = 0 # backend calls, at most one per page
+        self.hits = 0
+        self.misses = 0
+
+    def convert_all(self, items: Sequence[Tuple[str, bool]]) -> List[str]:
+        """HTML for each (expression, display) item, converting the uncached ones in one batch"""
+        keys = [self.key(expression, display) for expression, display in items]
+        results = [self.cache.get(key) for key in keys]
+        missing: Dict[str, Tuple[str, bool]] = {}
+        for key, item, result in zip(keys, items, results):
+            if result is None:
+                missing[key] = item
+        self.hits += sum(result is not None for result in results)
+        if missing:
+            if self.backend is None:
+                self.backend = BACKENDS[self.backend_name]()
+            self.calls += 1
+            self.misses += len(missing)
+            converted = dict(zip(missing, self.backend.convert(list(missing.values()))))
+            for key, html in converted.items():
+                self.cache.put(key, html)
+            results = [converted[key] if result is None else result for key, result in zip(keys, results)]
+        return results
+
+    def key(self, expression: str, display: bool) -> str:
+        if self.version is None:
+            self.version = BACKENDS[self.backend_name].installed_version()
+        return content_hash(json.dumps([self.backend_name, self.version, display, expression]).encode())
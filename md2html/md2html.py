@@ -1,6 +1,11 @@
+import time
+# Taken before the package modules below are imported, for --startup-profile
+IMPORT_STARTED = time.perf_counter()
+
 from dataclasses import dataclass, field
 from collections import defaultdict, deque
-from typing import List, Dict, Set, Tuple, Optional, Any
+from typing import List, Dict, Set, Tuple, Optional, Any, Callable
+from functools import partial
 from pathlib import Path
 from enum import Enum
 import argparse
@@ -9,16 +14,57 @@ import json
 import os
 
 from .config import Config, parse_args
-from .buildgraph import BuildTarget, BuildTargetType, BuildTargets, handle_target
 
+# Optional dependencies that should only be imported on code paths that use them
+HEAVY_MODULES = ['yaml', 'frontmatter', 'markdown', 'pygments', 'liquid', 'watchdog',
+                 'sqlite3', 'pickle', 'concurrent.futures', 'multiprocessing']
 
+@dataclass
+class StartupProfile:
+    """Timings for --startup-profile, measured from the start of md2html's imports"""
+    started: float
+    phases: List[Tuple[str, float]] = field(default_factory=list)
 
+    def mark(self, phase: str):
+        self.phases.append((phase, time.perf_counter()))
 
-def main():
-    argument_list = sys.argv[1:]
-    
-    config, args = parse_args(argument_list)
-    
+    def report(self):
+        print("Startup profile:", file=sys.stderr)
+        # CPU time also covers interpreter startup, which happens before any of our code runs
+        print(f"  {'process cpu time':<18}{time.process_time() * 1000:8.1f} ms", file=sys.stderr)
+        previous = self.started
+        for phase, at in self.phases:
+            print(f"  {phase:<18}{(at - previous) * 1000:8.1f} ms", file=sys.stderr)
+            previous = at
+        print(f"  {'total':<18}{(previous - self.started) * 1000:8.1f} ms", file=sys.stderr)
+        loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+        print(f"  heavy modules loaded: {', '.join(loaded) if loaded else 'none'}", file=sys.stderr)
+
+
+# The build graph modules are imported by the functions that use them, so that
+# `--client` only loads what it needs to talk to the daemon
+
+def scan(config: Config, args: List[Path], metadata_cache: Any,
+         on_node_ready: Optional[Callable[[Any], None]] = None) -> Any:
+    """Build the targets and dependency graph (BuildTargets) of the input paths.
+    metadata_cache is a MetadataCache, or None; on_node_ready gets each BuildTarget."""
+    from .buildgraph import BuildTargets, handle_target
+    targets = BuildTargets(config=config, jobs=config.jobs, metadata_cache=metadata_cache, on_node_ready=on_node_ready)
+    for path in args:
+        handle_target(path, config, targets)
+    targets.wait_for_metadata()
+    return targets
+
+
+def stream_node(node: Any):
+    """Write a scanned BuildTarget as an NDJSON line, flushed so that a reader of a pipe
+    gets it right away rather than when the output buffer fills"""
+    sys.stdout.write(node.to_json_line())
+    sys.stdout.flush()
+
+
+def input_paths(config: Config, args: List[str]) -> List[Path]:
+    """Check the input arguments, and set the base input path from them. Exits on errors."""
     # TODO: allow for no args to mean "look for md2html.json config"
     if not args:
         print("Error: No input files specified", file=sys.stderr)
@@ -39,14 +85,91 @@ def main():
             sys.exit(1)
     else:
         config.base_input_path = config.invoked_from
+    return args
 
-    targets = BuildTargets()
+
+def output(config: Config, targets: Any, streamed: bool = False, store: Any = None, scheduler: Any = None) -> int:
+    """Print the targets affected by --affected, or the build graph of a dry run, or
+    build the targets. streamed is set if the scan already wrote the graph as NDJSON.
+    targets is the BuildTargets of the scan, and scheduler a scheduler.Scheduler to
+    build on, if one is kept between builds. Returns the exit status."""
+    if config.affected is not None:
+        affected = targets.affected_targets(config.affected)
+        if config.output_format == 'ndjson':
+            sys.stdout.write(targets.get_ndjson_str(affected))
+        else:
+            print(targets.get_json_str(affected))
+    elif config.dry_run:
+        if config.output_format == 'ndjson':
+            if not streamed:
+                sys.stdout.write(targets.get_ndjson_str())
+        else:
+            print(targets.get_json_str())
+    else:
+        from .build import build
+        summary = build(targets, config, store=store, scheduler=scheduler)
+        print(summary)
+        if summary.errors:
+            print(f"Errors ({summary.failed}):", file=sys.stderr)
+            for input_file, error in summary.errors:
+                print(f"  {input_file}: {error}", file=sys.stderr)
+        if summary.failed:
+            return 1
+    return 0
+
+
+def main():
+    profile = StartupProfile(IMPORT_STARTED)
+    profile.mark("imports")
+    argument_list = sys.argv[1:]
     
-    for path in args:
-        handle_target(path, config, targets)
+    config, args = parse_args(argument_list)
+    profile.mark("parse args")
+    if config.client:
+        from .client import run_client
+        sys.exit(run_client(config, argument_list))
+    if config.daemon:
+        from .daemon import run_daemon
+        sys.exit(run_daemon(config))
+    
+    from .metadata_cache import MetadataCache
+    args = input_paths(config, args)
+    metadata_cache = MetadataCache.open(config.cache_dir)
+    # An NDJSON dry run writes each node as soon as it has been scanned, rather than the graph at the end
+    streaming = config.dry_run and config.affected is None and config.output_format == 'ndjson'
+    targets = scan(config, args, metadata_cache,
+                   on_node_ready=stream_node if streaming else None)
+    watching = config.watch and config.affected is None and not config.dry_run
+    server = None
+    if metadata_cache:
+        if config.verbose:
+            print(f"Metadata cache: {metadata_cache.hits} hits, {metadata_cache.misses} misses", file=sys.stderr)
+        if watching:
+            # Watch mode keeps the cache open; commit, so other runs aren't locked out of it
+            metadata_cache.commit()
+        else:
+            metadata_cache.close()
+    profile.mark("scan")
+    
+    if watching and config.serve:
+        from .serve import start_server
+        server = start_server(config)
+    status = output(config, targets, streaming, server.store if server else None)
+    profile.mark("output")
     
-    if config.dry_run:
-        print(targets.get_json_str())
+    if config.startup_profile:
+        profile.report()
+    if watching:
+        from .watch import watch
+        try:
+            watch(targets, config, partial(scan, config, args, metadata_cache), server.store if server else None)
+        finally:
+            if server:
+                server.stop()
+            if metadata_cache:
+                metadata_cache.close()
+        return
+    sys.exit(status)
 
 if __name__ == "__main__":
     main()
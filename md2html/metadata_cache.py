@@ -0,0 +1,141 @@
+"""
+Persistent cache of parsed markdown metadata.
+
+Entries live in a SQLite database (by default `.md2html-cache/metadata.sqlite`
+in the directory md2html was invoked from) and are keyed by the absolute input
+path. An entry is reused when:
+- the file's (mtime_ns, size) fingerprint is unchanged, which costs one stat, or
+- the fingerprint changed but the content hash did not (e.g. after a
+  `git checkout` or `touch`), in which case the stored fingerprint is refreshed.
+
+If the database fails while in use, e.g. because another run holds it locked, a
+warning is printed once and the rest of the run goes without the cache.
+"""
+
+from pathlib import Path
+from typing import Optional, Tuple
+import os
+import sys
+
+from .markdown_preprocessing import MarkdownMetadata
+from .source import SourceStore, content_hash
+
+# Bump whenever MarkdownMetadata or the parsing rules change, so stale entries are dropped
+CACHE_VERSION = 5
+CACHE_FILENAME = 'metadata.sqlite'
+
+
+def file_fingerprint(st: os.stat_result) -> Tuple[int, int]:
+    return st.st_mtime_ns, st.st_size
+
+
+class MetadataCache:
+    """SQLite-backed store of MarkdownMetadata keyed by path and file fingerprint"""
+
+    def __init__(self, cache_dir: Path):
+        import sqlite3
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(cache_dir / CACHE_FILENAME))
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS metadata (
+            path TEXT PRIMARY KEY,
+            mtime_ns INTEGER,
+            size INTEGER,
+            hash TEXT,
+            data BLOB)""")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != str(CACHE_VERSION):
+            self.db.execute("DELETE FROM metadata")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (str(CACHE_VERSION),))
+        self.hits = 0
+        self.misses = 0
+        self.failed = False # set after a database error, after which the cache is not used
+
+    def fail(self, e: Exception):
+        """Give up the cache after a database error, e.g. when another run holds it locked"""
+        if not self.failed:
+            print(f"Warning: Metadata cache disabled: {e}", file=sys.stderr)
+        self.failed = True
+
+    @staticmethod
+    def open(cache_dir: Optional[Path]) -> Optional['MetadataCache']:
+        """Open the cache, or return None (with a warning) if it is disabled or unusable"""
+        if cache_dir is None:
+            return None
+        import sqlite3
+        try:
+            return MetadataCache(cache_dir)
+        except (OSError, sqlite3.Error) as e:
+            print(f"Warning: Metadata cache disabled, could not open {cache_dir}: {e}", file=sys.stderr)
+            return None
+
+    def lookup(self, path: Path, sources: Optional[SourceStore] = None) -> Optional[MarkdownMetadata]:
+        """Return cached metadata for path if the file is unchanged, otherwise None.
+        If the content has to be hashed, it is read through sources when given so
+        that a later parse or render can reuse the buffer."""
+        import pickle
+        import sqlite3
+        key = os.path.abspath(path)
+        if self.failed:
+            self.misses += 1
+            return None
+        try:
+            row = self.db.execute("SELECT mtime_ns, size, hash, data FROM metadata WHERE path = ?", (key,)).fetchone()
+        except sqlite3.Error as e:
+            self.fail(e)
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        try:
+            fingerprint = file_fingerprint(os.stat(key))
+            if fingerprint != (row[0], row[1]):
+                # Fingerprint changed: fall back to comparing content hashes
+                digest = sources.read(path).digest if sources else content_hash(Path(key).read_bytes())
+                if digest != row[2]:
+                    self.misses += 1
+                    return None
+                self.db.execute("UPDATE metadata SET mtime_ns = ?, size = ? WHERE path = ?", (*fingerprint, key))
+            metadata = pickle.loads(row[3])
+        except sqlite3.Error as e:
+            self.fail(e)
+            self.misses += 1
+            return None
+        except (OSError, UnicodeDecodeError, pickle.UnpicklingError, EOFError, AttributeError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return metadata
+
+    def store(self, path: Path, fingerprint: Tuple[int, int], digest: str, metadata: MarkdownMetadata):
+        """Record metadata parsed from a file with the given fingerprint and content hash"""
+        import pickle
+        import sqlite3
+        if self.failed:
+            return
+        try:
+            data = pickle.dumps(metadata, protocol=pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return
+        try:
+            self.db.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)",
+                            (os.path.abspath(path), *fingerprint, digest, data))
+        except sqlite3.Error as e:
+            self.fail(e)
+
+    def commit(self):
+        import sqlite3
+        if self.failed:
+            return
+        try:
+            self.db.commit()
+        except sqlite3.Error as e:
+            self.fail(e)
+
+    def close(self):
+        import sqlite3
+        self.commit()
+        try:
+            self.db.close()
+        except sqlite3.Error:
+            pass
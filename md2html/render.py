@@ -0,0 +1,257 @@
+"""
+Render stage: turns markdown build targets into HTML pages.
+
+A page is rendered in three steps:
+1. @include and @src directives in the body are expanded, recursively for
+   included markdown files,
+2. the expanded markdown is converted to HTML with the markdown library,
+   Code blocks are highlighted with Pygments, and LaTeX math is converted,
+   through the caches in highlight.py and mathrender.py,
+3. the HTML is placed into a liquid template, `default.html` unless the front
+   matter names another one.
+
+Inline @src_begin(opts) ... @src_end blocks are listed like @src sources.
+
+In --execute builds, the output of each @src(file, run=true) source is embedded
+below its listing, and so is the output of each @src_begin(run=true) block. Sources
+and sessions are run by the build before the pages that use them, and their
+outputs are passed in keyed by ExecutionRequest.key and SessionRequest.key.
+
+The files read along the way are returned with the page, so that the build
+manifest can record them as dependencies.
+"""
+
+from dataclasses import dataclass, field
+from typing import Any, List, Mapping, Optional
+from pathlib import Path
+from html import escape
+import os
+import sys
+
+from .config import Config, DEFAULT_TEMPLATE
+from .execute import ExecutionRequest, SessionRequest, session_blocks
+from .markdown_preprocessing import MarkdownDirective, BACKTICKS, parse_other_frontmatter, scan_directives
+from .mathrender import MathError
+from .source import SourceBuffer, SourceStore
+
+# Bump whenever a change to rendering changes the output for the same inputs,
+# so that pages recorded in existing build manifests are rendered again
+RENDER_VERSION = 5
+
+MARKDOWN_EXTENSIONS = ['fenced_code', 'tables']
+
+# A renderer drops its Markdown instance and template cache, and builds new ones, after
+# this many pages, or once the process has grown this much since they were built, to
+# bound leaks in extensions. Unlike render workers, the main process, which renders
+# with --jobs 1, is never replaced, so this is all that bounds its leaks.
+RENDERER_MAX_GROWTH_MB = 256
+RENDERER_MAX_PAGES = 1000
+
+
+class RenderError(Exception):
+    """Raised when a page can't be rendered, e.g. because an @include target is missing"""
+
+
+@dataclass
+class RenderedPage:
+    html: str
+    source: SourceBuffer # the page as it was read
+    dependencies: List[SourceBuffer] # files read for @include and @src directives, in order
+
+
+def page_body(source: SourceBuffer) -> str:
+    """The markdown of a page without its front matter"""
+    if source.has_frontmatter:
+        return source.body
+    return parse_other_frontmatter(source.text)[1]
+
+
+def page_title(frontmatter: Mapping[str, Any], path: Path) -> str:
+    title = frontmatter.get('title')
+    return str(title) if title is not None else path.stem
+
+
+def select_lines(text: str, lines: Any) -> str:
+    """Apply a `lines=START-END` (or `lines=N`) directive option, with 1-based inclusive bounds"""
+    first, dash, last = str(lines).partition('-')
+    try:
+        start = int(first) if first.strip() else 1
+        end = (int(last) if last.strip() else None) if dash else start
+    except ValueError:
+        raise RenderError(f"invalid lines option: {lines}")
+    selected = text.split('\n')[start - 1:end]
+    return '\n'.join(selected)
+
+
+def code_fence(code: str, lang: str) -> str:
+    """Wrap code in a fenced block whose fence is longer than any backtick run inside it"""
+    longest = max((len(run) for run in BACKTICKS.findall(code)), default=0)
+    fence = '`' * max(3, longest + 1)
+    return f"{fence}{lang}\n{code.rstrip(chr(10))}\n{fence}"
+
+
+def output_block(output: str) -> str:
+    """The output of a run source, as a raw HTML block that markdown passes through"""
+    return f'<div class="code-output"><pre>{escape(output.rstrip())}</pre></div>'
+
+
+def rss_mb() -> float:
+    """Resident memory of this process in MB. Where /proc isn't available, this is the
+    peak instead, which never goes down; it is 0 where neither can be measured."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in KB elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+@dataclass
+class PageRenderer:
+    """Renders markdown pages. Holds the Markdown instance and the liquid environment
+    between pages, and reads files through a SourceStore so that buffers loaded by the
+    scan are reused."""
+    config: Config
+    sources: SourceStore = field(default_factory=SourceStore)
+    templates: Any = None # liquid.Environment, created on first use
+    markdown: Any = None # markdown.Markdown, created on first use and reset between pages
+    highlighter: Any = None # highlight.Highlighter, created on first use
+    math: Any = None # mathrender.MathRenderer, created on first use
+    baseline_mb: float = 0.0 # rss_mb() when markdown was created
+    pages: int = 0 # pages converted since markdown was created
+
+    def render(self, path: Path, frontmatter: Optional[Mapping[str, Any]],
+               outputs: Optional[Mapping[str, Any]] = None) -> RenderedPage:
+        """Render the markdown file at path, whose parsed front matter is given.
+        outputs holds the output of the sources the page runs, when executing."""
+        frontmatter = frontmatter if frontmatter is not None else {}
+        try:
+            source = self.sources.take(path)
+        except (OSError, UnicodeDecodeError) as e:
+            raise RenderError(f"could not read {path}: {e}")
+        dependencies: List[SourceBuffer] = []
+        body = self.expand_directives(path, page_body(source), dependencies, [os.path.abspath(path)], outputs)
+        try:
+            content = self.convert(body)
+        except MathError as e:
+            raise RenderError(f"{path}: {e}")
+        template = frontmatter.get('template') or DEFAULT_TEMPLATE
+        html = self.apply_template(str(template), content, frontmatter, path)
+        self.recycle_if_due()
+        return RenderedPage(html, source, dependencies)
+
+    def expand_directives(self, path: Path, text: str, dependencies: List[SourceBuffer], including: List[str],
+                          outputs: Optional[Mapping[str, Any]]) -> str:
+        """Replace the @include and @src directives and @src_begin blocks in text, which was read from path"""
+        directives = scan_directives(text)
+        if not directives:
+            return text
+        blocks = session_blocks(directives)
+        parts = []
+        position = 0
+        for directive in directives:
+            parts.append(text[position:directive.start])
+            if directive.directive_type == 'src_begin':
+                index = blocks.index(directive) if directive in blocks else None
+                parts.append(self.expand_block(path, directive, index, outputs))
+            else:
+                parts.append(self.expand_directive(path, directive, dependencies, including, outputs))
+            position = directive.end
+        parts.append(text[position:])
+        return ''.join(parts)
+
+    def expand_directive(self, path: Path, directive: MarkdownDirective, dependencies: List[SourceBuffer], including: List[str],
+                         outputs: Optional[Mapping[str, Any]]) -> str:
+        target = path.parent / directive.file_path
+        location = f"{path}:{directive.line_number}"
+        try:
+            source = self.sources.read(target)
+        except FileNotFoundError:
+            raise RenderError(f"{location}: @{directive.directive_type} file not found: {directive.file_path}")
+        except (OSError, UnicodeDecodeError) as e:
+            raise RenderError(f"{location}: could not read {directive.file_path}: {e}")
+        dependencies.append(source)
+        options = directive.options
+
+        if directive.directive_type == 'include':
+            if target.suffix.lower() != '.md':
+                text = source.text
+            else:
+                key = os.path.abspath(target)
+                if key in including:
+                    chain = ' -> '.join(including[including.index(key):] + [key])
+                    raise RenderError(f"{location}: @include cycle: {chain}")
+                text = self.expand_directives(target, page_body(source), dependencies, including + [key], outputs)
+            return select_lines(text, options['lines']) if 'lines' in options else text
+
+        code = select_lines(source.text, options['lines']) if 'lines' in options else source.text
+        lang = options.get('lang', target.suffix.lstrip('.'))
+        listing = code_fence(code, str(lang))
+        if options.get('run') is not True or not self.config.execute:
+            return listing
+        output = (outputs or {}).get(ExecutionRequest.from_options(str(target), options).key)
+        if output is None:
+            raise RenderError(f"{location}: output of {directive.file_path} is not available")
+        return f"{listing}\n\n{output_block(output)}\n"
+
+    def expand_block(self, path: Path, block: MarkdownDirective, index: Optional[int],
+                     outputs: Optional[Mapping[str, Any]]) -> str:
+        """List an @src_begin block, with its output if it is the index-th block of path's session"""
+        listing = code_fence(block.code or '', str(block.options.get('lang', 'python')))
+        if index is None or not self.config.execute:
+            return listing
+        session = (outputs or {}).get(SessionRequest(os.path.normpath(os.path.abspath(path))).key)
+        if session is None or index >= len(session):
+            raise RenderError(f"{path}:{block.line_number}: output of the block is not available")
+        return f"{listing}\n\n{output_block(session[index])}\n"
+
+    def markdown_extensions(self) -> List[Any]:
+        """The extensions pages are converted with, sharing this renderer's highlight and math caches"""
+        from .highlight import Highlighter
+        from .markdown_extensions import HighlightExtension, MathExtension
+        from .mathrender import MathRenderer
+        if self.highlighter is None:
+            self.highlighter = Highlighter(self.config.cache_dir)
+        if self.math is None:
+            self.math = MathRenderer(self.config.math, self.config.cache_dir)
+        return MARKDOWN_EXTENSIONS + [HighlightExtension(self.highlighter), MathExtension(self.math)]
+
+    def convert(self, text: str) -> str:
+        if self.markdown is None:
+            import markdown
+            # Setting up the extensions costs more than converting a typical page
+            self.markdown = markdown.Markdown(extensions=self.markdown_extensions())
+            self.baseline_mb = rss_mb()
+            self.pages = 0
+        self.pages += 1
+        return self.markdown.reset().convert(text)
+
+    def recycle_if_due(self):
+        """Drop the Markdown instance and templates after RENDERER_MAX_PAGES pages, or once the
+        process has grown by RENDERER_MAX_GROWTH_MB; the next page builds new ones"""
+        if self.markdown is None:
+            return
+        if self.pages >= RENDERER_MAX_PAGES or rss_mb() - self.baseline_mb > RENDERER_MAX_GROWTH_MB:
+            self.markdown = None
+            self.templates = None
+
+    def apply_template(self, template_name: str, content: str, frontmatter: Mapping[str, Any], path: Path) -> str:
+        from liquid.exceptions import LiquidError, TemplateNotFoundError
+        if self.templates is None:
+            from liquid import CachingFileSystemLoader, Environment
+            search_path = [str(templates_dir) for templates_dir in self.config.get_templates_search_paths()
+                           if templates_dir.is_dir()]
+            self.templates = Environment(loader=CachingFileSystemLoader(search_path))
+        try:
+            template = self.templates.get_template(template_name)
+            return template.render(content=content, page=dict(frontmatter), title=page_title(frontmatter, path))
+        except TemplateNotFoundError:
+            raise RenderError(f"template not found: {template_name}")
+        except LiquidError as e:
+            raise RenderError(f"template {template_name}: {e}")
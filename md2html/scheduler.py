@@ -0,0 +1,189 @@
+"""
+Build scheduler: runs build jobs in dependency order.
+
+Each job wraps a build target and the function that builds it. A job becomes
+ready once every job it requires has finished. Ready jobs run concurrently:
+markdown rendering is CPU bound and goes to a process pool, and copies mostly
+wait on IO and go to a thread pool. With a single worker, these jobs run inline
+in the main process instead. @src executions always go to the async pool, an
+asyncio subprocess executor, so they run concurrently whatever the worker count.
+
+A job that raises fails on its own, and so do the jobs that require it. The
+other jobs still run, and the failures are returned together at the end.
+
+At most POOL_QUEUE_FACTOR jobs per worker wait in the process and thread pools,
+so that the order of the ready jobs still counts while a build runs: jobs
+returned by the promote callback move to the front, e.g. pages a browser asked
+for, and once the stop callback returns true, no more jobs are started. The jobs
+that never started are left in deferred.
+
+The pools are shut down at the end of each run, unless keep_pools is set, e.g. by
+the daemon, whose render workers then stay warm between builds; the owner of such
+a scheduler calls shutdown() when it is done with it.
+"""
+
+from dataclasses import dataclass, field
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from .buildgraph import BuildTarget, BuildTargetType
+
+# Targets whose jobs are CPU bound, and so run on the process pool rather than the thread pool
+PROCESS_POOL_TYPES = {BuildTargetType.MARKDOWN}
+# Targets whose job functions are coroutine functions, run by the async pool
+ASYNC_POOL_TYPES = {BuildTargetType.EXECUTE}
+# Jobs submitted to the process and thread pools at a time, per worker
+POOL_QUEUE_FACTOR = 2
+
+
+@dataclass(eq=False)
+class Job:
+    target: BuildTarget
+    func: Callable[..., Any] # runs on a worker; must be picklable for process pool targets
+    args: Callable[[], Tuple] # called in the main process when the job is submitted
+    on_done: Optional[Callable[[Any], None]] = None # called in the main process with func's result
+    requires: List['Job'] = field(default_factory=list)
+    required_by: List['Job'] = field(default_factory=list)
+    error: Optional[str] = None
+
+    def describe(self) -> str:
+        return f"{self.target.node_type.value} {self.target.input_file}"
+
+
+def add_requirement(job: Job, required: Job):
+    """Make job wait for required to finish"""
+    job.requires.append(required)
+    required.required_by.append(job)
+
+
+@dataclass
+class Scheduler:
+    workers: int = 1
+    # Run in each process pool worker before its first job, e.g. to build a renderer
+    process_initializer: Optional[Callable[..., None]] = None
+    process_initargs: Tuple = ()
+    # Replace each process pool worker with a fresh one after this many jobs, to bound leaks
+    process_max_tasks: Optional[int] = None
+    process_pool: Any = None # concurrent.futures executors, created on first use
+    thread_pool: Any = None
+    # Runs coroutine functions: submit(func, *args) returns a concurrent.futures.Future.
+    # Owned by the caller, which shuts it down.
+    async_pool: Any = None
+    keep_pools: bool = False # leave the process and thread pools running after run(), for the next run
+    deferred: List[Job] = field(default_factory=list) # jobs of the last run that didn't start because it stopped
+
+    def run(self, jobs: List[Job], promote: Optional[Callable[[], List[Job]]] = None,
+            stop: Optional[Callable[[], bool]] = None) -> List[Job]:
+        """Run the jobs, independent ones concurrently and otherwise in list order.
+        Returns the jobs that failed, including those whose requirements failed."""
+        remaining: Dict[Job, int] = {job: len(job.requires) for job in jobs}
+        ready = deque(job for job in jobs if not job.requires)
+        running: Dict[Any, Job] = {}
+        started: Set[Job] = set()
+        pool_limit = POOL_QUEUE_FACTOR * self.workers
+        stopped = False
+        completed = False
+        broken = False # a worker died, so kept pools are replaced for the next run
+        try:
+            while ready or running:
+                while ready:
+                    if stopped or (stop is not None and stop()):
+                        stopped = True
+                        ready.clear()
+                        break
+                    if promote is not None:
+                        for job in promote():
+                            if job not in started and remaining.get(job) == 0:
+                                ready.appendleft(job)
+                    job = ready[0]
+                    if job in started:
+                        ready.popleft()
+                        continue
+                    pool_job = self.workers > 1 and job.target.node_type not in ASYNC_POOL_TYPES
+                    if pool_job and sum(1 for running_job in running.values()
+                                        if running_job.target.node_type not in ASYNC_POOL_TYPES) >= pool_limit:
+                        break
+                    ready.popleft()
+                    started.add(job)
+                    failed = next((required for required in job.requires if required.error is not None), None)
+                    if failed is not None:
+                        job.error = f"requires {failed.describe()}, which failed"
+                        self.finish(job, None, remaining, ready)
+                    elif self.workers <= 1 and job.target.node_type not in ASYNC_POOL_TYPES:
+                        try:
+                            result = job.func(*job.args())
+                        except Exception as e:
+                            job.error = str(e) or type(e).__name__
+                            result = None
+                        self.finish(job, result, remaining, ready)
+                    else:
+                        try:
+                            running[self.submit(job)] = job
+                        except Exception as e:
+                            # Raised by job.args(), e.g. for a source that vanished, like in the serial path
+                            job.error = str(e) or type(e).__name__
+                            self.finish(job, None, remaining, ready)
+                if running:
+                    from concurrent.futures import BrokenExecutor, wait, FIRST_COMPLETED
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        job = running.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            job.error = str(e) or type(e).__name__
+                            result = None
+                            broken = broken or isinstance(e, BrokenExecutor)
+                        self.finish(job, result, remaining, ready)
+            completed = True
+        finally:
+            if not (self.keep_pools and completed and not broken):
+                self.shutdown()
+
+        self.deferred = [job for job in jobs if job not in started] if stopped else []
+        for job, count in remaining.items():
+            if count > 0 and job.error is None and not stopped:
+                job.error = "dependency cycle"
+        return [job for job in jobs if job.error is not None]
+
+    def submit(self, job: Job) -> Any:
+        if job.target.node_type in ASYNC_POOL_TYPES:
+            pool = self.async_pool
+        elif job.target.node_type in PROCESS_POOL_TYPES:
+            if self.process_pool is None:
+                from concurrent.futures import ProcessPoolExecutor
+                import multiprocessing
+                # Forking while a pool thread is starting a subprocess would leak the subprocess's
+                # pipes into the worker, and hang the thread until the worker exits
+                start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                self.process_pool = ProcessPoolExecutor(max_workers=self.workers, initializer=self.process_initializer,
+                                                        initargs=self.process_initargs,
+                                                        max_tasks_per_child=self.process_max_tasks,
+                                                        mp_context=multiprocessing.get_context(start_method))
+            pool = self.process_pool
+        else:
+            if self.thread_pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.thread_pool = ThreadPoolExecutor(max_workers=self.workers)
+            pool = self.thread_pool
+        return pool.submit(job.func, *job.args())
+
+    def finish(self, job: Job, result: Any, remaining: Dict[Job, int], ready: deque):
+        """Record a finished job and release the jobs waiting for it"""
+        if job.error is None and job.on_done is not None:
+            try:
+                job.on_done(result)
+            except Exception as e:
+                job.error = str(e) or type(e).__name__
+        remaining[job] = 0
+        for dependent in job.required_by:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                ready.append(dependent)
+
+    def shutdown(self):
+        for pool in (self.process_pool, self.thread_pool):
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        self.process_pool = None
+        self.thread_pool = None
@@ -0,0 +1,292 @@
+"""
+Dev server for --serve: serves the output root over HTTP and reloads open pages
+when they are rebuilt.
+
+Pages rendered by the build are published to an OutputStore before they are
+written to disk, and served from there, so a browser can fetch a rebuilt page
+without waiting for the write. Other outputs, like copied assets and pages that
+didn't need rebuilding, are served from disk. Every output the build knows the
+content hash of is served with that hash as its ETag, so a browser revalidating
+an unchanged file gets a 304.
+
+Each HTML response gets a small script that subscribes to server-sent events for
+its own path. When the page's target is published again, the server sends an
+event and the browser reloads.
+
+The store also knows which pages are open, from their event streams, and which
+were just requested. The build renders those first, so the page the author is
+looking at reloads before the rest of a large rebuild is done.
+"""
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set, Tuple
+from pathlib import Path
+import mimetypes
+import os
+import sys
+import threading
+import urllib.parse
+
+from .config import Config
+
+EVENTS_PATH = '/__md2html/events'
+# Seconds between keepalive comments on idle event streams, which also notice closed connections
+KEEPALIVE_INTERVAL = 15.0
+RELOAD_SCRIPT = (f"<script>new EventSource('{EVENTS_PATH}?path=' + encodeURIComponent(location.pathname))"
+                 ".onmessage = () => location.reload();</script>").encode()
+
+
+@dataclass
+class StoredOutput:
+    digest: str # content hash of the output, its ETag
+    data: Optional[bytes] = None # the contents, for outputs published from memory
+    version: int = 0
+
+
+class OutputStore:
+    """The outputs of the build, keyed by their path under the output root. Written
+    by the build on the main thread, and read by the server's request threads."""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.root_prefix = os.path.join(os.path.abspath(root), '')
+        self.outputs: Dict[str, StoredOutput] = {}
+        self.viewers: Dict[str, int] = {} # key -> open event streams of the page
+        self.requested: Dict[str, None] = {} # keys of pages requested since take_requested(), in order
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def key(self, output_path: Path) -> str:
+        path = os.path.abspath(output_path)
+        if path.startswith(self.root_prefix):
+            return path[len(self.root_prefix):]
+        return os.path.relpath(path, self.root)
+
+    def publish(self, output_path: Path, digest: str, data: Optional[bytes] = None):
+        """Record an output that was just built, and wake up the browsers viewing it, unless
+        it was built to the same contents. data holds the contents if they should be
+        served from memory."""
+        key = self.key(output_path)
+        with self.condition:
+            previous = self.outputs.get(key)
+            if previous is not None and previous.digest == digest:
+                previous.data = data
+                return
+            self.outputs[key] = StoredOutput(digest, data, previous.version + 1 if previous else 1)
+            self.condition.notify_all()
+
+    def note(self, output_path: Path, digest: str):
+        """Record the hash of an output that is up to date on disk, without waking anyone"""
+        key = self.key(output_path)
+        with self.condition:
+            if key not in self.outputs:
+                self.outputs[key] = StoredOutput(digest)
+
+    def get(self, key: str) -> Optional[StoredOutput]:
+        with self.condition:
+            return self.outputs.get(key)
+
+    def version(self, key: str) -> int:
+        with self.condition:
+            return self.version_of(key)
+
+    def wait_for_change(self, key: str, version: int, timeout: float) -> int:
+        """Block until the output at key has a version other than version, the store is
+        closed, or timeout passes. Returns the current version."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed or self.version_of(key) != version, timeout)
+            return self.version_of(key)
+
+    def version_of(self, key: str) -> int:
+        output = self.outputs.get(key)
+        return output.version if output else 0
+
+    def request(self, key: str):
+        with self.condition:
+            self.requested[key] = None
+
+    def take_requested(self) -> List[str]:
+        """The keys of the pages requested since the last call"""
+        with self.condition:
+            requested, self.requested = self.requested, {}
+            return list(requested)
+
+    def open_view(self, key: str):
+        with self.condition:
+            self.viewers[key] = self.viewers.get(key, 0) + 1
+            self.requested[key] = None
+
+    def close_view(self, key: str):
+        with self.condition:
+            self.viewers[key] -= 1
+            if not self.viewers[key]:
+                del self.viewers[key]
+
+    def viewed(self) -> Set[str]:
+        """The keys of the pages open in a browser"""
+        with self.condition:
+            return set(self.viewers)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+def inject_reload_script(data: bytes) -> bytes:
+    """Add the live reload script at the end of the body of an HTML page"""
+    position = data.rfind(b'</body>')
+    if position < 0:
+        return data + RELOAD_SCRIPT
+    return data[:position] + RELOAD_SCRIPT + data[position:]
+
+
+def make_handler(store: OutputStore, verbose: bool):
+    from http.server import BaseHTTPRequestHandler
+
+    class DevRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.respond(send_body=True)
+
+        def do_HEAD(self):
+            self.respond(send_body=False)
+
+        def respond(self, send_body: bool):
+            url = urllib.parse.urlsplit(self.path)
+            if url.path == EVENTS_PATH:
+                page = urllib.parse.parse_qs(url.query).get('path', ['/'])[0]
+                self.stream_events(page)
+                return
+            resolved = self.resolve(urllib.parse.unquote(url.path))
+            if resolved is None:
+                self.send_error(404)
+                return
+            key, path = resolved
+            if key.endswith('.html'):
+                store.request(key)
+            data, digest = self.load(key, path)
+            if data is None:
+                self.send_error(404)
+                return
+            etag = f'"{digest}"'
+            if etag in self.headers.get('If-None-Match', ''):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            content_type = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+            if content_type == 'text/html':
+                data = inject_reload_script(data)
+                content_type += '; charset=utf-8'
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            if send_body:
+                self.wfile.write(data)
+
+        def resolve(self, url_path: str) -> Optional[Tuple[str, Path]]:
+            """The store key and disk path of the output a URL path names, or None"""
+            relative = os.path.normpath(url_path.lstrip('/'))
+            if relative == '.':
+                relative = ''
+            if relative.startswith('..') or os.path.isabs(relative):
+                return None
+            candidates = [relative]
+            if url_path.endswith('/') or relative == '' or os.path.isdir(store.root / relative):
+                candidates = [os.path.join(relative, 'index.html')]
+            elif not os.path.splitext(relative)[1]:
+                candidates.append(relative + '.html')
+            for key in candidates:
+                path = store.root / key
+                if store.get(key) is not None or path.is_file():
+                    return key, path
+            return None
+
+        def load(self, key: str, path: Path) -> Tuple[Optional[bytes], str]:
+            output = store.get(key)
+            if output is not None and output.data is not None:
+                return output.data, output.digest
+            try:
+                data = path.read_bytes()
+            except OSError:
+                return None, ''
+            if output is not None:
+                return data, output.digest
+            from .source import content_hash
+            return data, content_hash(data)
+
+        def stream_events(self, page: str):
+            resolved = self.resolve(page)
+            key = resolved[0] if resolved else page.lstrip('/')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+            version = store.version(key)
+            store.open_view(key)
+            try:
+                self.wfile.write(b': connected\n\n')
+                self.wfile.flush()
+                while not store.closed:
+                    current = store.wait_for_change(key, version, KEEPALIVE_INTERVAL)
+                    if store.closed:
+                        break
+                    if current != version:
+                        version = current
+                        self.wfile.write(b'data: reload\n\n')
+                    else:
+                        self.wfile.write(b': keepalive\n\n')
+                    self.wfile.flush()
+            except OSError:
+                pass # the browser went away
+            finally:
+                store.close_view(key)
+
+        def log_message(self, format, *args):
+            if verbose:
+                super().log_message(format, *args)
+
+    return DevRequestHandler
+
+
+class DevServer:
+    """The HTTP server, running on a background thread until stopped"""
+
+    def __init__(self, store: OutputStore, port: int, verbose: bool = False):
+        from http.server import ThreadingHTTPServer
+        self.store = store
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(store, verbose))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        print(f"Serving {self.store.root} at http://127.0.0.1:{self.port}/", file=sys.stderr)
+
+    def stop(self):
+        self.store.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def start_server(config: Config) -> DevServer:
+    """Start serving the output root on config.port. Exits if the port can't be bound."""
+    store = OutputStore(config.output_root())
+    try:
+        server = DevServer(store, config.port, config.verbose)
+    except OSError as e:
+        print(f"Error: Could not serve on port {config.port}: {e}", file=sys.stderr)
+        sys.exit(1)
+    server.start()
+    return server
@@ -0,0 +1,159 @@
+"""
+Source buffers: each input file is read and decoded once per build.
+
+A SourceBuffer holds the decoded text of a markdown file along with the span
+of its frontmatter block and the offset where the body starts, so the
+directive scanner, the frontmatter parser and the render stage can all work
+on the same string without splitting or re-reading it.
+
+With --jobs > 1, the scan workers send each page's buffer back with its metadata,
+and the build sends it on with the page's render job. Partials read by @include
+and @src are still read again by each render worker that uses them, and kept in
+the worker's own store for its next pages.
+"""
+
+from dataclasses import dataclass, field
+from collections import OrderedDict
+from typing import Optional, Tuple
+from pathlib import Path
+import os
+import re
+
+# Matches python-frontmatter's YAML boundary: a line of three or more dashes
+FRONTMATTER_BOUNDARY = re.compile(r'^-{3,}\s*$', re.MULTILINE)
+LEADING_WHITESPACE = re.compile(r'\s*')
+
+
+def content_hash(data: bytes) -> str:
+    """Hash used to recognise unchanged file contents"""
+    import hashlib
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_hash(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    """content_hash of a file of any size, read in chunks"""
+    import hashlib
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def decode_source(data: bytes) -> str:
+    """Decode file contents the way Path.read_text does, including universal newlines"""
+    text = data.decode('utf-8')
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+
+def find_frontmatter(text: str) -> Optional[Tuple[int, int, int]]:
+    """
+    Locate a YAML frontmatter block by offset, without copying the document.
+
+    Returns:
+        (start, end, body_offset) where text[start:end] is the YAML between the
+        `---` lines and the body starts at body_offset, or None if the text has
+        no complete frontmatter block.
+    """
+    opening = FRONTMATTER_BOUNDARY.match(text, LEADING_WHITESPACE.match(text).end())
+    if not opening:
+        return None
+    closing = FRONTMATTER_BOUNDARY.search(text, opening.end())
+    if not closing:
+        return None
+    return opening.end(), closing.start(), closing.end()
+
+
+@dataclass
+class SourceBuffer:
+    """The decoded contents of one markdown file, with its frontmatter located"""
+    path: Optional[Path]
+    text: str
+    digest: str = ''
+    # text[frontmatter_start:frontmatter_end] is the raw frontmatter; both are 0 if there is none
+    frontmatter_start: int = 0
+    frontmatter_end: int = 0
+    body_offset: int = 0
+    # (mtime_ns, size) of the file, taken before it was read: if the file changes
+    # while it is being read, the fingerprint can only look stale, never fresh
+    fingerprint: Tuple[int, int] = (0, 0)
+
+    @classmethod
+    def from_text(cls, text: str, path: Optional[Path] = None, digest: str = '',
+                  fingerprint: Tuple[int, int] = (0, 0)) -> 'SourceBuffer':
+        span = find_frontmatter(text)
+        if span is None:
+            return cls(path, text, digest, fingerprint=fingerprint)
+        return cls(path, text, digest, *span, fingerprint=fingerprint)
+
+    @classmethod
+    def read(cls, path: Path) -> 'SourceBuffer':
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            data = f.read()
+        return cls.from_text(decode_source(data), path, content_hash(data), (st.st_mtime_ns, st.st_size))
+
+    @property
+    def has_frontmatter(self) -> bool:
+        return self.body_offset > 0
+
+    @property
+    def frontmatter_text(self) -> str:
+        return self.text[self.frontmatter_start:self.frontmatter_end]
+
+    @property
+    def body(self) -> str:
+        """The document without its frontmatter, stripped like python-frontmatter's content"""
+        if not self.has_frontmatter:
+            return self.text.strip()
+        return self.text[self.body_offset:].strip()
+
+
+@dataclass
+class SourceStore:
+    """
+    Per-build store of SourceBuffers, so a file read while scanning is not read
+    again when it is rendered. Buffers are evicted least recently used first once
+    the total text size exceeds max_bytes; an evicted file is simply re-read.
+    """
+    max_bytes: int = 64 * 1024 * 1024
+    buffers: 'OrderedDict[Path, SourceBuffer]' = field(default_factory=OrderedDict)
+    total_bytes: int = 0
+    reads: int = 0
+
+    def read(self, path: Path) -> SourceBuffer:
+        """Return the buffer for path, reading the file only if it isn't held already"""
+        source = self.buffers.get(path)
+        if source is not None:
+            self.buffers.move_to_end(path)
+            return source
+        source = SourceBuffer.read(path)
+        self.reads += 1
+        self.add(source)
+        return source
+
+    def add(self, source: SourceBuffer):
+        """Hold a buffer read elsewhere, e.g. by a scan worker or in the process that sent a render job"""
+        self.release(source.path)
+        self.buffers[source.path] = source
+        self.total_bytes += len(source.text)
+        while self.total_bytes > self.max_bytes and len(self.buffers) > 1:
+            _, evicted = self.buffers.popitem(last=False)
+            self.total_bytes -= len(evicted.text)
+
+    def release(self, path: Path) -> Optional[SourceBuffer]:
+        """Remove the buffer for path from the store and return it, or None if it isn't held"""
+        source = self.buffers.pop(path, None)
+        if source is not None:
+            self.total_bytes -= len(source.text)
+        return source
+
+    def take(self, path: Path) -> SourceBuffer:
+        """Return the buffer for path and release it from the store, for a last use such as rendering"""
+        source = self.release(path)
+        if source is None:
+            self.reads += 1
+            return SourceBuffer.read(path)
+        return source
@@ -13,13 +13,21 @@ from pathlib import Path
 from .testsuite import TestContext
 from .testfilepaths import run_filepath_tests
 from .testpreprocessing import run_preprocessing_tests
+from .teststartup import run_startup_tests
+from .testbuild import run_build_tests
+from .testwatch import run_watch_tests
+from .testserve import run_server_tests
+from .testdaemon import run_daemon_tests
 
 # Registry of available test suites
 TEST_SUITES = {
     'filepaths': run_filepath_tests,
     'preprocessing': run_preprocessing_tests,
-    # Future: 'server': run_server_tests,
-    # Future: 'watch': run_watch_tests,
+    'startup': run_startup_tests,
+    'build': run_build_tests,
+    'watch': run_watch_tests,
+    'server': run_server_tests,
+    'daemon': run_daemon_tests,
 }
 
 def main():
@@ -30,6 +38,11 @@ def main():
 Available test suites:
   filepaths      File path and DAG generation tests (default)
   preprocessing  Markdown preprocessing and dependency parsing tests
+  startup        Lazy imports and CLI startup time budget
+  build          Rendering and incremental rebuild tests
+  watch          Debounced watch mode rebuilds
+  server         Dev server, ETags and live reload
+  daemon         Build daemon and --client
 
 Examples:
   python -m md2html.test                    # Run all test suites
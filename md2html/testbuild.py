@@ -0,0 +1,442 @@
+#!/usr/bin/env python3
+"""
+Build tests for md2html
+Renders small sites and checks the outputs and the incremental rebuild manifest
+"""
+
+import json
+import os
+import shutil
+import subprocess
+from functools import partial
+from pathlib import Path
+from typing import Tuple
+
+from .buildgraph import BuildTarget, BuildTargetType
+from .scheduler import Job, Scheduler, add_requirement
+from .testsuite import TestContext, run_command, start_command
+
+def expect_summary(ctx: TestContext, stdout: str, expected: str) -> bool:
+    """Check the build summary line, e.g. 'Build: 1 rendered, 0 copied, 3 unchanged'"""
+    summary = next((line for line in stdout.splitlines() if line.startswith("Build:")), "")
+    ctx.detail(f"Summary: {summary}")
+    if summary != f"Build: {expected}":
+        return ctx.fail_test(f"Expected 'Build: {expected}', got '{summary}'")
+    return ctx.pass_test()
+
+def run_build(ctx: TestContext, name: str, site: Path, expected: str, args=None) -> bool:
+    ctx.test_start(name)
+    success, stdout, stderr = run_command(['-r', 'src', '-o', 'html', '--no-cache'] + (args or []), site)
+    if not success:
+        ctx.detail(f"Error: {stderr[:200]}")
+        return ctx.fail_test("Build failed")
+    return expect_summary(ctx, stdout, expected)
+
+def run_build_tests(ctx: TestContext) -> Tuple[int, int]:
+    """Run all build tests and return (passed, failed) counts"""
+
+    passed_before, failed_before = ctx.passed, ctx.failed
+    project_root = Path(__file__).parent.parent
+    site = project_root / 'tests' / 'build'
+    if site.exists():
+        shutil.rmtree(site)
+    (site / 'src' / 'notes').mkdir(parents=True)
+    (site / 'templates').mkdir()
+    (site / 'src' / 'index.md').write_text(
+        "---\ntitle: Home\n---\n# Welcome\n\n@include(_intro.md)\n\n@src(notes/hello.py, lines=2-3)\n")
+    (site / 'src' / '_intro.md').write_text("Intro with **bold** text.\n")
+    (site / 'src' / 'notes' / 'hello.py').write_text("import sys\nprint('hello')\nprint('world')\n")
+    (site / 'src' / 'notes' / 'page.md').write_text("---\ntemplate: plain.html\n---\n# Plain page\n")
+    (site / 'templates' / 'plain.html').write_text("<title>{{ title }}</title>\n{{ content }}\n")
+    html = site / 'html'
+
+    ctx.print_header("Rendering")
+    run_build(ctx, "First build renders pages and copies files", site, "2 rendered, 1 copied, 0 unchanged (files: 3 written, 0 unchanged)")
+
+    ctx.test_start("Includes, source listings and templates are applied")
+    index = (html / 'index.html').read_text() if (html / 'index.html').exists() else ""
+    page = (html / 'notes' / 'page.html').read_text() if (html / 'notes' / 'page.html').exists() else ""
+    if ("<strong>bold</strong>" in index and '<span class="nb">print</span>' in index and "import" not in index
+            and '<div class="codehilite">' in index
+            and "<title>Home</title>" in index and page.startswith("<title>page</title>")
+            and "<h1>Plain page</h1>" in page and (html / 'notes' / 'hello.py').exists()
+            and (html / '.md2html-manifest.json').exists()):
+        ctx.pass_test()
+    else:
+        ctx.fail_test("Unexpected output contents")
+
+    ctx.test_start("One Markdown instance is reset and reused between pages")
+    from .config import Config
+    from .render import PageRenderer
+    renderer = PageRenderer(Config(invoked_from=site, bundle_root=project_root))
+    first = renderer.render(site / 'src' / 'index.md', {'title': 'Home'}).html
+    instance = renderer.markdown
+    renderer.render(site / 'src' / 'notes' / 'page.md', {'template': 'plain.html'})
+    again = renderer.render(site / 'src' / 'index.md', {'title': 'Home'}).html
+    if renderer.markdown is not instance:
+        ctx.fail_test("Markdown instance was rebuilt")
+    elif again != first or "Plain page" in again:
+        ctx.fail_test("State leaked between pages")
+    else:
+        ctx.pass_test()
+
+    ctx.test_start("The Markdown instance is rebuilt after RENDERER_MAX_PAGES pages")
+    from .render import RENDERER_MAX_PAGES
+    renderer.pages = RENDERER_MAX_PAGES - 1
+    renderer.render(site / 'src' / 'index.md', {'title': 'Home'})
+    recycled = renderer.markdown is None
+    renderer.render(site / 'src' / 'index.md', {'title': 'Home'})
+    if not recycled or renderer.markdown is None or renderer.pages != 1:
+        ctx.fail_test(f"Expected a new instance with one page, got {renderer.pages} pages")
+    else:
+        ctx.pass_test()
+
+    ctx.test_start("Highlighted code blocks are reused from the disk cache")
+    cache_dir = site / 'cache'
+    cold = PageRenderer(Config(invoked_from=site, bundle_root=project_root, cache_dir=cache_dir))
+    cold_html = cold.render(site / 'src' / 'index.md', {'title': 'Home'}).html
+    warm = PageRenderer(Config(invoked_from=site, bundle_root=project_root, cache_dir=cache_dir))
+    warm_html = warm.render(site / 'src' / 'index.md', {'title': 'Home'}).html
+    ctx.detail(f"Cold: {cold.highlighter.misses} misses, warm: {warm.highlighter.hits} hits, {warm.highlighter.misses} misses")
+    if (cold.highlighter.misses, warm.highlighter.hits, warm.highlighter.misses) != (1, 1, 0):
+        ctx.fail_test("Expected the second renderer to highlight nothing")
+    elif warm_html != cold_html or warm_html != first:
+        ctx.fail_test("Cached highlighting changed the page")
+    else:
+        ctx.pass_test()
+
+    ctx.test_start("Math is converted in one batch and cached across builds")
+    math_page = site / 'math.md'
+    math_page.write_text("# Math\n\n$x^2$, $x^2$ and `$code$` cost $5 and $6.\n\n$$\n\\frac{a}{b}\n$$\n\n"
+                         "A stray ` backtick.\n\nMath after it: $x^2$.\n")
+    cold_html = cold.render(math_page, {}).html
+    warm.render(math_page, {'title': 'Edited prose only'})
+    ctx.detail(f"Cold: {cold.math.calls} calls, {cold.math.misses} misses; warm: {warm.math.calls} calls, {warm.math.hits} hits")
+    if (cold.math.calls, cold.math.misses, warm.math.calls, warm.math.hits) != (1, 2, 0, 4):
+        ctx.fail_test("Expected one backend call for two expressions, then none")
+    elif warm.math.backend is not None:
+        ctx.fail_test("The backend was set up although all the math was cached")
+    elif cold_html.count('<math ') != 4 or '<code>$code$</code>' not in cold_html or '$5 and $6' not in cold_html:
+        ctx.fail_test("Math was not converted as expected")
+    else:
+        ctx.pass_test()
+    math_page.unlink()
+    shutil.rmtree(cache_dir)
+
+    ctx.print_header("Incremental Rebuilds")
+    index_mtime = (html / 'index.html').stat().st_mtime_ns
+    run_build(ctx, "No-op rebuild skips every target", site, "0 rendered, 0 copied, 3 unchanged (files: 0 written, 3 unchanged)")
+
+    ctx.test_start("No-op rebuild leaves outputs untouched")
+    if (html / 'index.html').stat().st_mtime_ns == index_mtime:
+        ctx.pass_test()
+    else:
+        ctx.fail_test("index.html was rewritten")
+
+    intro = site / 'src' / '_intro.md'
+    os.utime(intro, ns=(intro.stat().st_atime_ns, intro.stat().st_mtime_ns + 10**9))
+    run_build(ctx, "Touched file with unchanged content is skipped", site, "0 rendered, 0 copied, 3 unchanged (files: 0 written, 3 unchanged)")
+
+    intro.write_text("Edited intro.\n")
+    run_build(ctx, "Editing an include re-renders only the page using it", site, "1 rendered, 0 copied, 2 unchanged (files: 1 written, 2 unchanged)")
+
+    (site / 'templates' / 'plain.html').write_text("<title>{{ title }}!</title>\n{{ content }}\n")
+    run_build(ctx, "Editing a template re-renders every page", site,
+              "2 rendered, 0 copied, 1 unchanged (files: 1 written, 2 unchanged)")
+
+    (html / 'notes' / 'hello.py').unlink()
+    run_build(ctx, "Deleted output is rebuilt", site, "0 rendered, 1 copied, 2 unchanged (files: 1 written, 2 unchanged)")
+
+    ctx.print_header("Copies")
+    copied = html / 'notes' / 'hello.py'
+    source = site / 'src' / 'notes' / 'hello.py'
+    copied_mtime = copied.stat().st_mtime_ns
+    index_mtime = (html / 'index.html').stat().st_mtime_ns
+    (html / '.md2html-manifest.json').unlink()
+    run_build(ctx, "Identical outputs are left alone without a manifest", site,
+              "2 rendered, 0 copied, 1 unchanged (files: 0 written, 3 unchanged)")
+
+    ctx.test_start("Pages rendered to the same HTML are not rewritten")
+    if (html / 'index.html').stat().st_mtime_ns == index_mtime:
+        ctx.pass_test()
+    else:
+        ctx.fail_test("index.html was rewritten")
+
+    ctx.test_start("Copies keep the mtime of their input")
+    if copied.stat().st_mtime_ns == copied_mtime == source.stat().st_mtime_ns:
+        ctx.pass_test()
+    else:
+        ctx.fail_test("hello.py was rewritten, or has a different mtime")
+
+    run_build(ctx, "--link-assets replaces copies with links", site,
+              "0 rendered, 1 copied, 2 unchanged (files: 1 written, 2 unchanged)", ['--link-assets'])
+    ctx.test_start("Linked output is the input file, and isn't hashed")
+    manifest = json.loads((html / '.md2html-manifest.json').read_text())['outputs']
+    entry = next((entry for entry in manifest.values() if entry['input'].endswith('hello.py')), None)
+    if copied.stat().st_ino != source.stat().st_ino:
+        ctx.fail_test("hello.py is not a hardlink of its input")
+    elif entry is None or entry['input_state'][2] is not None or entry['output_state'][2] is not None:
+        ctx.fail_test(f"Unexpected manifest entry: {entry}")
+    else:
+        ctx.pass_test()
+
+    run_build(ctx, "Without --link-assets, links become copies again", site,
+              "0 rendered, 1 copied, 2 unchanged (files: 1 written, 2 unchanged)")
+    ctx.test_start("Copying over a link leaves the input intact")
+    if copied.stat().st_ino != source.stat().st_ino and source.read_text() == copied.read_text():
+        ctx.pass_test()
+    else:
+        ctx.fail_test("hello.py is still linked, or its input changed")
+
+    intro.write_text("Edited intro, synced.\n")
+    run_build(ctx, "--fsync flushes the written files", site,
+              "1 rendered, 0 copied, 2 unchanged (files: 1 written, 2 unchanged)", ['--fsync'])
+    ctx.test_start("No temporary files are left in the output")
+    leftovers = [path.name for path in html.rglob('*.tmp')]
+    if leftovers:
+        ctx.fail_test(f"Left behind: {leftovers}")
+    else:
+        ctx.pass_test()
+
+    ctx.print_header("Errors")
+    ctx.test_start("Missing include fails that page only")
+    (site / 'src' / 'broken.md').write_text("@include(missing.md)\n")
+    success, stdout, stderr = run_command(['-r', 'src', '-o', 'html', '--no-cache'], site)
+    if success:
+        ctx.fail_test("Should have failed")
+    elif "missing.md" not in stderr:
+        ctx.fail_test(f"Error message missing the include: {stderr[:200]}")
+    else:
+        expect_summary(ctx, stdout, "0 rendered, 0 copied, 3 unchanged, 1 failed (files: 0 written, 3 unchanged)")
+
+    (site / 'src' / 'broken.md').unlink()
+
+    ctx.print_header("Scheduling")
+    index_text = (html / 'index.html').read_text() if (html / 'index.html').exists() else ""
+    shutil.rmtree(html)
+    run_build(ctx, "Parallel build renders pages and copies files", site, "2 rendered, 1 copied, 0 unchanged (files: 3 written, 0 unchanged)", ['-j', '2'])
+
+    ctx.test_start("Parallel build writes the same pages")
+    if (html / 'index.html').exists() and (html / 'index.html').read_text() == index_text:
+        ctx.pass_test()
+    else:
+        ctx.fail_test("index.html differs from the serial build")
+
+    ctx.test_start("A parallel job whose arguments fail fails on its own, with the jobs requiring it")
+    def vanished() -> Tuple:
+        raise FileNotFoundError("gone.txt vanished")
+    broken = Job(BuildTarget.from_paths(BuildTargetType.COPY, Path('gone.txt')), len, vanished)
+    dependent = Job(BuildTarget.from_paths(BuildTargetType.COPY, Path('after.txt')), len, partial(tuple, ('a',)))
+    other = Job(BuildTarget.from_paths(BuildTargetType.COPY, Path('other.txt')), len, partial(tuple, ('b',)))
+    add_requirement(dependent, broken)
+    try:
+        failed = Scheduler(2).run([broken, dependent, other])
+    except Exception as e:
+        ctx.fail_test(f"The build was aborted: {e}")
+    else:
+        if failed != [broken, dependent] or "vanished" not in (broken.error or ""):
+            ctx.fail_test(f"Unexpected failures: {[(job.target.input_file, job.error) for job in failed]}")
+        else:
+            ctx.pass_test()
+
+    ctx.test_start("A scheduler that keeps its pools renders on the same workers in each run")
+    kept = Scheduler(2, keep_pools=True)
+    pids = []
+    try:
+        for _ in range(2):
+            run_pids = set()
+            kept.run([Job(BuildTarget.from_paths(BuildTargetType.MARKDOWN, Path(f'page{i}.md')), os.getpid, tuple,
+                          run_pids.add) for i in range(4)])
+            pids.append(run_pids)
+    finally:
+        kept.shutdown()
+    ctx.detail(f"Worker pids: {pids}")
+    if not pids[1] or not pids[1] <= pids[0]:
+        ctx.fail_test("The second run started new workers")
+    elif kept.process_pool is not None:
+        ctx.fail_test("shutdown() left the pool running")
+    else:
+        ctx.pass_test()
+
+    (site / 'src' / 'notes' / 'run.md').write_text("# Run\n\n@src(count.py, run=true)\n")
+    (site / 'src' / 'notes' / 'count.py').write_text("print(6 * 7)\nprint('<done>')\n")
+    (site / 'src' / 'notes' / 'fails.md').write_text("# Fails\n\n@src(fail.py, run=true)\n")
+    (site / 'src' / 'notes' / 'fail.py').write_text("import sys\nsys.exit('boom')\n")
+    ctx.test_start("Executed sources run before the pages embedding them")
+    success, stdout, stderr = run_command(['-r', 'src', '-o', 'html', '--no-cache', '-e', '-j', '2'], site)
+    run_page = (html / 'notes' / 'run.html').read_text() if (html / 'notes' / 'run.html').exists() else ""
+    if success:
+        ctx.fail_test("Should have failed")
+    elif '<div class="code-output"><pre>42\n&lt;done&gt;</pre></div>' not in run_page:
+        ctx.fail_test("Output of count.py missing from run.html")
+    else:
+        ctx.pass_test()
+
+    ctx.test_start("A failed execution fails only the pages embedding it, in one error list")
+    errors = stderr[stderr.find("Errors"):]
+    ctx.detail(f"Errors: {errors.strip()}")
+    if not errors.startswith("Errors (2):") or "boom" not in errors or "requires execute" not in errors:
+        ctx.fail_test(f"Unexpected error list: {stderr[:300]}")
+    elif errors.find("boom") > errors.find("requires execute"):
+        ctx.fail_test(f"Errors are not in graph order: {errors.strip()}")
+    elif (html / 'notes' / 'fails.html').exists():
+        ctx.fail_test("fails.html should not have been written")
+    else:
+        expect_summary(ctx, stdout, "3 rendered, 2 copied, 1 unchanged, 2 failed (files: 3 written, 3 unchanged)")
+
+    (site / 'src' / 'notes' / 'fails.md').unlink()
+    cached_page = site / 'src' / 'notes' / 'cached.md'
+    cached_page.write_text("# Cached\n\n@src(counted.py, run=true, artifacts=plot.txt)\n")
+    (site / 'src' / 'notes' / 'counted.py').write_text(
+        "open('../../runs.txt', 'a').write('run\\n')\nopen('plot.txt', 'w').write('plot')\nprint('counted')\n")
+    cache_args = ['-r', 'src', '-o', 'html', '--cache-dir', 'cache', '-e']
+
+    def runs_after_build(args) -> int:
+        success, _, stderr = run_command(args, site)
+        if not success:
+            ctx.detail(f"Error: {stderr[:200]}")
+        cached_html = (html / 'notes' / 'cached.html').read_text() if (html / 'notes' / 'cached.html').exists() else ""
+        if "counted" not in cached_html:
+            ctx.detail("Output of counted.py missing from cached.html")
+            return -1
+        return len((site / 'runs.txt').read_text().splitlines()) if (site / 'runs.txt').exists() else 0
+
+    ctx.test_start("Unchanged sources are served from the execution cache")
+    first_runs = runs_after_build(cache_args)
+    cached_page.write_text("# Cached, edited\n\n@src(counted.py, run=true, artifacts=plot.txt)\n")
+    (site / 'src' / 'notes' / 'plot.txt').unlink()
+    second_runs = runs_after_build(cache_args)
+    ctx.detail(f"Runs after first build: {first_runs}, after prose edit: {second_runs}")
+    if (first_runs, second_runs) != (1, 1):
+        ctx.fail_test("counted.py should have run exactly once")
+    elif not (site / 'src' / 'notes' / 'plot.txt').exists():
+        ctx.fail_test("Cached artifact plot.txt was not restored")
+    else:
+        ctx.pass_test()
+
+    ctx.test_start("--reexecute runs sources again")
+    cached_page.write_text("# Cached, edited again\n\n@src(counted.py, run=true, artifacts=plot.txt)\n")
+    if runs_after_build(cache_args + ['--reexecute']) != 2:
+        ctx.fail_test("counted.py should have run again")
+    else:
+        ctx.pass_test()
+
+    cached_page.unlink()
+    (site / 'src' / 'notes' / 'flaky.md').write_text("# Flaky\n\n@src(flaky.py, run=true)\n")
+    (site / 'src' / 'notes' / 'flaky.py').write_text(
+        "import os, sys\nif not os.path.exists('ready.txt'):\n    sys.exit('not ready')\nprint('ready')\n")
+    ctx.test_start("Failed runs are not cached")
+    failed_first, _, _ = run_command(cache_args, site)
+    (site / 'src' / 'notes' / 'ready.txt').write_text("")
+    succeeded, _, stderr = run_command(cache_args, site)
+    flaky = (html / 'notes' / 'flaky.html').read_text() if (html / 'notes' / 'flaky.html').exists() else ""
+    if failed_first or not succeeded or "<pre>ready</pre>" not in flaky:
+        ctx.fail_test(f"flaky.py should have run again once it could succeed: {stderr[:300]}")
+    else:
+        ctx.pass_test()
+    (site / 'src' / 'notes' / 'flaky.md').unlink()
+    (site / 'src' / 'notes' / 'ready.txt').unlink()
+    notes = site / 'src' / 'notes'
+    for i in range(4):
+        (notes / f'sleep{i}.py').write_text(f"import time\ntime.sleep(1)\nprint('slept {i}')\n")
+    (notes / 'hello.c').write_text('#include <stdio.h>\nint main(void) { printf("compiled\\n"); return 0; }\n')
+    (notes / 'slow.py').write_text("import time\ntime.sleep(30)\n")
+    (notes / 'many.md').write_text("# Many\n\n" + "".join(f"@src(sleep{i}.py, run=true)\n\n" for i in range(4))
+                                   + "@src(hello.c, run=true)\n")
+    (notes / 'slow.md').write_text("# Slow\n\n@src(slow.py, run=true, timeout=1)\n")
+    ctx.test_start("Sources of a page run concurrently, with per-run timeouts")
+    import time
+    start = time.perf_counter()
+    success, stdout, stderr = run_command(['-r', 'src', '-o', 'html', '--no-cache', '-e'], site)
+    elapsed = time.perf_counter() - start
+    many = (html / 'notes' / 'many.html').read_text() if (html / 'notes' / 'many.html').exists() else ""
+    ctx.detail(f"Build took {elapsed:.1f} s")
+    if not all(f"slept {i}" in many for i in range(4)) or "compiled" not in many:
+        ctx.fail_test(f"Missing outputs in many.html: {stderr[:300]}")
+    elif "timed out after 1 s" not in stderr:
+        ctx.fail_test(f"slow.py should have timed out: {stderr[:300]}")
+    elif elapsed > 3.5:
+        ctx.fail_test("Four 1 s sources and a 1 s timeout should not take this long")
+    else:
+        ctx.pass_test()
+
+    (notes / 'many.md').unlink()
+    (notes / 'slow.md').unlink()
+    (notes / 'hang.py').write_text("import os, time\nopen('hang.pid', 'w').write(str(os.getpid()))\ntime.sleep(60)\n")
+    (notes / 'hang.md').write_text("# Hang\n\n@src(hang.py, run=true)\n")
+    ctx.test_start("Interrupting a build kills the sources it is running")
+    import signal
+    build = start_command(['-r', 'src', '-o', 'html', '--no-cache', '-e'], site)
+    pid_file = notes / 'hang.pid'
+    deadline = time.monotonic() + 10
+    while not (pid_file.exists() and pid_file.read_text()) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    build.send_signal(signal.SIGINT)
+    try:
+        build.communicate(timeout=10)
+    except subprocess.TimeoutExpired:
+        build.kill()
+        build.communicate()
+    hang_pid = int(pid_file.read_text()) if pid_file.exists() and pid_file.read_text() else None
+    try:
+        alive = hang_pid is not None and (os.kill(hang_pid, 0) or True)
+    except ProcessLookupError:
+        alive = False
+    if hang_pid is None:
+        ctx.fail_test("hang.py never started")
+    elif alive:
+        os.kill(hang_pid, signal.SIGKILL)
+        ctx.fail_test("hang.py was left running")
+    else:
+        ctx.pass_test()
+    (notes / 'hang.md').unlink()
+    pid_file.unlink(missing_ok=True)
+    session_page = notes / 'session.md'
+    first_block = "@src_begin(run=true)\nopen('../../blocks.txt', 'a').write('first\\n')\nimport math\nx = 21\n@src_end\n"
+    session_page.write_text(f"# Session\n\n{first_block}\nProse.\n\n@src_begin(run=true)\nprint(x * 2)\n@src_end\n")
+
+    def blocks_after_build() -> Tuple[str, int]:
+        success, _, stderr = run_command(cache_args, site)
+        if not success:
+            ctx.detail(f"Error: {stderr[:300]}")
+        page = (html / 'notes' / 'session.html').read_text() if (html / 'notes' / 'session.html').exists() else ""
+        outputs = [line for line in page.splitlines() if line.startswith('<div class="code-output">')]
+        runs = len((site / 'blocks.txt').read_text().splitlines()) if (site / 'blocks.txt').exists() else 0
+        return outputs[-1] if outputs else "", runs
+
+    ctx.test_start("Session blocks share state, and only blocks from the first edited one run again")
+    first_output, first_runs = blocks_after_build()
+    session_page.write_text(f"# Session\n\n{first_block}\nProse.\n\n@src_begin(run=true)\nprint(x * 3, math.e > 2)\n@src_end\n")
+    second_output, second_runs = blocks_after_build()
+    ctx.detail(f"Outputs: {first_output!r}, {second_output!r}; first block ran {second_runs} times")
+    if "<pre>42</pre>" not in first_output or "<pre>63 True</pre>" not in second_output:
+        ctx.fail_test("Second block should see the first block's names")
+    elif (first_runs, second_runs) != (1, 1):
+        ctx.fail_test("The unchanged first block should have been restored from the cache")
+    else:
+        ctx.pass_test()
+
+    session_page.unlink()
+    replay_page = notes / 'replay.md'
+    # The function leaves no snapshot, so the first block is run again for the second
+    replay_block = ("@src_begin(run=true)\nimport os\ndef double(n):\n    return 2 * n\n"
+                    "assert os.path.exists('ready.txt'), 'not ready'\n@src_end\n")
+    replay_page.write_text(f"# Replay\n\n{replay_block}\n@src_begin(run=true)\nprint(double(2))\n@src_end\n")
+    (notes / 'ready.txt').write_text("")
+    ctx.test_start("A block that fails when it is run again is reported at its own line")
+    built, _, _ = run_command(cache_args, site)
+    (notes / 'ready.txt').unlink()
+    replay_page.write_text(f"# Replay\n\n{replay_block}\n@src_begin(run=true)\nprint(double(3))\n@src_end\n")
+    failed, _, stderr = run_command(cache_args, site)
+    ctx.detail(f"Error: {stderr.strip()[:300]}")
+    if not built or failed:
+        ctx.fail_test("The first build should succeed and the second fail")
+    elif "block at line 3 failed" not in stderr or "not ready" not in stderr:
+        ctx.fail_test("The error should point at the first block")
+    else:
+        ctx.pass_test()
+
+    if not ctx.keep_files:
+        shutil.rmtree(site)
+
+    return ctx.passed - passed_before, ctx.failed - failed_before
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Daemon tests for md2html
+Starts `md2html --daemon` on a small site and runs commands on it with --client
+"""
+
+import json
+import os
+import shutil
+import socket
+import threading
+import subprocess
+import time
+from pathlib import Path
+from typing import Tuple
+
+from .testsuite import TestContext, run_command, start_command
+from .teststartup import imported_modules
+
+def wait_for_socket(socket_path: Path, timeout: float = 10.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if socket_path.exists():
+            return True
+        time.sleep(0.02)
+    return False
+
+def parent_pid(pid: int) -> int:
+    """The parent of a process, or 0 if it is gone"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return int(f.read().rsplit(')', 1)[1].split()[1])
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def run_daemon_tests(ctx: TestContext) -> Tuple[int, int]:
+    """Run all daemon tests and return (passed, failed) counts"""
+
+    passed_before, failed_before = ctx.passed, ctx.failed
+    project_root = Path(__file__).parent.parent
+    site = project_root / 'tests' / 'daemon'
+    if site.exists():
+        shutil.rmtree(site)
+    src = site / 'src'
+    src.mkdir(parents=True)
+    (src / 'index.md').write_text("# Home\n\n@include(_shared.md)\n")
+    (src / 'about.md').write_text("# About\n")
+    (src / '_shared.md').write_text("Shared text.\n")
+    socket_path = site / '.md2html-cache' / 'daemon.sock'
+    build_args = ['--client', '-r', 'src', '-o', 'html']
+
+    ctx.print_header("Daemon")
+    ctx.test_start("Client without a daemon reports an error")
+    success, _, stderr = run_command(build_args, site)
+    if success or "No md2html daemon" not in stderr:
+        ctx.fail_test(f"Unexpected result: {success}, {stderr.strip()}")
+    else:
+        ctx.pass_test()
+
+    daemon = start_command(['--daemon'], site)
+    try:
+        ctx.test_start("Daemon listens on the socket in the cache directory")
+        if not wait_for_socket(socket_path):
+            ctx.fail_test("Socket was not created")
+        else:
+            ctx.pass_test()
+
+        ctx.test_start("First build on the daemon")
+        success, stdout, stderr = run_command(build_args, site)
+        if not success or stdout.strip() != "Build: 2 rendered, 0 copied, 0 unchanged (files: 2 written, 0 unchanged)":
+            ctx.fail_test(f"Unexpected output: {stdout.strip()} {stderr.strip()}")
+        elif "Shared text." not in (site / 'html' / 'index.html').read_text():
+            ctx.fail_test("index.html was not rendered")
+        else:
+            ctx.pass_test()
+
+        ctx.test_start("Repeated build reuses the warm session")
+        start = time.perf_counter()
+        success, stdout, stderr = run_command(build_args, site)
+        ctx.detail(f"Client call took {(time.perf_counter() - start) * 1000:.0f} ms")
+        if not success or stdout.strip() != "Build: 0 rendered, 0 copied, 2 unchanged (files: 0 written, 2 unchanged)":
+            ctx.fail_test(f"Unexpected output: {stdout.strip()} {stderr.strip()}")
+        else:
+            ctx.pass_test()
+
+        ctx.test_start("Edits are picked up by the next build")
+        (src / '_shared.md').write_text("Shared text, edited.\n")
+        time.sleep(0.2)
+        success, stdout, stderr = run_command(build_args, site)
+        if not success or stdout.strip() != "Build: 1 rendered, 0 copied, 1 unchanged (files: 1 written, 1 unchanged)":
+            ctx.fail_test(f"Unexpected output: {stdout.strip()} {stderr.strip()}")
+        elif "edited" not in (site / 'html' / 'index.html').read_text():
+            ctx.fail_test("index.html does not have the edited partial")
+        else:
+            ctx.pass_test()
+
+        ctx.test_start("New pages are scanned by the next build")
+        (src / 'new.md').write_text("# New\n")
+        time.sleep(0.2)
+        success, stdout, stderr = run_command(build_args, site)
+        if not success or stdout.strip() != "Build: 1 rendered, 0 copied, 2 unchanged (files: 1 written, 2 unchanged)":
+            ctx.fail_test(f"Unexpected output: {stdout.strip()} {stderr.strip()}")
+        else:
+            ctx.pass_test()
+
+        ctx.test_start("Dry runs and --affected share the session, and stdin is forwarded")
+        success, stdout, _ = run_command(build_args + ['--dry-run'], site)
+        nodes = json.loads(stdout)['nodes'] if success else []
+        success, affected, stderr = run_command(build_args + ['--affected', '-', '--format', 'ndjson'], site,
+                                                stdin="src/_shared.md\n")
+        affected = [json.loads(line)['input'] for line in affected.splitlines()] if success else []
+        ctx.detail(f"{len(nodes)} nodes, affected: {affected}")
+        if sorted(node['input'] for node in nodes) != ['src/about.md', 'src/index.md', 'src/new.md']:
+            ctx.fail_test(f"Unexpected dry run graph: {nodes}")
+        elif not any(path.endswith('index.md') for path in affected) or any(path.endswith('about.md') for path in affected):
+            ctx.fail_test(f"Unexpected affected targets: {affected} {stderr.strip()}")
+        else:
+            ctx.pass_test()
+
+        ctx.test_start("Errors are streamed back with the exit status")
+        success, _, stderr = run_command(['--client', 'missing.md'], site)
+        if success or "does not exist" not in stderr:
+            ctx.fail_test(f"Unexpected result: {success}, {stderr.strip()}")
+        else:
+            ctx.pass_test()
+
+        ctx.test_start("A client that sends nothing doesn't block the daemon")
+        idle = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        idle.connect(str(socket_path))
+        # Gives up on the daemon rather than hanging the tests if it waits for the idle client
+        release = threading.Timer(15, idle.close)
+        release.start()
+        try:
+            start = time.perf_counter()
+            success, stdout, stderr = run_command(build_args, site)
+            elapsed = time.perf_counter() - start
+        finally:
+            release.cancel()
+            idle.close()
+        ctx.detail(f"Client call took {elapsed * 1000:.0f} ms")
+        if not success or not stdout.startswith("Build:"):
+            ctx.fail_test(f"Unexpected output: {stdout.strip()} {stderr.strip()}")
+        elif elapsed > 10:
+            ctx.fail_test("The command waited too long for the idle client")
+        else:
+            ctx.pass_test()
+
+        ctx.test_start("Builds with --jobs keep their render workers between commands")
+        for i in range(2):
+            (src / 'about.md').write_text(f"# About, take {i}\n")
+            time.sleep(0.2)
+            success, stdout, stderr = run_command(build_args + ['-j', '2'], site)
+        # Render workers are started by the forkserver, a child of the daemon
+        workers = [pid for pid in os.listdir('/proc') if pid.isdigit() and parent_pid(parent_pid(int(pid))) == daemon.pid]
+        ctx.detail(f"{len(workers)} render workers after the command")
+        if not success or "1 rendered" not in stdout:
+            ctx.fail_test(f"Unexpected output: {stdout.strip()} {stderr.strip()}")
+        elif not workers:
+            ctx.fail_test("The render workers were shut down after the command")
+        else:
+            ctx.pass_test()
+
+        ctx.test_start("The client doesn't import the build modules")
+        modules = imported_modules(build_args, site)
+        if 'md2html.client' not in modules:
+            ctx.fail_test("Could not collect import timings")
+        elif 'md2html.buildgraph' in modules or 'md2html.daemon' in modules:
+            ctx.fail_test(f"Imported: {sorted(module for module in modules if module.startswith('md2html.'))}")
+        else:
+            ctx.pass_test()
+
+        ctx.test_start("Stopping the daemon during a command fails the command")
+        (src / 'hang.py').write_text("import os, time\nopen('hang.pid', 'w').write(str(os.getpid()))\ntime.sleep(60)\n")
+        (src / 'hang.md').write_text("# Hang\n\n@src(hang.py, run=true)\n")
+        client = start_command(build_args + ['-e'], site)
+        deadline = time.monotonic() + 10
+        while not (src / 'hang.pid').exists() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        daemon.terminate()
+        try:
+            _, stderr = client.communicate(timeout=10)
+            daemon.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            client.kill()
+            stderr = ''
+        ctx.detail(f"Client exited with {client.returncode}, daemon with {daemon.poll()}")
+        if client.returncode == 0 or "stopped" not in stderr:
+            ctx.fail_test(f"Expected a failed command, got {client.returncode}: {stderr.strip()}")
+        elif daemon.poll() is None:
+            ctx.fail_test("The daemon kept running")
+        else:
+            ctx.pass_test()
+    finally:
+        daemon.terminate()
+        daemon.wait(timeout=5)
+
+    ctx.test_start("Stopping the daemon removes its socket")
+    if socket_path.exists():
+        ctx.fail_test("Socket is left behind")
+    else:
+        ctx.pass_test()
+
+    if not ctx.keep_files:
+        shutil.rmtree(site)
+
+    return ctx.passed - passed_before, ctx.failed - failed_before
@@ -308,6 +308,16 @@ def run_filepath_tests(ctx: TestContext) -> Tuple[int, int]:
                      expected_outputs=['build/a/b/c/d/deep.html', 'build/readme.html', 'build/README.html'],
                      should_ignore=['_templates', '.github'])
 
+    # Symlinked directories, including one pointing back at an ancestor
+    (config3 / 'a' / 'b' / 'loop').symlink_to('..', target_is_directory=True)
+    (config3 / 'linked').symlink_to('a/b/c', target_is_directory=True)
+    test_dag_command(ctx, "Symlinked directories and symlink loops",
+                     ['-r', '.', '-o', 'build', '--dry-run'], config3,
+                     expected_outputs=['build/a/b/c/d/deep.html', 'build/linked/d/deep.html'],
+                     not_expected=['build/a/b/loop/b/c/d/deep.html'])
+    (config3 / 'a' / 'b' / 'loop').unlink()
+    (config3 / 'linked').unlink()
+
     # Add file with spaces dynamically
     (config1 / 'file with space.md').write_text('# File with space')
     test_dag_command(ctx, "File with spaces in name",
@@ -388,7 +398,7 @@ def run_filepath_tests(ctx: TestContext) -> Tuple[int, int]:
 
     # Parent directory invocation
     test_dag_command(ctx, "Invocation from parent directory",
-                     ['-r', 'tests/config1/html', '-o', 'tests/config1/output', '--dry-run'],
+                     ['-r', 'tests/config1/html', '-o', 'tests/config1/output', '--dry-run', '--no-cache'],
                      project_root,
                      expected_outputs=['tests/config1/output/index.html'])
 
@@ -4,12 +4,19 @@ Markdown preprocessing tests for md2html
 Tests dependency parsing, frontmatter parsing, and custom directives
 """
 
+import io
 import json
 import shutil
+import sys
 from pathlib import Path
 from typing import Dict, List, Set, Tuple, Any
 
 from .testsuite import TestContext, run_command
+from .config import Config
+from .buildgraph import BuildTargets, handle_target
+from .markdown_preprocessing import parse_frontmatter
+from .source import SourceBuffer
+from .md2html import stream_node
 
 def parse_build_targets(output: str) -> Dict:
     """Parse the JSON build targets output"""
@@ -60,7 +67,7 @@ def test_basic_dependencies(ctx: TestContext, test_dir: Path) -> bool:
 Some content here.
 """)
     
-    success, stdout, stderr = run_command(['--dry-run', str(test_md)])
+    success, stdout, stderr = run_command(['--dry-run', '--no-cache', str(test_md)])
     
     if not success:
         ctx.print(f"✗ Test {ctx.current_test}: Command failed: {stderr}", 'fail')
@@ -97,7 +104,7 @@ author: Test Author
 Some markdown content.
 """)
     
-    success, stdout, stderr = run_command(['--dry-run', str(test_md)])
+    success, stdout, stderr = run_command(['--dry-run', '--no-cache', str(test_md)])
     
     if not success:
         ctx.print(f"✗ Test {ctx.current_test}: Command failed: {stderr}", 'fail')
@@ -136,7 +143,7 @@ def test_complex_directives(ctx: TestContext, test_dir: Path) -> bool:
 Content here.
 """)
     
-    success, stdout, stderr = run_command(['--dry-run', str(test_md)])
+    success, stdout, stderr = run_command(['--dry-run', '--no-cache', str(test_md)])
     
     if not success:
         ctx.print(f"✗ Test {ctx.current_test}: Command failed: {stderr}", 'fail')
@@ -178,7 +185,7 @@ title: Simple Document
 Just regular markdown content with no directives.
 """)
     
-    success, stdout, stderr = run_command(['--dry-run', str(test_md)])
+    success, stdout, stderr = run_command(['--dry-run', '--no-cache', str(test_md)])
     
     if not success:
         ctx.print(f"✗ Test {ctx.current_test}: Command failed: {stderr}", 'fail')
@@ -214,7 +221,7 @@ def test_malformed_directives(ctx: TestContext, test_dir: Path) -> bool:
 Content here.
 """)
     
-    success, stdout, stderr = run_command(['--dry-run', str(test_md)])
+    success, stdout, stderr = run_command(['--dry-run', '--no-cache', str(test_md)])
     
     if not success:
         ctx.print(f"✗ Test {ctx.current_test}: Command failed: {stderr}", 'fail')
@@ -250,7 +257,7 @@ def test_relative_paths(ctx: TestContext, test_dir: Path) -> bool:
 Content here.
 """)
     
-    success, stdout, stderr = run_command(['--dry-run', str(test_md)])
+    success, stdout, stderr = run_command(['--dry-run', '--no-cache', str(test_md)])
     
     if not success:
         ctx.print(f"✗ Test {ctx.current_test}: Command failed: {stderr}", 'fail')
@@ -274,6 +281,358 @@ Content here.
         ctx.print(f"✗ Test {ctx.current_test}: Expected {expected}, got {dependencies}, all_relative: {all_relative}", 'fail')
         return False
 
+def test_directives_in_code_ignored(ctx: TestContext, test_dir: Path) -> bool:
+    """Test that directives inside fenced code blocks and inline code are not dependencies"""
+    ctx.current_test += 1
+    
+    test_md = test_dir / "test_code.md"
+    test_md.write_text("""# Code Test
+
+Use `@include(inline.md)` to include a file. @src(after_inline.cpp)
+
+```markdown
+@include(fenced.md)
+```
+
+~~~~
+@src(tilde.cpp)
+~~~
+@src(still_fenced.cpp)
+~~~~
+
+@include(real.md)
+""" + "@include(unterminated.md, " * 5000 + "\n")
+    
+    success, stdout, stderr = run_command(['--dry-run', '--no-cache', str(test_md)])
+    
+    if not success:
+        ctx.print(f"✗ Test {ctx.current_test}: Command failed: {stderr}", 'fail')
+        return False
+    
+    build_targets = parse_build_targets(stdout)
+    if not build_targets:
+        ctx.print(f"✗ Test {ctx.current_test}: Failed to parse build targets JSON", 'fail')
+        return False
+    
+    dependencies = get_dependency_names(build_targets, test_md.name)
+    expected = {"after_inline.cpp", "real.md"}
+    
+    if dependencies == expected:
+        ctx.print(f"✓ Test {ctx.current_test}: Directives in code are ignored", 'normal')
+        return True
+    else:
+        ctx.print(f"✗ Test {ctx.current_test}: Expected {expected}, got {dependencies}", 'fail')
+        return False
+
+def test_parallel_scan_matches_serial(ctx: TestContext, test_dir: Path) -> bool:
+    """Test that --jobs produces the same build graph as a serial scan"""
+    ctx.current_test += 1
+    
+    site_dir = test_dir / "parallel_site"
+    (site_dir / "sub").mkdir(parents=True, exist_ok=True)
+    for i in range(150):
+        folder = site_dir if i % 2 else site_dir / "sub"
+        (folder / f"page{i}.md").write_text(f"""---
+title: Page {i}
+---
+
+@include(part{i}.md, index={i})
+@src(code{i}.py)
+""")
+    (site_dir / "style.css").write_text("body {}")
+    
+    serial_ok, serial_out, serial_err = run_command(['-r', str(site_dir), '-o', str(test_dir / 'html'), '--dry-run', '--no-cache'])
+    parallel_ok, parallel_out, parallel_err = run_command(['-r', str(site_dir), '-o', str(test_dir / 'html'), '--dry-run', '--no-cache', '--jobs', '4'])
+    
+    if not serial_ok or not parallel_ok:
+        ctx.print(f"✗ Test {ctx.current_test}: Command failed: {serial_err or parallel_err}", 'fail')
+        return False
+    
+    if serial_out == parallel_out and len(parse_build_targets(parallel_out)['nodes']) == 151:
+        ctx.print(f"✓ Test {ctx.current_test}: Parallel scan matches serial scan", 'normal')
+        return True
+    else:
+        ctx.print(f"✗ Test {ctx.current_test}: Parallel scan output differs from serial scan", 'fail')
+        return False
+
+def test_metadata_cache(ctx: TestContext, test_dir: Path) -> bool:
+    """Test that a warm metadata cache gives the same graph and notices edits"""
+    ctx.current_test += 1
+    
+    cache_dir = test_dir / "cache"
+    test_md = test_dir / "test_cached.md"
+    test_md.write_text("""---
+title: Cached
+---
+
+@include(first.md)
+""")
+    args = ['--dry-run', '-v', '--cache-dir', str(cache_dir), str(test_md)]
+    
+    cold_ok, cold_out, cold_err = run_command(args)
+    warm_ok, warm_out, warm_err = run_command(args)
+    test_md.write_text("""---
+title: Edited
+---
+
+@include(second.md)
+""")
+    edited_ok, edited_out, edited_err = run_command(args)
+    
+    if not (cold_ok and warm_ok and edited_ok):
+        ctx.print(f"✗ Test {ctx.current_test}: Command failed: {cold_err or warm_err or edited_err}", 'fail')
+        return False
+    
+    edited = parse_build_targets(edited_out)
+    checks = [
+        "0 hits, 1 misses" in cold_err,
+        "1 hits, 0 misses" in warm_err,
+        cold_out == warm_out,
+        get_dependency_names(edited, test_md.name) == {"second.md"},
+        get_frontmatter(edited, test_md.name).get("title") == "Edited",
+    ]
+    
+    if all(checks):
+        ctx.print(f"✓ Test {ctx.current_test}: Metadata cache reused and invalidated correctly", 'normal')
+        return True
+    else:
+        ctx.print(f"✗ Test {ctx.current_test}: Metadata cache checks failed: {checks}", 'fail')
+        return False
+
+def test_metadata_cache_locked(ctx: TestContext, test_dir: Path) -> bool:
+    """Test that a locked metadata cache is given up with one warning, not a traceback"""
+    ctx.current_test += 1
+    import io
+    import sqlite3
+    from contextlib import redirect_stderr
+    from .metadata_cache import CACHE_FILENAME, MetadataCache
+    from .markdown_preprocessing import MarkdownMetadata
+    
+    cache_dir = test_dir / "locked_cache"
+    cache = MetadataCache(cache_dir)
+    cache.commit()
+    cache.db.execute("PRAGMA busy_timeout = 0")
+    lock = sqlite3.connect(str(cache_dir / CACHE_FILENAME))
+    lock.execute("BEGIN EXCLUSIVE")
+    page = test_dir / "first.md"
+    errors = io.StringIO()
+    try:
+        with redirect_stderr(errors):
+            for _ in range(2):
+                cache.store(page, (1, 2), "digest", MarkdownMetadata())
+            found = cache.lookup(page)
+            cache.close()
+    except sqlite3.Error as e:
+        ctx.print(f"✗ Test {ctx.current_test}: Locked cache raised {e}", 'fail')
+        return False
+    finally:
+        lock.rollback()
+        lock.close()
+    
+    if found is None and errors.getvalue().count("Metadata cache disabled") == 1:
+        ctx.print(f"✓ Test {ctx.current_test}: Locked metadata cache is given up with one warning", 'normal')
+        return True
+    else:
+        ctx.print(f"✗ Test {ctx.current_test}: Unexpected warnings: {errors.getvalue()!r}", 'fail')
+        return False
+
+def test_reverse_dependency_index(ctx: TestContext, test_dir: Path) -> bool:
+    """Test that affected_targets follows @src edges and transitive @include chains"""
+    ctx.current_test += 1
+    
+    site_dir = test_dir / "index_site"
+    (site_dir / "_partials").mkdir(parents=True, exist_ok=True)
+    (site_dir / "a.md").write_text("@include(_partials/outer.md)\n")
+    (site_dir / "b.md").write_text("@include(a.md)\n@src(code/main.py)\n")
+    (site_dir / "c.md").write_text("# Unrelated\n")
+    (site_dir / "_partials" / "outer.md").write_text("@include(inner.md)\n")
+    (site_dir / "_partials" / "inner.md").write_text("Inner\n")
+    
+    config = Config(invoked_from=test_dir, bundle_root=Path(__file__).parent.parent,
+                    base_input_path=site_dir, recursive=True, output_dir=test_dir / "index_html")
+    targets = BuildTargets()
+    handle_target(site_dir, config, targets)
+    targets.wait_for_metadata()
+    
+    def affected(*paths):
+        return sorted(node.input_path.name for node in targets.affected_targets([site_dir / p for p in paths]))
+    
+    checks = {
+        "inner": (affected("_partials/inner.md"), ["a.md", "b.md"]),
+        "src": (affected("code/main.py"), ["b.md"]),
+        "page": (affected("b.md"), ["b.md"]),
+        "unrelated": (affected("c.md", "missing.md"), ["c.md"]),
+    }
+    failures = {name: got for name, (got, expected) in checks.items() if got != expected}
+    
+    if not failures:
+        ctx.print(f"✓ Test {ctx.current_test}: Reverse dependency index finds affected targets", 'normal')
+        return True
+    else:
+        ctx.print(f"✗ Test {ctx.current_test}: Unexpected affected targets: {failures}", 'fail')
+        return False
+
+def test_source_read_once(ctx: TestContext, test_dir: Path) -> bool:
+    """Test that scanning reads each file once and leaves the buffer for rendering"""
+    ctx.current_test += 1
+    
+    site_dir = test_dir / "source_site"
+    site_dir.mkdir(parents=True, exist_ok=True)
+    (site_dir / "page.md").write_text("---\ntitle: Shared\n---\n\n# Body\n@include(part.md)\n")
+    (site_dir / "part.md").write_text("Part\n")
+    
+    config = Config(invoked_from=test_dir, bundle_root=Path(__file__).parent.parent,
+                    base_input_path=site_dir, recursive=True, output_dir=test_dir / "source_html")
+    targets = BuildTargets()
+    handle_target(site_dir, config, targets)
+    targets.wait_for_metadata()
+    reads_after_scan = targets.sources.reads
+    source = targets.sources.take(site_dir / "page.md")
+
+    # A parallel scan reads pages on its workers, and hands their buffers back
+    parallel = BuildTargets(jobs=2)
+    handle_target(site_dir, config, parallel)
+    parallel.wait_for_metadata()
+    parallel_source = parallel.sources.release(site_dir / "page.md")
+
+    checks = [
+        reads_after_scan == 2,
+        targets.sources.reads == 2,
+        parallel.sources.reads == 0,
+        parallel_source is not None and parallel_source.text == source.text,
+        source.frontmatter_text.strip() == "title: Shared",
+        source.body == "# Body\n@include(part.md)",
+        targets.get_node(site_dir / "page.md").frontmatter == {"title": "Shared"},
+    ]
+    
+    if all(checks):
+        ctx.print(f"✓ Test {ctx.current_test}: Source buffers are read once and shared", 'normal')
+        return True
+    else:
+        ctx.print(f"✗ Test {ctx.current_test}: Source buffer checks failed: {checks}", 'fail')
+        return False
+
+def test_lazy_frontmatter(ctx: TestContext, test_dir: Path) -> bool:
+    """Test that lazy front matter parses on demand and matches the eager parser"""
+    ctx.current_test += 1
+    
+    plain = SourceBuffer.from_text("---\ntitle: Lazy\ntags: [a, b]\n---\nBody\n")
+    templated = SourceBuffer.from_text("---\ntemplate: post.html\n---\nBody\n")
+    malformed = SourceBuffer.from_text("---\ntitle: [unclosed\n---\nBody\n")
+    
+    lazy_plain = parse_frontmatter(plain, lazy=True)
+    template_lookup = lazy_plain.get('template')
+    parsed_by_lookup = lazy_plain.parsed
+    
+    checks = [
+        template_lookup is None and not parsed_by_lookup,
+        lazy_plain == parse_frontmatter(plain) == {"title": "Lazy", "tags": ["a", "b"]},
+        parse_frontmatter(templated, lazy=True).get('template') == "post.html",
+        dict(parse_frontmatter(malformed, lazy=True)) == parse_frontmatter(malformed) == {},
+    ]
+    
+    if all(checks):
+        ctx.print(f"✓ Test {ctx.current_test}: Lazy front matter matches eager parsing", 'normal')
+        return True
+    else:
+        ctx.print(f"✗ Test {ctx.current_test}: Lazy front matter checks failed: {checks}", 'fail')
+        return False
+
+def test_affected_command(ctx: TestContext, test_dir: Path) -> bool:
+    """Test --affected with command line and stdin paths, including template dependencies"""
+    ctx.current_test += 1
+    
+    site_dir = test_dir / "affected_site"
+    (site_dir / "src").mkdir(parents=True, exist_ok=True)
+    (site_dir / "templates").mkdir(exist_ok=True)
+    (site_dir / "templates" / "post.html").write_text("{{ content }}")
+    (site_dir / "src" / "post.md").write_text("---\ntemplate: post.html\n---\n@src(plot.py)\n")
+    (site_dir / "src" / "page.md").write_text("@include(_nav.md)\n")
+    (site_dir / "src" / "_nav.md").write_text("Nav\n")
+    (site_dir / "src" / "logo.png").write_bytes(b"png")
+    
+    base_args = ['-r', 'src', '-o', 'html']
+    results = {
+        "template": run_command(base_args + ['--affected', 'templates/post.html'], site_dir),
+        "src": run_command(base_args + ['--affected', 'src/plot.py'], site_dir),
+        "stdin": run_command(base_args + ['--affected', '-'], site_dir, stdin="src/_nav.md\nsrc/logo.png\n"),
+        "none": run_command(base_args + ['--affected', 'readme.txt'], site_dir),
+    }
+    expected = {
+        "template": {"post.md"},
+        "src": {"post.md"},
+        "stdin": {"page.md", "logo.png"},
+        "none": set(),
+    }
+    
+    failures = {}
+    for name, (success, stdout, stderr) in results.items():
+        if not success:
+            failures[name] = stderr
+            continue
+        got = {Path(node['input']).name for node in parse_build_targets(stdout)['nodes']}
+        if got != expected[name]:
+            failures[name] = got
+    
+    if not failures:
+        ctx.print(f"✓ Test {ctx.current_test}: --affected lists the targets that depend on changed files", 'normal')
+        return True
+    else:
+        ctx.print(f"✗ Test {ctx.current_test}: Unexpected --affected results: {failures}", 'fail')
+        return False
+
+def test_ndjson_streaming(ctx: TestContext, test_dir: Path) -> bool:
+    """Test that --format=ndjson streams the same nodes as the JSON graph, serial and parallel"""
+    ctx.current_test += 1
+    
+    site_dir = test_dir / "ndjson_site"
+    (site_dir / "sub").mkdir(parents=True, exist_ok=True)
+    for i in range(100):
+        folder = site_dir if i % 2 else site_dir / "sub"
+        (folder / f"page{i}.md").write_text(f"---\ntitle: Page {i}\n---\n@include(part{i}.md, index={i})\n")
+    (site_dir / "style.css").write_text("body {}")
+    
+    base_args = ['-r', str(site_dir), '-o', str(test_dir / 'html'), '--dry-run', '--no-cache']
+    json_ok, json_out, json_err = run_command(base_args)
+    outputs = [run_command(base_args + ['--format=ndjson', '--jobs', jobs]) for jobs in ('1', '3')]
+    if not json_ok or not all(success for success, _, _ in outputs):
+        ctx.print(f"✗ Test {ctx.current_test}: Command failed: {json_err or [err for _, _, err in outputs]}", 'fail')
+        return False
+    expected = parse_build_targets(json_out)['nodes']
+    streamed = [[json.loads(line) for line in stdout.splitlines()] for _, stdout, _ in outputs]
+    
+    # In process, a serial scan reports each node before the scan finishes
+    config = Config(invoked_from=test_dir, bundle_root=test_dir, base_input_path=site_dir,
+                    output_dir=test_dir / 'html', recursive=True)
+    reported = []
+    targets = BuildTargets(config=config, on_node_ready=reported.append)
+    handle_target(site_dir, config, targets)
+    reported_during_scan = len(reported)
+    targets.wait_for_metadata()
+    
+    # Each streamed line is flushed, so a pipe reader sees it before the output buffer fills
+    class FlushCounter(io.StringIO):
+        flushed_lines = []
+        def flush(self):
+            self.flushed_lines.append(self.getvalue().count("\n"))
+    stdout, sys.stdout = sys.stdout, FlushCounter()
+    try:
+        for node in reported[:3]:
+            stream_node(node)
+        flushed_lines = sys.stdout.flushed_lines
+    finally:
+        sys.stdout = stdout
+    
+    if all(nodes == expected for nodes in streamed) and reported_during_scan == len(targets.nodes) == 101 \
+            and flushed_lines == [1, 2, 3]:
+        ctx.print(f"✓ Test {ctx.current_test}: NDJSON output streams the build graph in order", 'normal')
+        return True
+    else:
+        ctx.print(f"✗ Test {ctx.current_test}: NDJSON output differs from the JSON graph "
+                  f"({[len(nodes) for nodes in streamed]} vs {len(expected)} nodes, {reported_during_scan} reported during scan, "
+                  f"flushed after lines {flushed_lines})", 'fail')
+        return False
+
 def run_preprocessing_tests(ctx: TestContext) -> Tuple[int, int]:
     """Run all preprocessing tests and return (passed, failed) counts"""
     
@@ -289,6 +648,15 @@ def run_preprocessing_tests(ctx: TestContext) -> Tuple[int, int]:
         test_no_dependencies,
         test_malformed_directives,
         test_relative_paths,
+        test_directives_in_code_ignored,
+        test_parallel_scan_matches_serial,
+        test_metadata_cache,
+        test_metadata_cache_locked,
+        test_reverse_dependency_index,
+        test_source_read_once,
+        test_lazy_frontmatter,
+        test_affected_command,
+        test_ndjson_streaming,
     ]
     
     passed = 0
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Dev server tests for md2html
+Runs `md2html --serve` on a small site, fetches pages, and checks live reload
+"""
+
+import http.client
+import shutil
+import socket
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from .testsuite import TestContext
+from .testwatch import Watcher
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def fetch(port: int, path: str, headers: Optional[Dict[str, str]] = None) -> Tuple[int, Dict[str, str], bytes]:
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    try:
+        connection.request('GET', path, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        connection.close()
+
+class EventStream:
+    """A server-sent event stream, read line by line"""
+
+    def __init__(self, port: int, page: str, timeout: float = 5.0):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+        self.connection.request('GET', f'/__md2html/events?path={page}')
+        self.response = self.connection.getresponse()
+
+    def next_event(self) -> str:
+        """The data of the next event, skipping comments, or '' on timeout"""
+        try:
+            while True:
+                line = self.response.fp.readline()
+                if not line:
+                    return ''
+                line = line.decode().rstrip('\n')
+                if line.startswith('data:'):
+                    return line[len('data:'):].strip()
+        except (socket.timeout, OSError):
+            return ''
+
+    def close(self):
+        self.connection.close()
+
+def run_server_tests(ctx: TestContext) -> Tuple[int, int]:
+    """Run all server tests and return (passed, failed) counts"""
+
+    passed_before, failed_before = ctx.passed, ctx.failed
+    project_root = Path(__file__).parent.parent
+    site = project_root / 'tests' / 'serve'
+    if site.exists():
+        shutil.rmtree(site)
+    src = site / 'src'
+    src.mkdir(parents=True)
+    (src / 'index.md').write_text("# Home\n")
+    (src / 'about.md').write_text("# About\n")
+    (src / 'style.css').write_text("body { color: black; }\n")
+    (src / '_shared.md').write_text("Shared text.\n")
+    for i in range(20):
+        (src / f'page{i:02}.md').write_text(f"# Page {i}\n\n@include(_shared.md)\n")
+
+    ctx.print_header("Dev server")
+    port = free_port()
+    server = Watcher(site, ['--serve', '--port', str(port), '--verbose'])
+    try:
+        ctx.test_start("Serving after the initial build")
+        summary = server.next_summary(timeout=10)
+        if summary != "Build: 22 rendered, 1 copied, 0 unchanged (files: 23 written, 0 unchanged)":
+            ctx.fail_test(f"Unexpected initial build: '{summary}' {server.errors[-3:]}")
+        elif server.error_line("Serving") is None or not server.watching():
+            ctx.fail_test(f"Server did not start: {server.errors[-3:]}")
+        else:
+            ctx.pass_test()
+
+        ctx.test_start("Pages are served with an ETag and the reload script")
+        status, headers, body = fetch(port, '/about.html')
+        ctx.detail(f"Status {status}, ETag {headers.get('ETag')}")
+        if status != 200 or b'<h1>About</h1>' not in body:
+            ctx.fail_test(f"Unexpected response {status}: {body[:80]!r}")
+        elif b'/__md2html/events' not in body or 'ETag' not in headers:
+            ctx.fail_test("Response has no reload script or ETag")
+        else:
+            ctx.pass_test()
+        etag = headers.get('ETag', '')
+
+        ctx.test_start("Unchanged pages revalidate with a 304")
+        status, _, body = fetch(port, '/about.html', {'If-None-Match': etag})
+        if status != 304 or body:
+            ctx.fail_test(f"Expected an empty 304, got {status}")
+        else:
+            ctx.pass_test()
+
+        ctx.test_start("The root serves index.html, and extensionless paths serve .html pages")
+        root_status, _, root_body = fetch(port, '/')
+        about_status, _, _ = fetch(port, '/about')
+        if root_status != 200 or b'<h1>Home</h1>' not in root_body or about_status != 200:
+            ctx.fail_test(f"Got {root_status} for / and {about_status} for /about")
+        else:
+            ctx.pass_test()
+
+        ctx.test_start("Copied assets are served without the reload script")
+        status, headers, body = fetch(port, '/style.css')
+        if status != 200 or body != b"body { color: black; }\n" or not headers.get('Content-Type', '').startswith('text/css'):
+            ctx.fail_test(f"Unexpected response {status} {headers.get('Content-Type')}: {body!r}")
+        else:
+            ctx.pass_test()
+
+        ctx.test_start("Paths outside the output root are not served")
+        status, _, _ = fetch(port, '/../src/about.md')
+        missing, _, _ = fetch(port, '/missing.html')
+        if status != 404 or missing != 404:
+            ctx.fail_test(f"Got {status} and {missing}")
+        else:
+            ctx.pass_test()
+
+        ctx.test_start("Rebuilding a page reloads the browsers viewing it")
+        events = EventStream(port, '/about.html')
+        others = EventStream(port, '/index.html', timeout=0.5)
+        try:
+            time.sleep(0.1)
+            started = time.perf_counter()
+            (src / 'about.md').write_text("# About, edited\n")
+            event = events.next_event()
+            elapsed = (time.perf_counter() - started) * 1000
+            ctx.detail(f"Event '{event}' after {elapsed:.0f} ms")
+            if event != 'reload':
+                ctx.fail_test(f"Expected a reload event, got '{event}'")
+            elif others.next_event():
+                ctx.fail_test("A page that wasn't rebuilt was reloaded")
+            else:
+                ctx.pass_test()
+        finally:
+            events.close()
+            others.close()
+
+        ctx.test_start("The rebuilt page is served with a new ETag")
+        status, headers, body = fetch(port, '/about.html', {'If-None-Match': etag})
+        if status != 200 or b'About, edited' not in body or headers.get('ETag') == etag:
+            ctx.fail_test(f"Unexpected response {status}: {body[:80]!r}")
+        else:
+            ctx.pass_test()
+        server.next_summary(timeout=1)
+
+        ctx.test_start("Pages open in a browser are rebuilt first")
+        events = EventStream(port, '/page19.html')
+        try:
+            time.sleep(0.1)
+            seen = len(server.errors)
+            (src / '_shared.md').write_text("Shared text, edited.\n")
+            event = events.next_event()
+            summary = server.next_summary()
+            ctx.detail(f"Summary: {summary}")
+            built = [line for line in server.errors[seen:] if line.startswith("Built ")]
+            if event != 'reload':
+                ctx.fail_test(f"Expected a reload event, got '{event}'")
+            elif not summary.startswith("Build: 20 rendered, 0 copied, 0 unchanged (files: 20 written, 0 unchanged) in ") or "open pages in" not in summary:
+                ctx.fail_test(f"Unexpected summary: '{summary}'")
+            elif not built or not built[0].endswith('page19.html'):
+                ctx.fail_test(f"Expected page19.html to be built first, got {built[:2]}")
+            else:
+                ctx.pass_test()
+        finally:
+            events.close()
+    finally:
+        server.stop()
+
+    shutil.rmtree(site)
+    src.mkdir(parents=True)
+    (src / '_shared.md').write_text("Shared text.\n")
+    for i in range(20):
+        (src / f'page{i:02}.md').write_text(f"# Page {i}\n\n@include(_shared.md)\n")
+    server = Watcher(site, ['--serve', '--port', str(free_port())], in_place=True)
+    try:
+        ctx.test_start("An in-place build isn't stopped by the files it writes")
+        server.next_summary(timeout=10)
+        server.watching()
+        (src / '_shared.md').write_text("Shared text, edited.\n")
+        summary = server.next_summary()
+        extra = server.next_summary(timeout=1)
+        ctx.detail(f"Summary: {summary}")
+        if not summary.startswith("Build: 20 rendered, 0 copied, 0 unchanged (files: 20 written, 0 unchanged) in "):
+            ctx.fail_test(f"Expected all 20 pages in one build, got '{summary}' {server.errors[-3:]}")
+        elif extra:
+            ctx.fail_test(f"Expected a single rebuild, got another: '{extra}'")
+        elif "edited" not in (src / 'page00.html').read_text():
+            ctx.fail_test("page00.html does not have the edited partial")
+        else:
+            ctx.pass_test()
+    finally:
+        server.stop()
+
+    if not ctx.keep_files:
+        shutil.rmtree(site)
+
+    return ctx.passed - passed_before, ctx.failed - failed_before
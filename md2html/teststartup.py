@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Startup time tests for md2html
+Checks that heavy dependencies are imported lazily and that cold start stays within budget
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import List, Set, Tuple
+
+from .testsuite import TestContext, run_command
+
+# Allowed cold start cost of a dry run of a small site on top of a bare interpreter start.
+# Typical is around 100 ms; the slack absorbs noisy CI machines.
+STARTUP_BUDGET_SECONDS = 0.2
+
+# Modules that must not be imported by `--help` or a dry run of a page without front matter
+LAZY_MODULES = ['yaml', 'frontmatter', 'markdown', 'pygments', 'liquid', 'watchdog',
+                'concurrent.futures', 'multiprocessing']
+
+def python_env() -> dict:
+    """Environment that lets a bare interpreter import the md2html package"""
+    project_root = Path(__file__).parent.parent
+    env = os.environ.copy()
+    env['PYTHONPATH'] = str(project_root) + (os.pathsep + env['PYTHONPATH'] if 'PYTHONPATH' in env else '')
+    return env
+
+def imported_modules(args: List[str], cwd: Path) -> Set[str]:
+    """Top-level names of the modules imported while running md2html with args"""
+    cmd = [sys.executable, '-X', 'importtime', '-m', 'md2html.md2html'] + args
+    result = subprocess.run(cmd, capture_output=True, text=True, cwd=cwd, env=python_env())
+    modules = set()
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:') and line.count('|') == 2:
+            modules.add(line.rsplit('|', 1)[1].strip())
+    return modules
+
+def best_run_time(cmd: List[str], cwd: Path, repeat: int = 5) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(cmd, capture_output=True, cwd=cwd, env=python_env())
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def test_lazy_imports(ctx: TestContext, name: str, args: List[str], cwd: Path):
+    ctx.test_start(name)
+    modules = imported_modules(args, cwd)
+    if 'md2html.config' not in modules:
+        return ctx.fail_test("Could not collect import timings")
+    eager = [module for module in LAZY_MODULES if module in modules]
+    if eager:
+        return ctx.fail_test(f"Imported eagerly: {eager}")
+    return ctx.pass_test()
+
+def run_startup_tests(ctx: TestContext) -> Tuple[int, int]:
+    """Run all startup tests and return (passed, failed) counts"""
+
+    passed_before, failed_before = ctx.passed, ctx.failed
+    project_root = Path(__file__).parent.parent
+    test_dir = project_root / 'tests' / 'startup'
+    if test_dir.exists():
+        shutil.rmtree(test_dir)
+    test_dir.mkdir(parents=True)
+    (test_dir / 'note.md').write_text('# Note\n\nNo front matter here.\n')
+    (test_dir / 'site').mkdir()
+    (test_dir / 'site' / 'index.md').write_text('# Index\n\nNo front matter here either.\n')
+
+    ctx.print_header("Lazy Imports")
+    test_lazy_imports(ctx, "Help imports no heavy dependencies", ['--help'], test_dir)
+    test_lazy_imports(ctx, "Dry run without front matter imports no heavy dependencies",
+                      ['note.md', '--dry-run', '--no-cache'], test_dir)
+    test_lazy_imports(ctx, "Dry run of a directory imports no heavy dependencies",
+                      ['-r', 'site', '--dry-run', '--no-cache'], test_dir)
+
+    ctx.test_start("Startup profile report")
+    success, stdout, stderr = run_command(['note.md', '--dry-run', '--startup-profile'], test_dir)
+    if success and "Startup profile:" in stderr and "heavy modules loaded:" in stderr:
+        ctx.pass_test()
+    else:
+        ctx.fail_test("Missing startup profile report")
+
+    ctx.print_header("Startup Budget")
+    baseline = best_run_time([sys.executable, '-c', 'pass'], test_dir)
+    # Dry runs go through the scan, so they also catch build-path modules imported eagerly
+    for args in (['note.md', '--dry-run', '--no-cache'], ['-r', 'site', '--dry-run', '--no-cache']):
+        command = ' '.join(args)
+        ctx.test_start(f"Cold `{command}` within {STARTUP_BUDGET_SECONDS * 1000:.0f} ms of a bare interpreter")
+        startup = best_run_time([sys.executable, '-m', 'md2html.md2html', *args], test_dir)
+        overhead = startup - baseline
+        ctx.detail(f"Interpreter: {baseline * 1000:.1f} ms, md2html {command}: {startup * 1000:.1f} ms")
+        if overhead <= STARTUP_BUDGET_SECONDS:
+            ctx.pass_test(f"Startup overhead {overhead * 1000:.1f} ms")
+        else:
+            ctx.fail_test(f"Startup overhead {overhead * 1000:.1f} ms exceeds budget")
+
+    if not ctx.keep_files:
+        shutil.rmtree(test_dir)
+
+    return ctx.passed - passed_before, ctx.failed - failed_before
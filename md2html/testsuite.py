@@ -97,13 +97,29 @@ class TestContext:
                 msg += f" ({suite_name})"
             print(f"{Colors.YELLOW}{Colors.BOLD}{msg}{Colors.RESET}")
 
-def run_command(args: List[str], cwd: Path = None) -> Tuple[bool, str, str]:
+def run_command(args: List[str], cwd: Path = None, stdin: str = None) -> Tuple[bool, str, str]:
     """
-    Run md2html with given arguments.
+    Run md2html with given arguments, optionally feeding text to stdin.
     Returns (success, stdout, stderr)
     """
     cmd = [sys.executable, '-m', 'md2html.md2html'] + args
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, cwd=cwd, env=command_env(), input=stdin)
+        return result.returncode == 0, result.stdout, result.stderr
+    except Exception as e:
+        return False, "", str(e)
+
+def start_command(args: List[str], cwd: Path = None) -> subprocess.Popen:
+    """
+    Start md2html in the background, e.g. in watch mode, with stdout and stderr
+    piped as line buffered text. The caller stops it.
+    """
+    cmd = [sys.executable, '-u', '-m', 'md2html.md2html'] + args
+    return subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, bufsize=1,
+                            cwd=cwd, env=command_env())
 
+def command_env() -> dict:
+    """Environment for running md2html from this checkout"""
     # Get the project root (parent of md2html package)
     project_root = Path(__file__).parent.parent
 
@@ -113,9 +129,4 @@ def run_command(args: List[str], cwd: Path = None) -> Tuple[bool, str, str]:
         env['PYTHONPATH'] = str(project_root) + os.pathsep + env['PYTHONPATH']
     else:
         env['PYTHONPATH'] = str(project_root)
-
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True, cwd=cwd, env=env)
-        return result.returncode == 0, result.stdout, result.stderr
-    except Exception as e:
-        return False, "", str(e)
+    return env
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Watch mode tests for md2html
+Runs `md2html --watch` on a small site, edits it, and checks the rebuilds
+"""
+
+import os
+import queue
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from .testsuite import TestContext, run_command, start_command
+
+class Watcher:
+    """A running `md2html --watch`, whose output lines are collected by a thread"""
+
+    def __init__(self, site: Path, extra_args: List[str] = (), in_place: bool = False, cache: bool = False):
+        output_args = [] if in_place else ['-o', 'html']
+        cache_args = ['--cache-dir', 'cache'] if cache else ['--no-cache']
+        self.process = start_command(['-r', 'src', *output_args, *cache_args, '--watch', *extra_args], site)
+        self.lines: 'queue.Queue[str]' = queue.Queue()
+        self.errors: List[str] = []
+        threading.Thread(target=self.collect, args=(self.process.stdout, self.lines), daemon=True).start()
+        threading.Thread(target=self.collect_errors, daemon=True).start()
+
+    @staticmethod
+    def collect(stream, lines: 'queue.Queue[str]'):
+        for line in stream:
+            lines.put(line.rstrip('\n'))
+
+    def collect_errors(self):
+        for line in self.process.stderr:
+            self.errors.append(line.rstrip('\n'))
+
+    def next_summary(self, timeout: float = 5.0) -> str:
+        """The next build summary line, or '' if there is none within timeout"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                line = self.lines.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                return ''
+            if line.startswith("Build:"):
+                return line
+
+    def watching(self, timeout: float = 5.0) -> bool:
+        return self.error_line("Watching", timeout) is not None
+
+    def error_line(self, prefix: str, timeout: float = 5.0) -> Optional[str]:
+        """The first stderr line starting with prefix, waiting up to timeout for it"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            line = next((line for line in self.errors if line.startswith(prefix)), None)
+            if line is not None:
+                return line
+            time.sleep(0.02)
+        return None
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait(timeout=5)
+
+def expect_rebuild(ctx: TestContext, watcher: Watcher, expected: str) -> bool:
+    summary = watcher.next_summary()
+    ctx.detail(f"Summary: {summary}")
+    if not summary.startswith(f"Build: {expected} in "):
+        return ctx.fail_test(f"Expected 'Build: {expected}', got '{summary}'")
+    extra = watcher.next_summary(timeout=0.5)
+    if extra:
+        return ctx.fail_test(f"Expected a single rebuild, got another: '{extra}'")
+    return ctx.pass_test()
+
+def run_watch_tests(ctx: TestContext) -> Tuple[int, int]:
+    """Run all watch tests and return (passed, failed) counts"""
+
+    passed_before, failed_before = ctx.passed, ctx.failed
+    project_root = Path(__file__).parent.parent
+    site = project_root / 'tests' / 'watch'
+    if site.exists():
+        shutil.rmtree(site)
+    src = site / 'src'
+    src.mkdir(parents=True)
+    (src / 'index.md').write_text("# Home\n\n@include(_shared.md)\n")
+    (src / 'about.md').write_text("# About\n\n@include(_shared.md)\n")
+    (src / 'other.md').write_text("# Other\n")
+    (src / '_shared.md').write_text("Shared text.\n")
+    html = site / 'html'
+
+    ctx.print_header("Watch mode")
+    watcher = Watcher(site, cache=True)
+    try:
+        ctx.test_start("Initial build, then watching")
+        summary = watcher.next_summary(timeout=10)
+        if summary != "Build: 3 rendered, 0 copied, 0 unchanged (files: 3 written, 0 unchanged)":
+            ctx.fail_test(f"Unexpected initial build: '{summary}' {watcher.errors[-3:]}")
+        elif not watcher.watching():
+            ctx.fail_test("Watch loop did not start")
+        else:
+            ctx.pass_test()
+
+        ctx.test_start("Other runs can use the metadata cache while watching")
+        started = time.perf_counter()
+        success, _, stderr = run_command(['-r', 'src', '--dry-run', '--cache-dir', 'cache'], site)
+        elapsed = time.perf_counter() - started
+        ctx.detail(f"Dry run took {elapsed * 1000:.0f} ms")
+        if not success or "Metadata cache disabled" in stderr or elapsed > 3:
+            ctx.fail_test(f"The dry run was locked out of the cache: {stderr.strip()[:300]}")
+        else:
+            ctx.pass_test()
+
+        ctx.test_start("A burst of saves through temporary files becomes one rebuild")
+        for i in range(20):
+            temp = src / f'.other.md.{i}.tmp'
+            temp.write_text(f"# Other, save {i}\n")
+            os.replace(temp, src / 'other.md')
+        if expect_rebuild(ctx, watcher, "1 rendered, 0 copied, 0 unchanged (files: 1 written, 0 unchanged)"):
+            other = (html / 'other.html').read_text()
+            if "Other, save 19" not in other:
+                ctx.fail_test("other.html does not have the last save")
+
+        ctx.test_start("Editing a partial rebuilds only the pages that include it")
+        (src / '_shared.md').write_text("Shared text, edited.\n")
+        if expect_rebuild(ctx, watcher, "2 rendered, 0 copied, 0 unchanged (files: 2 written, 0 unchanged)"):
+            if "edited" not in (html / 'about.html').read_text():
+                ctx.fail_test("about.html does not have the edited partial")
+
+        ctx.test_start("A page's new @include is followed by later rebuilds")
+        (src / '_footer.md').write_text("Footer.\n")
+        (src / 'other.md').write_text("# Other\n\n@include(_footer.md)\n")
+        expect_rebuild(ctx, watcher, "1 rendered, 0 copied, 0 unchanged (files: 1 written, 0 unchanged)")
+        (src / '_footer.md').write_text("Footer, edited.\n")
+        ctx.test_start("Editing the new partial rebuilds the page")
+        if expect_rebuild(ctx, watcher, "1 rendered, 0 copied, 0 unchanged (files: 1 written, 0 unchanged)"):
+            if "Footer, edited." not in (html / 'other.html').read_text():
+                ctx.fail_test("other.html does not have the edited footer")
+
+        ctx.test_start("A new page is scanned and built")
+        (src / 'new.md').write_text("# New\n")
+        expect_rebuild(ctx, watcher, "1 rendered, 0 copied, 3 unchanged (files: 1 written, 3 unchanged)")
+
+        ctx.test_start("A page in a new directory is scanned and built")
+        (src / 'new').mkdir()
+        (src / 'new' / 'page.md').write_text("# New page\n")
+        if expect_rebuild(ctx, watcher, "1 rendered, 0 copied, 4 unchanged (files: 1 written, 4 unchanged)"):
+            if not (html / 'new' / 'page.html').exists():
+                ctx.fail_test("new/page.html was not written")
+
+        ctx.test_start("A page added later to a new, empty directory is built")
+        (src / 'empty').mkdir()
+        watcher.next_summary()
+        (src / 'empty' / 'page.md').write_text("# Later page\n")
+        expect_rebuild(ctx, watcher, "1 rendered, 0 copied, 5 unchanged (files: 1 written, 5 unchanged)")
+    finally:
+        watcher.stop()
+
+    # src is a symlink to the real input tree, and linked/ a symlink to its pages/, so
+    # page.md is both src/pages/page.md and src/linked/page.md
+    shutil.rmtree(site)
+    (site / 'real' / 'pages').mkdir(parents=True)
+    (site / 'real' / 'index.md').write_text("# Home\n")
+    (site / 'real' / 'pages' / 'page.md').write_text("# Page\n")
+    (site / 'src').symlink_to('real')
+    (site / 'real' / 'linked').symlink_to(Path('..') / 'real' / 'pages')
+    watcher = Watcher(site)
+    try:
+        watcher.next_summary(timeout=10)
+        watcher.watching()
+        ctx.test_start("Edits are seen when the input root is a symlink")
+        (site / 'real' / 'index.md').write_text("# Home, edited\n")
+        if expect_rebuild(ctx, watcher, "1 rendered, 0 copied, 0 unchanged (files: 1 written, 0 unchanged)"):
+            if "Home, edited" not in (html / 'index.html').read_text():
+                ctx.fail_test("index.html does not have the edit")
+
+        ctx.test_start("Edits are seen under a symlinked directory")
+        (site / 'real' / 'pages' / 'page.md').write_text("# Page, edited\n")
+        if expect_rebuild(ctx, watcher, "2 rendered, 0 copied, 0 unchanged (files: 2 written, 0 unchanged)"):
+            if "Page, edited" not in (html / 'linked' / 'page.html').read_text():
+                ctx.fail_test("linked/page.html does not have the edit")
+    finally:
+        watcher.stop()
+
+    if not ctx.keep_files:
+        shutil.rmtree(site)
+
+    return ctx.passed - passed_before, ctx.failed - failed_before
@@ -0,0 +1,220 @@
+"""
+Watch mode: rebuilds the site as its files change.
+
+Only the directories holding watched files, and the directories the scan walked
+(WatchTargets.get_watch_dirs), are watched, each without recursion, and event
+paths are looked up in the set of watched files as they are: the watched
+directories are resolved, so the paths of their events are too, and no event
+costs a syscall. The build graph is keyed by the paths the scan was given, so the
+paths of files under a symlink are translated to those keys before they are looked
+up in it (WatchTargets.dependency_keys). A directory created, moved or deleted in
+the input tree is scanned again, and watched from then on.
+
+Saving through a temporary file and a rename, or a `git checkout`, produces a
+burst of events. Events are collected until none has arrived for WATCH_DEBOUNCE
+seconds, or WATCH_MAX_DELAY seconds after the first, and the files they changed
+become one incremental build of the targets affected by them. A new input file,
+or a deleted page, changes the set of targets, and the tree is scanned again
+instead (through the metadata cache, so unchanged pages aren't parsed).
+
+Events for the outputs of the build, its manifest and temporary files are dropped,
+since an in-place build (no -o) writes them into the watched directories.
+
+With --serve, the build renders the pages open in a browser first, and stops
+starting targets as soon as a watched file changes again. The targets it didn't get to
+are built with the next burst's, so an edit never waits for the rest of a large
+rebuild before the page it affects is rendered.
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from pathlib import Path
+import os
+import sys
+import threading
+import time
+
+from .buildgraph import BuildTarget, BuildTargets, dependency_key, should_ignore_path
+from .config import Config
+from .manifest import MANIFEST_FILENAME
+
+# Seconds without events before a burst counts as over, and at most after its first event
+WATCH_DEBOUNCE = 0.05
+WATCH_MAX_DELAY = 0.5
+# Events that don't change the file
+IGNORED_EVENTS = {'opened', 'closed_no_write'}
+# Events of directories that can change the set of targets; others, such as the
+# modification of a directory when a file in it changes, are ignored
+DIRECTORY_EVENTS = {'created', 'moved', 'deleted'}
+
+
+class ChangeCollector:
+    """Gathers the paths of file events from the watchdog observer thread. Works as
+    the observer's event handler, which only needs a dispatch() method."""
+
+    def __init__(self, watched: Set[str]):
+        self.watched = watched # resolved paths of the watched files
+        self.outputs: Set[str] = set() # resolved paths of the outputs, whose events are dropped
+        self.changed: Set[str] = set() # watched files that changed
+        self.unknown: Set[str] = set() # other files and directories in the watched directories
+        self.first_event = 0.0
+        self.last_event = 0.0
+        self.condition = threading.Condition()
+
+    def dispatch(self, event):
+        if event.event_type in IGNORED_EVENTS or (event.is_directory and event.event_type not in DIRECTORY_EVENTS):
+            return
+        paths = [event.src_path, event.dest_path] if event.dest_path else [event.src_path]
+        with self.condition:
+            paths = [path for path in map(os.fsdecode, paths) if not self.is_output(path)]
+            if not paths:
+                return
+            now = time.monotonic()
+            if not (self.changed or self.unknown):
+                self.first_event = now
+            self.last_event = now
+            for path in paths:
+                (self.changed if path in self.watched else self.unknown).add(path)
+            self.condition.notify()
+
+    def is_output(self, path: str) -> bool:
+        """Whether path is written by the build: an output, the manifest or a temporary file"""
+        if path in self.watched:
+            return False
+        return path in self.outputs or path.endswith('.tmp') or os.path.basename(path) == MANIFEST_FILENAME
+
+    def has_changes(self) -> bool:
+        """Whether a watched file changed since the last take()"""
+        with self.condition:
+            return bool(self.changed)
+
+    def wait(self) -> Tuple[Set[str], Set[str]]:
+        """Block until a burst of events is over, and return the changed and unknown paths"""
+        with self.condition:
+            while not (self.changed or self.unknown):
+                self.condition.wait()
+            while True:
+                remaining = min(self.last_event + WATCH_DEBOUNCE, self.first_event + WATCH_MAX_DELAY) - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return self.take()
+
+    def take(self) -> Tuple[Set[str], Set[str]]:
+        """Return the changed and unknown paths collected so far, without waiting"""
+        with self.condition:
+            changed, unknown = self.changed, self.unknown
+            self.changed, self.unknown = set(), set()
+            return changed, unknown
+
+
+def output_paths(targets: BuildTargets) -> Set[str]:
+    """Resolved paths of the outputs of targets, resolving each output directory once"""
+    resolved_dirs: Dict[str, str] = {}
+    paths = set()
+    for node in targets.nodes.values():
+        if node.output_dir is None or node.output_name is None:
+            continue
+        resolved = resolved_dirs.get(node.output_dir)
+        if resolved is None:
+            resolved = resolved_dirs[node.output_dir] = os.path.realpath(node.output_dir)
+        paths.add(os.path.join(resolved, node.output_name))
+    return paths
+
+
+def new_inputs(targets: BuildTargets, config: Config, paths: Set[str]) -> List[str]:
+    """The paths that are files the scan would make targets of, but that have none.
+    Temporary files of editors are usually gone by the end of the burst."""
+    outputs = {dependency_key(node.output_path) for node in targets.nodes.values() if node.output_path is not None}
+    return [path for path in paths
+            if dependency_key(path) not in outputs and not should_ignore_path(config, Path(path)) and os.path.isfile(path)]
+
+
+def changed_dirs(targets: BuildTargets, config: Config, paths: Set[str]) -> List[str]:
+    """The paths that are directories the scan would walk but didn't, or walked directories that are gone"""
+    walked = targets.watch_targets.watched_dirs
+    return [path for path in paths
+            if not should_ignore_path(config, Path(path)) and os.path.isdir(path) != (path in walked)]
+
+
+def update_targets(targets: BuildTargets, config: Config, changed: Set[str], unknown: Set[str],
+                   scan: Callable[[], BuildTargets]) -> Tuple[BuildTargets, Optional[List[BuildTarget]]]:
+    """Bring targets up to date with the paths of a burst of events. Returns the
+    targets, which are scanned again if the set of targets changed, and the targets
+    affected by the changes, or None if the tree was scanned again."""
+    # Event paths are resolved, while the graph is keyed by the paths the scan was given
+    changed = targets.watch_targets.dependency_keys(changed)
+    deleted = [path for path in changed if dependency_key(path) in targets.node_keys and not os.path.exists(path)]
+    if deleted or new_inputs(targets, config, unknown) or changed_dirs(targets, config, unknown):
+        return scan(), None
+    if changed:
+        targets.refresh(changed)
+        return targets, targets.affected_targets(changed)
+    return targets, []
+
+
+class TreeWatcher:
+    """A watchdog observer of the watched directories of a build graph, whose events
+    go to a ChangeCollector. Directories are added as the graph grows."""
+
+    def __init__(self, targets: BuildTargets):
+        from watchdog.observers import Observer
+        self.collector = ChangeCollector(targets.watch_targets.watched_files)
+        self.observer = Observer()
+        self.watched_dirs: Set[Path] = set()
+        self.targets: Optional[BuildTargets] = None
+        self.update(targets)
+        self.observer.start()
+
+    def update(self, targets: BuildTargets):
+        """Watch the files of targets, e.g. after they were scanned again"""
+        if targets is not self.targets:
+            outputs = output_paths(targets)
+            with self.collector.condition:
+                self.collector.watched = targets.watch_targets.watched_files
+                self.collector.outputs = outputs
+            self.targets = targets
+        for directory in targets.watch_targets.get_watch_dirs():
+            if directory not in self.watched_dirs and directory.is_dir():
+                self.observer.schedule(self.collector, str(directory), recursive=False)
+                self.watched_dirs.add(directory)
+
+    def stop(self):
+        self.observer.stop()
+        self.observer.join()
+
+
+def watch(targets: BuildTargets, config: Config, scan: Callable[[], BuildTargets], store: Any = None):
+    """Rebuild on changes until interrupted. scan builds the targets of the tree again.
+    Rebuilt outputs are published to the dev server's store, if there is one."""
+    from .build import build
+
+    watcher = TreeWatcher(targets)
+    collector = watcher.collector
+    print(f"Watching {len(watcher.watched_dirs)} directories for changes (Ctrl-C to stop)", file=sys.stderr)
+    stop = collector.has_changes if store is not None else None
+    deferred: List[BuildTarget] = [] # targets the last build was stopped before
+    try:
+        while True:
+            changed, unknown = collector.wait()
+            started = time.perf_counter()
+            targets, affected = update_targets(targets, config, changed, unknown, scan)
+            if targets.metadata_cache:
+                # Like the daemon, commit what was parsed, so other runs aren't locked out of the cache
+                targets.metadata_cache.commit()
+            if affected is None:
+                summary = build(targets, config, store=store, stop=stop)
+            elif affected or deferred:
+                affected = {id(node): node for node in affected + deferred}
+                summary = build(targets, config, sorted(affected.values(), key=lambda node: node.order), store, stop)
+            else:
+                continue
+            deferred = summary.deferred
+            watcher.update(targets)
+            viewed = f", open pages in {summary.viewed_seconds * 1000:.0f} ms" if summary.viewed_seconds is not None else ""
+            print(f"{summary} in {(time.perf_counter() - started) * 1000:.0f} ms{viewed}", flush=True)
+            for input_file, error in summary.errors:
+                print(f"  {input_file}: {error}", file=sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.stop()
@@ -0,0 +1,70 @@
+"""
+Output writer: writes rendered pages only if their contents changed.
+
+A page is rendered into memory and hashed. If the existing output has the same
+size and hash, it is left alone, so its mtime doesn't change and rsync, CDNs and
+browser caches don't see a new file. Otherwise the page is written to a temporary
+file next to the output and renamed over it, so readers like the dev server see
+either the old or the new file, never a half-written one.
+
+With --fsync, the files written by a build are flushed to disk together at the
+end of the build, followed by the directories holding them, which makes the
+renames durable.
+"""
+
+from typing import Any, Iterable, List, Tuple
+from pathlib import Path
+import os
+import sys
+
+from .manifest import written_state
+from .source import content_hash, file_hash
+
+
+def temp_path_for(output_path: Path) -> Path:
+    """A path next to output_path to write it at, before renaming it into place"""
+    return output_path.with_name(f".{output_path.name}.{os.getpid()}.tmp")
+
+
+def write_if_changed(output_path: Path, data: bytes) -> Tuple[List[Any], bool]:
+    """Write data to output_path unless the file already holds it. Returns the output
+    state for the manifest, and whether the file was written."""
+    digest = content_hash(data)
+    try:
+        st = os.stat(output_path)
+        if st.st_size == len(data) and file_hash(output_path) == digest:
+            return [st.st_mtime_ns, st.st_size, digest], False
+    except OSError:
+        pass
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = temp_path_for(output_path)
+    try:
+        temp_path.write_bytes(data)
+        os.replace(temp_path, output_path)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    return written_state(output_path, digest), True
+
+
+def sync_files(paths: Iterable[Path]):
+    """Flush files, and then the directories holding them, to disk"""
+    directories = set()
+    for path in paths:
+        directories.add(os.path.dirname(os.path.abspath(path)))
+        sync_path(path)
+    # Directories can't be opened for fsync on Windows
+    if sys.platform != 'win32':
+        for directory in sorted(directories):
+            sync_path(directory)
+
+
+def sync_path(path: Any):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print(f"Warning: Could not sync {path} to disk: {e}", file=sys.stderr)